@@ -1,132 +1,335 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 import sqlite3
-import hashlib
 import secrets
-from datetime import datetime
+from datetime import datetime, timedelta
+import base64
+import functools
+import csv
+import io
+import json
 import os
 
-app = Flask(__name__, static_folder='static')
-CORS(app)
+from db import DATABASE, get_db, close_db, check_query_plans
+import archive
+import assets
+import events
+import idempotency
+import ledger
+import metrics
+import migrations
+import passwords
+import pipeline
+import money
+import rates
+import ratelimit
+import reports
+import sessions
+import sharding
+import statements
 
-# Use /tmp directory for SQLite on Render (ephemeral but writable)
-DATABASE = os.path.join('/tmp', 'paypal_mvp.db') if os.path.exists('/tmp') else 'paypal_mvp.db'
+# /static/ is served by serve_static() from the in-memory asset table, not Flask's static view
+app = Flask(__name__, static_folder=None)
+CORS(app, expose_headers=['X-Next-Cursor'])
 
-def get_db():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Pooled connections go back to the worker's pool at the end of each request
+app.teardown_appcontext(close_db)
 
-def init_db():
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            balance REAL DEFAULT 0.0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Cards table (simulated) - Now with card type and USD balance
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS cards (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            card_number TEXT NOT NULL,
-            card_holder TEXT NOT NULL,
-            card_type TEXT NOT NULL,
-            expiry TEXT NOT NULL,
-            cvv TEXT NOT NULL,
-            balance_usd REAL DEFAULT 200000.0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Transactions table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            from_user_id INTEGER,
-            to_user_id INTEGER,
-            from_card_id INTEGER,
-            to_card_id INTEGER,
-            amount REAL NOT NULL,
-            currency TEXT DEFAULT 'TL',
-            type TEXT NOT NULL,
-            description TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (from_user_id) REFERENCES users (id),
-            FOREIGN KEY (to_user_id) REFERENCES users (id),
-            FOREIGN KEY (from_card_id) REFERENCES cards (id),
-            FOREIGN KEY (to_card_id) REFERENCES cards (id)
+# Per-route latency and per-statement SQL timings, served on /metrics
+if metrics.ENABLED:
+    metrics.init_app(app)
+
+# Optional group commit: postings are applied in batches by one writer per worker
+if pipeline.ENABLED and sharding.ENABLED:
+    app.logger.warning('WRITE_PIPELINE is ignored when SHARDS is set')
+elif pipeline.ENABLED:
+    ledger.pipeline = pipeline.WritePipeline()
+
+# Old events are pruned by a thread in each worker, streams or not
+app.before_request(events.pruner.start)
+
+# Cross-shard credits a request had to defer are retried by a thread in each worker
+if sharding.ENABLED:
+    app.before_request(sharding.retrier.start)
+
+# Per-route rate limits and transfer velocity rules, in memory shared by all workers
+if ratelimit.ENABLED:
+    ratelimit.init_app(app)
+
+# Transaction history: one indexed branch per direction, merged by SQLite.
+# A single "from_user_id = ? OR to_user_id = ?" cannot walk either index in
+# created_at order and ends up sorting the user's entire history.
+# Pages are keyset-paginated on (created_at, id), so every page is an index
+# seek no matter how deep it is.
+TRANSACTIONS_QUERY = '''
+    SELECT t.*,
+           u_from.email as from_email,
+           u_to.email as to_email,
+           c_from.card_type as from_card_type,
+           c_to.card_type as to_card_type
+    FROM (
+        SELECT * FROM (
+            SELECT * FROM transactions
+            WHERE from_user_id = :user_id AND (created_at, id) < (:before_ts, :before_id)
+            ORDER BY created_at DESC, id DESC LIMIT :limit
         )
-    ''')
-    
-    # Exchange rates table - All major currencies
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS exchange_rates (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            currency_code TEXT UNIQUE NOT NULL,
-            rate_to_usd REAL NOT NULL,
-            currency_name TEXT NOT NULL,
-            symbol TEXT NOT NULL,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        UNION ALL
+        SELECT * FROM (
+            SELECT * FROM transactions
+            WHERE to_user_id = :user_id AND (created_at, id) < (:before_ts, :before_id)
+              AND from_user_id IS NOT :user_id
+            ORDER BY created_at DESC, id DESC LIMIT :limit
         )
-    ''')
-    
-    # Insert default exchange rates if not exists
-    cursor.execute('SELECT COUNT(*) FROM exchange_rates')
-    if cursor.fetchone()[0] == 0:
-        default_rates = [
-            ('USD', 1.0, 'US Dollar', '$'),
-            ('EUR', 0.92, 'Euro', '€'),
-            ('GBP', 0.79, 'British Pound', '£'),
-            ('JPY', 149.50, 'Japanese Yen', '¥'),
-            ('CHF', 0.88, 'Swiss Franc', 'Fr'),
-            ('CAD', 1.35, 'Canadian Dollar', 'C$'),
-            ('AUD', 1.52, 'Australian Dollar', 'A$'),
-            ('TRY', 34.50, 'Turkish Lira', '₺'),
-            ('CNY', 7.24, 'Chinese Yuan', '¥'),
-            ('RUB', 92.50, 'Russian Ruble', '₽'),
-            ('SAR', 3.75, 'Saudi Riyal', '﷼'),
-            ('AED', 3.67, 'UAE Dirham', 'د.إ'),
-            ('INR', 83.12, 'Indian Rupee', '₹'),
-            ('BRL', 4.97, 'Brazilian Real', 'R$'),
-            ('KRW', 1305.50, 'South Korean Won', '₩'),
-            ('MXN', 17.15, 'Mexican Peso', '$'),
-            ('SEK', 10.35, 'Swedish Krona', 'kr'),
-            ('NOK', 10.52, 'Norwegian Krone', 'kr'),
-            ('DKK', 6.87, 'Danish Krone', 'kr'),
-            ('PLN', 4.02, 'Polish Zloty', 'zł')
-        ]
-        
-        for rate in default_rates:
-            cursor.execute('''
-                INSERT INTO exchange_rates (currency_code, rate_to_usd, currency_name, symbol)
-                VALUES (?, ?, ?, ?)
-            ''', rate)
-    
-    conn.commit()
-    conn.close()
+    ) t
+    LEFT JOIN users u_from ON t.from_user_id = u_from.id
+    LEFT JOIN users u_to ON t.to_user_id = u_to.id
+    LEFT JOIN cards c_from ON t.from_card_id = c_from.id
+    LEFT JOIN cards c_to ON t.to_card_id = c_to.id
+    ORDER BY t.created_at DESC, t.id DESC
+    LIMIT :limit
+'''
+
+# The whole dashboard as one JSON document built inside SQLite: Python only
+# passes the text through, no per-row dicts. Nested JSON comes back through
+# scalar subqueries, which drop SQLite's JSON subtype, hence the json() wraps.
+# Cached rates are spliced in as-is via :rates. When the first page reaches
+# into archived months it is built in Python and passed in as :history.
+DASHBOARD_QUERY = f'''
+    SELECT json_object(
+        'user', json_object('user_id', u.id, 'email', u.email,
+                            'balance', {money.from_minor_sql('u.balance_minor')}),
+        'cards', json((
+            SELECT json_group_array(json_object(
+                'id', c.id,
+                'card_number', '**** **** **** ' || substr(c.card_number, -4),
+                'card_holder', c.card_holder,
+                'card_type', c.card_type,
+                'expiry', c.expiry,
+                'balance_usd', {money.from_minor_sql('c.balance_usd_minor', money.CARD_CURRENCY)}
+            ))
+            FROM cards c WHERE c.user_id = :user_id
+        )),
+        'transactions', coalesce(json(:history), json((
+            SELECT json_group_array(json_object(
+                'id', id,
+                'amount', {money.from_minor_sql('amount_minor', currency_column='currency')},
+                'currency', coalesce(currency, 'TL'),
+                'type', type,
+                'description', description,
+                'from_email', from_email,
+                'to_email', to_email,
+                'from_card_type', from_card_type,
+                'to_card_type', to_card_type,
+                'created_at', created_at,
+                'is_incoming', json(iif(to_user_id IS :user_id, 'true', 'false')),
+                'balance_after', {money.from_minor_sql('iif(to_user_id IS :user_id, to_balance_after, from_balance_after)')}
+            ))
+            FROM ({TRANSACTIONS_QUERY})
+        ))),
+        'exchange_rates', json(:rates)
+    )
+    FROM users u
+    WHERE u.id = :user_id
+'''
+
+# Queries that must stay index-backed; checked against the live schema at startup
+HOT_QUERIES = {
+    'transactions': (TRANSACTIONS_QUERY, {'user_id': 1, 'limit': 50, 'before_ts': '', 'before_id': 0}),
+    'cards': ('SELECT id, card_number, card_holder, card_type, expiry, balance_usd_minor FROM cards WHERE user_id = ?', (1,)),
+    'user': ('SELECT id, email, balance_minor FROM users WHERE id = ?', (1,)),
+    'user_by_email': ('SELECT id FROM users WHERE email = ?', ('x',)),
+    'balance_at': (statements.BALANCE_AT_QUERY, {'user_id': 1, 'ts': ''}),
+    'first_row': (statements.FIRST_ROW_QUERY, {'user_id': 1}),
+    'rollups': (statements.ROLLUPS_QUERY, (1, '', '')),
+    'dashboard': (DASHBOARD_QUERY, {'user_id': 1, 'limit': 50, 'before_ts': '', 'before_id': 0, 'rates': '{}',
+                                    'history': None}),
+    'page_floor': (archive.PAGE_FLOOR_QUERY, {'user_id': 1, 'limit': 50}),
+    'events_since': (events.SINCE_QUERY, (1, 0, 1)),
+    'events_tail': (events.TAIL_QUERY, (0,)),
+    'idempotency_key': (idempotency.LOOKUP_QUERY, (1, 'x', 0)),
+}
+
+# Fingerprinted, precompressed static files, built once per worker
+STATIC_ASSETS, STATIC_MANIFEST = assets.build()
+
+# Starting balances, in minor units
+WELCOME_BONUS_MINOR = money.to_minor(100, 'TL')
+CARD_START_BALANCE_MINOR = money.to_minor(200000, 'USD')
+
+# Browsers may reuse rates this long before revalidating with If-None-Match
+RATES_MAX_AGE = 60
+
+MAX_QUOTES = 1000
+MAX_BATCH_ITEMS = 100000
+
+TRANSACTIONS_PAGE_SIZE = 50
+TRANSACTIONS_MAX_PAGE_SIZE = 200
+EXPORT_BATCH_SIZE = 500
+
+STATEMENT_MAX_DAYS = 366
+
+# Sorts after every real (created_at, id), i.e. "start from the newest"
+FIRST_PAGE = ('9999-12-31 23:59:59', 2 ** 63 - 1)
+
+def encode_cursor(created_at, tx_id):
+    raw = json.dumps([created_at, tx_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    if not cursor:
+        return FIRST_PAGE
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, tx_id = json.loads(raw)
+        if not isinstance(created_at, str) or not isinstance(tx_id, int):
+            raise ValueError(cursor)
+        return created_at, tx_id
+    except (ValueError, TypeError):
+        return None
+
+def fetch_transactions(cursor, user_id, before, limit):
+    params = {
+        'user_id': user_id,
+        'before_ts': before[0],
+        'before_id': before[1],
+        'limit': limit
+    }
+    cursor.execute(TRANSACTIONS_QUERY, params)
+    # Pages that run past the hot table continue into the user's archived months
+    return archive.extend_page(cursor.connection, TRANSACTIONS_QUERY, params, cursor.fetchall(),
+                               user_id, before[0], limit)
+
+def transaction_to_dict(tx, user_id):
+    # This user's TL balance right after the row; None on rows from before it was recorded
+    balance_after = tx['to_balance_after'] if tx['to_user_id'] == user_id else tx['from_balance_after']
+    return {
+        'id': tx['id'],
+        'amount': money.from_minor(tx['amount_minor'], tx['currency'] or 'TL'),
+        'currency': tx['currency'] if tx['currency'] else 'TL',
+        'type': tx['type'],
+        'description': tx['description'],
+        'from_email': tx['from_email'],
+        'to_email': tx['to_email'],
+        'from_card_type': tx['from_card_type'],
+        'to_card_type': tx['to_card_type'],
+        'created_at': tx['created_at'],
+        'is_incoming': tx['to_user_id'] == user_id,
+        'balance_after': balance_after if balance_after is None else money.from_minor(balance_after)
+    }
+
+def login_required(view):
+    # Resolves the bearer token to g.user_id; the per-worker token cache makes this a dict hit
+    @functools.wraps(view)
+    def wrapped(*args, **kwargs):
+        token = bearer_token()
+        user_id = sessions.lookup(get_db(), token) if token else None
+        # EventSource cannot set headers: the stream takes a short-lived, stream-only ticket in the URL
+        ticket = request.args.get('ticket') if request.endpoint == 'stream_events' else None
+        if user_id is None and ticket:
+            user_id = sessions.lookup_ticket(get_db(), ticket)
+        if user_id is None:
+            return jsonify({'error': 'Oturum geçersiz, lütfen tekrar giriş yapın'}), 401
+        g.user_id = user_id
+        # From here on get_db() is the user's shard (DATABASE unless sharded)
+        g.db_path = sharding.path_for_user(user_id)
+        if ratelimit.ENABLED:
+            limited = ratelimit.check(('user',))
+            if limited:
+                return limited
+        return view(*args, **kwargs)
+    return wrapped
+
+def idempotent(view):
+    # A repeated Idempotency-Key gets the recorded response instead of a second posting (see idempotency.py)
+    @functools.wraps(view)
+    def wrapped(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > idempotency.MAX_KEY_LENGTH:
+            return jsonify({'error': 'Geçersiz Idempotency-Key'}), 400
+        fingerprint = idempotency.fingerprint(request.method, request.path, request.get_data())
+        stored = idempotency.lookup(get_db(), g.user_id, key)
+        if stored is None:
+            g.idempotency = idempotency.Claim(g.user_id, key, fingerprint)
+            try:
+                return view(*args, **kwargs)
+            except idempotency.Duplicate:
+                stored = idempotency.lookup(get_db(), g.user_id, key)
+                # The winner's record expired in between; nothing to replay
+                if stored is None:
+                    return jsonify({'error': 'Bu Idempotency-Key ile yapılan istek zaman aşımına uğradı, '
+                                             'lütfen yeni bir anahtarla tekrar deneyin'}), 409
+        if stored.fingerprint != fingerprint:
+            return jsonify({'error': 'Bu Idempotency-Key başka bir istek için kullanıldı'}), 422
+        response = stored_response(stored)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+    return wrapped
+
+def stored_response(stored):
+    return Response(stored.response, status=stored.status, mimetype='application/json')
+
+def post_mutation(render, posting, *args):
+    """ledger.post() for a mutation route; returns the result and the route's
+    response, built by render(result) -> (body, status).
+
+    Under an Idempotency-Key the response is recorded in the posting's own
+    transaction, and the first request answers with the recorded bytes too.
+    """
+    claim = g.get('idempotency')
+    if claim is None:
+        result = ledger.post(get_db(), posting, *args)
+        body, status = render(result)
+        return result, (jsonify(body), status)
+    result = ledger.post(get_db(), claim.recorded(posting, render), *args)
+    claim.committed()
+    return result, stored_response(claim.stored)
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+def shard_db(shard):
+    return get_db(sharding.shard_path(shard))
+
+def deliver_transfers(transfer_ids):
+    # The debit is already committed; whatever cannot be credited now is retried by sharding.retrier
+    if not transfer_ids:
+        return
+    try:
+        sharding.deliver(get_db(), shard_db, transfer_ids)
+    except (sqlite3.OperationalError, ledger.LedgerError) as e:
+        app.logger.warning(f'Cross-shard delivery deferred: {e}')
+
+def bearer_token():
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        return header[len('Bearer '):].strip() or None
+    return None
+
+def is_current_user(user_id):
+    try:
+        return int(user_id) == g.user_id
+    except (TypeError, ValueError):
+        return False
+
+FORBIDDEN = {'error': 'Bu işlem için yetkiniz yok'}
 
 # Routes
 @app.route('/')
 def index():
-    return send_from_directory('static', 'index.html')
+    return assets.respond(STATIC_ASSETS['index.html'])
 
 @app.route('/static/<path:path>')
 def serve_static(path):
+    asset = STATIC_ASSETS.get(path)
+    if asset is not None:
+        return assets.respond(asset)
     return send_from_directory('static', path)
 
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics.ENABLED:
+        return jsonify({'error': 'Metrikler kapalı'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/register', methods=['POST'])
 def register():
     data = request.json
@@ -137,24 +340,23 @@ def register():
         return jsonify({'error': 'Email ve şifre gerekli'}), 400
     
     conn = get_db()
-    cursor = conn.cursor()
     
     try:
-        hashed_pw = hash_password(password)
-        cursor.execute('INSERT INTO users (email, password, balance) VALUES (?, ?, ?)',
-                      (email, hashed_pw, 100.0))  # 100 TL başlangıç bonusu
-        conn.commit()
-        user_id = cursor.lastrowid
+        hashed_pw = passwords.hash_password(password)
+        # 100 TL başlangıç bonusu
+        if sharding.ENABLED:
+            user_id = sharding.register(conn, shard_db, email, hashed_pw, WELCOME_BONUS_MINOR)
+        else:
+            user_id = ledger.post(conn, ledger.open_account, email, hashed_pw, WELCOME_BONUS_MINOR)
         
         return jsonify({
             'message': 'Hesap oluşturuldu! 100 TL hoş geldin bonusu eklendi.',
             'user_id': user_id,
-            'email': email
+            'email': email,
+            'token': sessions.create(conn, user_id)
         }), 201
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Bu email zaten kayıtlı'}), 400
-    finally:
-        conn.close()
 
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -166,48 +368,67 @@ def login():
         return jsonify({'error': 'Email ve şifre gerekli'}), 400
     
     conn = get_db()
-    cursor = conn.cursor()
+    user_db = get_db(sharding.path_for_email(conn, email))
+    cursor = user_db.cursor()
     
-    hashed_pw = hash_password(password)
-    cursor.execute('SELECT id, email, balance FROM users WHERE email = ? AND password = ?',
-                  (email, hashed_pw))
+    cursor.execute('SELECT id, email, balance_minor, password FROM users WHERE email = ?', (email,))
     user = cursor.fetchone()
-    conn.close()
+    
+    if not passwords.verify_password(password, user['password'] if user else None):
+        user = None
+    elif passwords.needs_rehash(user['password']):
+        # Upgrade legacy / weaker hashes now that we know the plaintext
+        cursor.execute('UPDATE users SET password = ? WHERE id = ?',
+                      (passwords.hash_password(password), user['id']))
+        user_db.commit()
     
     if user:
         return jsonify({
             'user_id': user['id'],
             'email': user['email'],
-            'balance': user['balance']
+            'balance': money.from_minor(user['balance_minor']),
+            'token': sessions.create(conn, user['id'])
         }), 200
     else:
         return jsonify({'error': 'Email veya şifre hatalı'}), 401
 
+@app.route('/api/logout', methods=['POST'])
+@login_required
+def logout():
+    sessions.revoke(get_db(DATABASE), bearer_token())
+    return jsonify({'message': 'Çıkış yapıldı'}), 200
+
 @app.route('/api/user/<int:user_id>', methods=['GET'])
+@login_required
 def get_user(user_id):
+    if user_id != g.user_id:
+        return jsonify(FORBIDDEN), 403
+    
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT id, email, balance FROM users WHERE id = ?', (user_id,))
+    cursor.execute('SELECT id, email, balance_minor FROM users WHERE id = ?', (user_id,))
     user = cursor.fetchone()
-    conn.close()
     
     if user:
         return jsonify({
             'user_id': user['id'],
             'email': user['email'],
-            'balance': user['balance']
+            'balance': money.from_minor(user['balance_minor'])
         }), 200
     else:
         return jsonify({'error': 'Kullanıcı bulunamadı'}), 404
 
 @app.route('/api/cards/<int:user_id>', methods=['GET'])
+@login_required
 def get_cards(user_id):
+    if user_id != g.user_id:
+        return jsonify(FORBIDDEN), 403
+    
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT id, card_number, card_holder, card_type, expiry, balance_usd FROM cards WHERE user_id = ?',
+    cursor.execute('SELECT id, card_number, card_holder, card_type, expiry, balance_usd_minor FROM cards WHERE user_id = ?',
                   (user_id,))
     cards = cursor.fetchall()
-    conn.close()
     
     return jsonify([{
         'id': card['id'],
@@ -215,10 +436,36 @@ def get_cards(user_id):
         'card_holder': card['card_holder'],
         'card_type': card['card_type'],
         'expiry': card['expiry'],
-        'balance_usd': card['balance_usd']
+        'balance_usd': money.from_minor(card['balance_usd_minor'], 'USD')
     } for card in cards]), 200
 
+@app.route('/api/dashboard/<int:user_id>', methods=['GET'])
+@login_required
+def get_dashboard(user_id):
+    if user_id != g.user_id:
+        return jsonify(FORBIDDEN), 403
+    
+    conn = get_db()
+    history = None
+    if not archive.page_is_hot(conn, user_id, TRANSACTIONS_PAGE_SIZE):
+        history = json.dumps([transaction_to_dict(tx, user_id) for tx in fetch_transactions(
+            conn.cursor(), user_id, FIRST_PAGE, TRANSACTIONS_PAGE_SIZE)], ensure_ascii=False)
+    row = conn.execute(DASHBOARD_QUERY, {
+        'user_id': user_id,
+        'before_ts': FIRST_PAGE[0],
+        'before_id': FIRST_PAGE[1],
+        'limit': TRANSACTIONS_PAGE_SIZE,
+        'rates': rates.current(conn).json.decode(),
+        'history': history
+    }).fetchone()
+    
+    if row is None:
+        return jsonify({'error': 'Kullanıcı bulunamadı'}), 404
+    return Response(row[0], mimetype='application/json')
+
 @app.route('/api/cards', methods=['POST'])
+@login_required
+@idempotent
 def add_card():
     data = request.json
     user_id = data.get('user_id')
@@ -231,6 +478,9 @@ def add_card():
     if not all([user_id, card_number, card_holder, card_type, expiry, cvv]):
         return jsonify({'error': 'Tüm kart bilgileri gerekli'}), 400
     
+    if not is_current_user(user_id):
+        return jsonify(FORBIDDEN), 403
+    
     # Simple validation
     if len(card_number.replace(' ', '')) != 16:
         return jsonify({'error': 'Kart numarası 16 haneli olmalı'}), 400
@@ -238,25 +488,16 @@ def add_card():
     if card_type not in ['Visa', 'Mastercard', 'Troy']:
         return jsonify({'error': 'Geçersiz kart tipi'}), 400
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('''
-            INSERT INTO cards (user_id, card_number, card_holder, card_type, expiry, cvv, balance_usd)
-            VALUES (?, ?, ?, ?, ?, ?, 200000.0)
-        ''', (user_id, card_number.replace(' ', ''), card_holder, card_type, expiry, cvv))
-        conn.commit()
-        card_id = cursor.lastrowid
-        
-        return jsonify({
-            'message': f'{card_type} kart başarıyla eklendi (200,000 USD bakiye)',
-            'card_id': card_id
-        }), 201
-    finally:
-        conn.close()
+    _, response = post_mutation(lambda result: ({
+        'message': f'{card_type} kart başarıyla eklendi (200,000 USD bakiye)',
+        'card_id': result['card_id']
+    }, 201), ledger.open_card, user_id, card_number.replace(' ', ''), card_holder, card_type, expiry, cvv,
+        CARD_START_BALANCE_MINOR)
+    return response
 
 @app.route('/api/add-balance', methods=['POST'])
+@login_required
+@idempotent
 def add_balance():
     data = request.json
     user_id = data.get('user_id')
@@ -266,40 +507,25 @@ def add_balance():
     if not all([user_id, card_id, amount]):
         return jsonify({'error': 'Eksik bilgi'}), 400
     
+    if not is_current_user(user_id):
+        return jsonify(FORBIDDEN), 403
+    
     if amount <= 0:
         return jsonify({'error': 'Miktar 0\'dan büyük olmalı'}), 400
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Verify card belongs to user
-    cursor.execute('SELECT id FROM cards WHERE id = ? AND user_id = ?', (card_id, user_id))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({'error': 'Kart bulunamadı'}), 404
-    
-    # Update balance
-    cursor.execute('UPDATE users SET balance = balance + ? WHERE id = ?', (amount, user_id))
-    
-    # Record transaction
-    cursor.execute('''
-        INSERT INTO transactions (to_user_id, amount, type, description)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, amount, 'deposit', f'Kredi kartından {amount} TL yükleme'))
+    amount_minor = money.to_minor(amount, 'TL')
+    if amount_minor is None:
+        return jsonify({'error': 'Geçersiz miktar'}), 400
     
-    conn.commit()
-    
-    # Get new balance
-    cursor.execute('SELECT balance FROM users WHERE id = ?', (user_id,))
-    new_balance = cursor.fetchone()['balance']
-    conn.close()
-    
-    return jsonify({
+    _, response = post_mutation(lambda result: ({
         'message': f'{amount} TL bakiye eklendi',
-        'new_balance': new_balance
-    }), 200
+        'new_balance': money.from_minor(result['new_balance'])
+    }, 200), ledger.deposit, user_id, card_id, amount_minor)
+    return response
 
 @app.route('/api/send-money', methods=['POST'])
+@login_required
+@idempotent
 def send_money():
     data = request.json
     from_user_id = data.get('from_user_id')
@@ -310,79 +536,174 @@ def send_money():
     if not all([from_user_id, to_email, amount]):
         return jsonify({'error': 'Eksik bilgi'}), 400
     
+    if not is_current_user(from_user_id):
+        return jsonify(FORBIDDEN), 403
+    
     if amount <= 0:
         return jsonify({'error': 'Miktar 0\'dan büyük olmalı'}), 400
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Get sender
-    cursor.execute('SELECT balance, email FROM users WHERE id = ?', (from_user_id,))
-    sender = cursor.fetchone()
-    
-    if not sender:
-        conn.close()
-        return jsonify({'error': 'Gönderen kullanıcı bulunamadı'}), 404
-    
-    if sender['balance'] < amount:
-        conn.close()
-        return jsonify({'error': 'Yetersiz bakiye'}), 400
+    amount_minor = money.to_minor(amount, 'TL')
+    if amount_minor is None:
+        return jsonify({'error': 'Geçersiz miktar'}), 400
     
-    # Get receiver
-    cursor.execute('SELECT id FROM users WHERE email = ?', (to_email,))
-    receiver = cursor.fetchone()
+    def render(result):
+        return {'message': f'{amount} TL gönderildi', 'new_balance': money.from_minor(result['new_balance'])}, 200
     
-    if not receiver:
-        conn.close()
-        return jsonify({'error': 'Alıcı kullanıcı bulunamadı'}), 404
-    
-    if sender['email'] == to_email:
-        conn.close()
-        return jsonify({'error': 'Kendinize para gönderemezsiniz'}), 400
+    receiver = sharding.remote_accounts(get_db(DATABASE), from_user_id, [to_email]).get(to_email)
+    if receiver is not None:
+        result, response = post_mutation(render, ledger.transfer_out, from_user_id, receiver, amount_minor,
+                                         description)
+        deliver_transfers(result['transfer_ids'])
+    else:
+        _, response = post_mutation(render, ledger.transfer, from_user_id, to_email, amount_minor, description)
+    return response
+
+@app.route('/api/send-money/batch', methods=['POST'])
+@login_required
+@idempotent
+def send_money_batch():
+    data = request.json
+    from_user_id = data.get('from_user_id')
+    items = data.get('items')
     
-    # Perform transaction
-    cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ?',
-                  (amount, from_user_id))
-    cursor.execute('UPDATE users SET balance = balance + ? WHERE id = ?',
-                  (amount, receiver['id']))
+    if not from_user_id or not isinstance(items, list) or not items:
+        return jsonify({'error': 'Eksik bilgi'}), 400
     
-    # Record transaction
-    cursor.execute('''
-        INSERT INTO transactions (from_user_id, to_user_id, amount, type, description)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (from_user_id, receiver['id'], amount, 'transfer', description))
+    if not is_current_user(from_user_id):
+        return jsonify(FORBIDDEN), 403
+    
+    if len(items) > MAX_BATCH_ITEMS:
+        return jsonify({'error': f'Tek seferde en fazla {MAX_BATCH_ITEMS} ödeme gönderilebilir'}), 400
+    
+    # Malformed entries fail on their own; the rest go to the ledger in one transaction
+    results = [None] * len(items)
+    valid = []
+    valid_indexes = []
+    for i, item in enumerate(items):
+        to_email = item.get('to_email') if isinstance(item, dict) else None
+        amount_minor = money.to_minor(item.get('amount'), 'TL') if to_email else None
+        if not to_email or amount_minor is None:
+            results[i] = {'status': 'error', 'error': 'Eksik veya geçersiz bilgi'}
+        elif amount_minor <= 0:
+            results[i] = {'status': 'error', 'error': 'Miktar 0\'dan büyük olmalı'}
+        else:
+            valid.append((to_email, amount_minor, item.get('description', '')))
+            valid_indexes.append(i)
+    
+    if not valid:
+        return jsonify({'error': 'Gönderilecek geçerli ödeme yok', 'results': results}), 400
+    
+    def render(posted):
+        for i, result in zip(valid_indexes, posted['results']):
+            results[i] = result
+        sent = sum(1 for r in results if r['status'] == 'ok')
+        return {
+            'message': f'{sent}/{len(items)} ödeme gönderildi ({money.format_amount(posted["total"])} TL)',
+            'new_balance': money.from_minor(posted['new_balance']),
+            'results': results
+        }, 200
+    
+    remote = sharding.remote_accounts(get_db(DATABASE), from_user_id, [item[0] for item in valid])
+    posted, response = post_mutation(render, ledger.transfer_batch, from_user_id, valid, remote)
+    deliver_transfers(posted.get('transfer_ids'))
+    return response
+
+@app.route('/api/statement/<int:user_id>', methods=['GET'])
+@login_required
+def get_statement(user_id):
+    if user_id != g.user_id:
+        return jsonify(FORBIDDEN), 403
+    
+    today = datetime.utcnow().date()
+    start = statements.parse_day(request.args.get('from', today.replace(day=1).isoformat()))
+    end = statements.parse_day(request.args.get('to', today.isoformat()))
+    if start is None or end is None:
+        return jsonify({'error': 'Tarihler YYYY-MM-DD biçiminde olmalı'}), 400
+    if start > end:
+        return jsonify({'error': 'Başlangıç tarihi bitişten sonra olamaz'}), 400
+    if (end - start).days >= STATEMENT_MAX_DAYS:
+        return jsonify({'error': f'Ekstre en fazla {STATEMENT_MAX_DAYS} günü kapsayabilir'}), 400
+    
+    return jsonify(statements.statement(get_db(), user_id, start, end)), 200
+
+@app.route('/api/balance-at/<int:user_id>', methods=['GET'])
+@login_required
+def get_balance_at(user_id):
+    if user_id != g.user_id:
+        return jsonify(FORBIDDEN), 403
     
-    conn.commit()
+    ts = statements.parse_timestamp(request.args.get('ts'))
+    if ts is None:
+        return jsonify({'error': 'ts ISO tarih/saat olmalı (ör. 2024-05-01T12:00:00)'}), 400
     
-    # Get new balance
-    cursor.execute('SELECT balance FROM users WHERE id = ?', (from_user_id,))
-    new_balance = cursor.fetchone()['balance']
-    conn.close()
+    balance_minor = statements.balance_at(get_db(), user_id, ts)
+    if balance_minor is None:
+        return jsonify({'error': 'Bu tarih için bakiye kaydı yok'}), 404
     
-    return jsonify({
-        'message': f'{amount} TL gönderildi',
-        'new_balance': new_balance
-    }), 200
+    return jsonify({'user_id': user_id, 'ts': ts, 'balance': money.from_minor(balance_minor)}), 200
 
 @app.route('/api/exchange-rates', methods=['GET'])
 def get_exchange_rates():
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('SELECT currency_code, rate_to_usd, currency_name, symbol FROM exchange_rates ORDER BY currency_code')
-    rates = cursor.fetchall()
-    conn.close()
+    table = rates.current(get_db())
     
-    result = {}
-    for rate in rates:
-        result[rate['currency_code']] = {
-            'rate_to_usd': rate['rate_to_usd'],
-            'currency_name': rate['currency_name'],
-            'symbol': rate['symbol']
-        }
+    if table.etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(table.json, mimetype='application/json')
+    response.set_etag(table.etag)
+    response.headers['Cache-Control'] = f'public, max-age={RATES_MAX_AGE}'
+    return response
+
+@app.route('/api/quote', methods=['POST'])
+def quote():
+    data = request.json
+    table = rates.current(get_db())
     
-    return jsonify(result), 200
+    # Either an explicit list of triples, or one amount against every currency
+    if 'quotes' in data:
+        requested = data['quotes']
+        if not isinstance(requested, list):
+            return jsonify({'error': 'quotes bir liste olmalı'}), 400
+    else:
+        to_currency = data.get('to', 'all')
+        targets = sorted(table.rates) if to_currency == 'all' else [to_currency]
+        requested = [{'from': data.get('from'), 'to': target, 'amount': data.get('amount')}
+                     for target in targets if target != data.get('from')]
+    
+    if len(requested) > MAX_QUOTES:
+        return jsonify({'error': f'En fazla {MAX_QUOTES} kur hesaplanabilir'}), 400
+    
+    cross = table.cross
+    quotes = []
+    for item in requested:
+        if not isinstance(item, dict):
+            quotes.append({'error': 'Eksik veya geçersiz bilgi'})
+            continue
+        from_currency = item.get('from')
+        to_currency = item.get('to')
+        amount = item.get('amount')
+        entry = {'from': from_currency, 'to': to_currency, 'amount': amount}
+        # Codes straight from the body may be unhashable (lists, objects)
+        codes = (from_currency, to_currency)
+        if not all(isinstance(code, str) and code in cross for code in codes):
+            entry['error'] = 'Geçersiz para birimi'
+            quotes.append(entry)
+            continue
+        amount_minor = money.to_minor(amount, from_currency)
+        if amount_minor is None or amount_minor <= 0:
+            entry['error'] = 'Geçersiz miktar'
+        else:
+            # Same integer path convert-currency uses, so the quote is exactly what would be credited
+            converted_minor = money.convert(amount_minor, from_currency, to_currency, table.scaled)
+            entry['rate'] = cross[from_currency][to_currency]
+            entry['converted_amount'] = money.from_minor(converted_minor, to_currency)
+        quotes.append(entry)
+    
+    return jsonify({'quotes': quotes, 'rates_version': table.version}), 200
 
 @app.route('/api/convert-currency', methods=['POST'])
+@login_required
+@idempotent
 def convert_currency():
     data = request.json
     user_id = data.get('user_id')
@@ -394,86 +715,29 @@ def convert_currency():
     if not all([user_id, card_id, from_currency, to_currency, amount]):
         return jsonify({'error': 'Eksik bilgi'}), 400
     
+    if not is_current_user(user_id):
+        return jsonify(FORBIDDEN), 403
+    
     if amount <= 0:
         return jsonify({'error': 'Miktar 0\'dan büyük olmalı'}), 400
     
     if from_currency == to_currency:
         return jsonify({'error': 'Aynı para birimine çevrilemez'}), 400
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Get exchange rates
-    cursor.execute('SELECT currency_code, rate_to_usd, symbol FROM exchange_rates WHERE currency_code IN (?, ?)',
-                  (from_currency, to_currency))
-    rates = {row['currency_code']: {'rate': row['rate_to_usd'], 'symbol': row['symbol']} 
-             for row in cursor.fetchall()}
-    
-    if len(rates) != 2:
-        conn.close()
-        return jsonify({'error': 'Geçersiz para birimi'}), 400
-    
-    # Get card
-    cursor.execute('SELECT balance_usd FROM cards WHERE id = ? AND user_id = ?', (card_id, user_id))
-    card = cursor.fetchone()
+    amount_minor = money.to_minor(amount, from_currency)
+    if amount_minor is None:
+        return jsonify({'error': 'Geçersiz miktar'}), 400
     
-    if not card:
-        conn.close()
-        return jsonify({'error': 'Kart bulunamadı'}), 404
-    
-    # Calculate conversion
-    # Convert from_currency to USD, then USD to to_currency
-    amount_in_usd = amount / rates[from_currency]['rate']
-    converted_amount = amount_in_usd * rates[to_currency]['rate']
-    
-    # Get current user balance
-    cursor.execute('SELECT balance FROM users WHERE id = ?', (user_id,))
-    user = cursor.fetchone()
-    
-    # Determine source (card USD or user balance)
-    if from_currency == 'USD':
-        # From card USD
-        if card['balance_usd'] < amount:
-            conn.close()
-            return jsonify({'error': f'Yetersiz USD bakiye'}), 400
-        cursor.execute('UPDATE cards SET balance_usd = balance_usd - ? WHERE id = ?', (amount, card_id))
-    else:
-        # From user balance (stored as TL equivalent for simplicity)
-        # We'll store all non-USD as TL in user balance
-        if not user or user['balance'] < amount:
-            conn.close()
-            return jsonify({'error': f'Yetersiz {from_currency} bakiye'}), 400
-        cursor.execute('UPDATE users SET balance = balance - ? WHERE id = ?', (amount, user_id))
-    
-    # Add to destination
-    if to_currency == 'USD':
-        # To card USD
-        cursor.execute('UPDATE cards SET balance_usd = balance_usd + ? WHERE id = ?', (converted_amount, card_id))
-    else:
-        # To user balance
-        cursor.execute('UPDATE users SET balance = balance + ? WHERE id = ?', (converted_amount, user_id))
-    
-    # Calculate exchange rate
-    exchange_rate = converted_amount / amount
-    
-    description = f'{amount:.2f} {rates[from_currency]["symbol"]} {from_currency} → {converted_amount:.2f} {rates[to_currency]["symbol"]} {to_currency} (Kur: {exchange_rate:.4f})'
-    
-    # Record transaction
-    cursor.execute('''
-        INSERT INTO transactions (from_user_id, from_card_id, amount, currency, type, description)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, card_id, amount, from_currency, 'conversion', description))
-    
-    conn.commit()
-    conn.close()
-    
-    return jsonify({
+    _, response = post_mutation(lambda result: ({
         'message': 'Döviz çevirme başarılı',
-        'description': description,
-        'converted_amount': converted_amount
-    }), 200
+        'description': result['description'],
+        'converted_amount': money.from_minor(result['converted_minor'], to_currency)
+    }, 200), ledger.convert, user_id, card_id, from_currency, to_currency, amount_minor)
+    return response
 
 @app.route('/api/transfer-between-cards', methods=['POST'])
+@login_required
+@idempotent
 def transfer_between_cards():
     data = request.json
     user_id = data.get('user_id')
@@ -484,89 +748,176 @@ def transfer_between_cards():
     if not all([user_id, from_card_id, to_card_id, amount]):
         return jsonify({'error': 'Eksik bilgi'}), 400
     
+    if not is_current_user(user_id):
+        return jsonify(FORBIDDEN), 403
+    
     if amount <= 0:
         return jsonify({'error': 'Miktar 0\'dan büyük olmalı'}), 400
     
     if from_card_id == to_card_id:
         return jsonify({'error': 'Aynı karta transfer yapılamaz'}), 400
     
-    conn = get_db()
-    cursor = conn.cursor()
+    amount_minor = money.to_minor(amount, 'USD')
+    if amount_minor is None:
+        return jsonify({'error': 'Geçersiz miktar'}), 400
     
-    # Get cards
-    cursor.execute('SELECT balance_usd, card_type FROM cards WHERE id = ? AND user_id = ?', (from_card_id, user_id))
-    from_card = cursor.fetchone()
+    _, response = post_mutation(lambda result: ({
+        'message': f'{amount} USD transfer başarılı'
+    }, 200), ledger.card_transfer, user_id, from_card_id, to_card_id, amount_minor)
+    return response
+
+@app.route('/api/transactions/<int:user_id>', methods=['GET'])
+@login_required
+def get_transactions(user_id):
+    if user_id != g.user_id:
+        return jsonify(FORBIDDEN), 403
     
-    cursor.execute('SELECT balance_usd, card_type FROM cards WHERE id = ? AND user_id = ?', (to_card_id, user_id))
-    to_card = cursor.fetchone()
+    before = decode_cursor(request.args.get('cursor'))
+    if before is None:
+        return jsonify({'error': 'Geçersiz sayfa imleci'}), 400
     
-    if not from_card or not to_card:
-        conn.close()
-        return jsonify({'error': 'Kart(lar) bulunamadı'}), 404
+    limit = request.args.get('limit', TRANSACTIONS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, TRANSACTIONS_MAX_PAGE_SIZE))
     
-    if from_card['balance_usd'] < amount:
-        conn.close()
-        return jsonify({'error': 'Yetersiz bakiye'}), 400
+    transactions = fetch_transactions(get_db().cursor(), user_id, before, limit)
+    result = [transaction_to_dict(tx, user_id) for tx in transactions]
     
-    # Transfer
-    cursor.execute('UPDATE cards SET balance_usd = balance_usd - ? WHERE id = ?', (amount, from_card_id))
-    cursor.execute('UPDATE cards SET balance_usd = balance_usd + ? WHERE id = ?', (amount, to_card_id))
+    response = jsonify(result)
+    # The body stays a plain list; the cursor for the next page travels in a header
+    if len(transactions) == limit:
+        last = transactions[-1]
+        response.headers['X-Next-Cursor'] = encode_cursor(last['created_at'], last['id'])
+    return response, 200
+
+EXPORT_CSV_FIELDS = ['id', 'created_at', 'type', 'amount', 'currency', 'description',
+                     'from_email', 'to_email', 'from_card_type', 'to_card_type', 'is_incoming', 'balance_after']
+
+@app.route('/api/transactions/<int:user_id>/export', methods=['GET'])
+@login_required
+def export_transactions(user_id):
+    if user_id != g.user_id:
+        return jsonify(FORBIDDEN), 403
+    
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'Desteklenmeyen format'}), 400
+    
+    def rows():
+        # Walk the history one keyset page at a time so memory stays flat
+        cursor = get_db().cursor()
+        before = FIRST_PAGE
+        while True:
+            page = fetch_transactions(cursor, user_id, before, EXPORT_BATCH_SIZE)
+            for tx in page:
+                yield transaction_to_dict(tx, user_id)
+            if len(page) < EXPORT_BATCH_SIZE:
+                break
+            before = (page[-1]['created_at'], page[-1]['id'])
+    
+    def ndjson():
+        for row in rows():
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+    
+    def csv_lines():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_CSV_FIELDS)
+        writer.writeheader()
+        for row in rows():
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    
+    if export_format == 'csv':
+        body, mimetype = csv_lines(), 'text/csv'
+    else:
+        body, mimetype = ndjson(), 'application/x-ndjson'
     
-    # Record transaction
-    cursor.execute('''
-        INSERT INTO transactions (from_user_id, from_card_id, to_card_id, amount, currency, type, description)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, from_card_id, to_card_id, amount, 'USD', 'card_transfer', 
-          f'{from_card["card_type"]} → {to_card["card_type"]} ({amount} USD)'))
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=transactions-{user_id}.{export_format}'
+    })
+
+@app.route('/api/events/ticket', methods=['POST'])
+@login_required
+def create_stream_ticket():
+    # Goes in the stream's URL in place of the session token (see sessions.py)
+    ticket = sessions.create_ticket(get_db(DATABASE), g.user_id)
+    return jsonify({'ticket': ticket, 'expires_in': sessions.STREAM_TICKET_TTL}), 201
+
+@app.route('/api/events/<int:user_id>', methods=['GET'])
+@login_required
+def stream_events(user_id):
+    if user_id != g.user_id:
+        return jsonify(FORBIDDEN), 403
     
-    conn.commit()
-    conn.close()
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    last_id = int(last_id) if last_id and last_id.isdigit() else None
     
-    return jsonify({
-        'message': f'{amount} USD transfer başarılı'
-    }), 200
+    # Subscribe before reading the replay so nothing committed in between is missed
+    subscription = events.hub.subscribe(g.db_path, user_id)
+    try:
+        first_messages, last_id = events.replay(get_db(), user_id, last_id)
+    except BaseException:
+        events.hub.unsubscribe(subscription)
+        raise
+    events.hub.start(subscription, last_id)
+    
+    # Not stream_with_context: the request context, and with it the pooled
+    # connections, is released as soon as the body starts streaming
+    return Response(events.stream(subscription, first_messages), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-@app.route('/api/transactions/<int:user_id>', methods=['GET'])
-def get_transactions(user_id):
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT t.*, 
-               u_from.email as from_email,
-               u_to.email as to_email,
-               c_from.card_type as from_card_type,
-               c_to.card_type as to_card_type
-        FROM transactions t
-        LEFT JOIN users u_from ON t.from_user_id = u_from.id
-        LEFT JOIN users u_to ON t.to_user_id = u_to.id
-        LEFT JOIN cards c_from ON t.from_card_id = c_from.id
-        LEFT JOIN cards c_to ON t.to_card_id = c_to.id
-        WHERE t.from_user_id = ? OR t.to_user_id = ?
-        ORDER BY t.created_at DESC
-        LIMIT 50
-    ''', (user_id, user_id))
-    
-    transactions = cursor.fetchall()
-    conn.close()
-    
-    result = []
-    for tx in transactions:
-        result.append({
-            'id': tx['id'],
-            'amount': tx['amount'],
-            'currency': tx['currency'] if tx['currency'] else 'TL',
-            'type': tx['type'],
-            'description': tx['description'],
-            'from_email': tx['from_email'],
-            'to_email': tx['to_email'],
-            'from_card_type': tx['from_card_type'],
-            'to_card_type': tx['to_card_type'],
-            'created_at': tx['created_at'],
-            'is_incoming': tx['to_user_id'] == user_id
-        })
-    
-    return jsonify(result), 200
+@app.route('/api/reports/<name>', methods=['GET'])
+@login_required
+def get_report(name):
+    user = get_db().execute('SELECT email FROM users WHERE id = ?', (g.user_id,)).fetchone()
+    if user is None or user['email'].lower() not in reports.VIEWERS:
+        return jsonify(FORBIDDEN), 403
+    if name not in reports.REPORTS:
+        return jsonify({'error': 'Rapor bulunamadı'}), 404
+    
+    params = {}
+    if name == 'daily':
+        today = datetime.utcnow().date()
+        start = statements.parse_day(request.args.get('from', (today - timedelta(days=29)).isoformat()))
+        end = statements.parse_day(request.args.get('to', today.isoformat()))
+        if start is None or end is None:
+            return jsonify({'error': 'Tarihler YYYY-MM-DD biçiminde olmalı'}), 400
+        if start > end:
+            return jsonify({'error': 'Başlangıç tarihi bitişten sonra olamaz'}), 400
+        if (end - start).days >= reports.MAX_DAYS:
+            return jsonify({'error': f'Rapor en fazla {reports.MAX_DAYS} günü kapsayabilir'}), 400
+        params = {'from': start.isoformat(), 'to': end.isoformat()}
+    
+    # Never read from the live tables: answer from the last snapshot, refreshing it in the background
+    reports.refresh_if_stale()
+    report = reports.read(name, params)
+    if report is None:
+        response = jsonify({'error': 'Rapor henüz hazır değil, lütfen biraz sonra tekrar deneyin'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    report['age_seconds'] = round(reports.snapshot_age(report['snapshot_at']))
+    return jsonify(report), 200
+
+# Business-rule rejections from the ledger (insufficient funds, unknown card, ...)
+@app.errorhandler(ledger.LedgerError)
+def handle_ledger_error(error):
+    return jsonify({'error': error.message}), error.status
+
+# Password hashing pool is saturated; shed load instead of queueing
+@app.errorhandler(passwords.PasswordPoolBusy)
+def handle_password_pool_busy(error):
+    response = jsonify({'error': 'Sunucu şu anda yoğun, lütfen tekrar deneyin'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# The worker's ledger writer did not answer in time
+@app.errorhandler(pipeline.PipelineTimeout)
+def handle_pipeline_timeout(error):
+    response = jsonify({'error': 'Sunucu şu anda yoğun, lütfen tekrar deneyin'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
 # Error handler for better debugging
 @app.errorhandler(Exception)
@@ -579,7 +930,14 @@ def handle_error(error):
 # Initialize database on app startup (for both gunicorn and direct run)
 try:
     with app.app_context():
-        init_db()
+        migrations.migrate(get_db(), DATABASE, log=app.logger.info)
+        check_query_plans(get_db(), HOT_QUERIES)
+        if sharding.ENABLED:
+            os.makedirs(sharding.SHARD_DIR, exist_ok=True)
+            for path in sharding.database_paths():
+                migrations.migrate(get_db(path), path, log=app.logger.info)
+                check_query_plans(get_db(path), HOT_QUERIES)
+            sharding.recover(get_db(), shard_db)
         app.logger.info(f"Database initialized at {DATABASE}")
 except Exception as e:
     app.logger.error(f"Failed to initialize database: {str(e)}")
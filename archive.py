@@ -0,0 +1,255 @@
+"""Monthly archive partitions for transactions.
+
+Closed months (everything older than the newest ARCHIVE_HOT_MONTHS) are
+moved out of the main database into one SQLite file per month under
+ARCHIVE_DIR, which readers ATTACH on demand. The main database keeps a
+catalog (archive_partitions) and, per user, the months they have archived
+rows in (archive_users), so a reader only ever attaches months that can
+hold rows for the user it is serving.
+
+The archiver (``python archive.py``, e.g. from cron) is online: it walks
+the hot table in id order in small batches, each in its own short
+transaction, and sleeps between batches so request writers get the lock.
+Rows are first copied into the month file and only then deleted from the
+hot table if they are present in the copy, so a crash can leave a row in
+both places but never in neither. Readers merge and de-duplicate by id,
+which also makes a half-archived month read correctly.
+
+Reads go to the hot table first; partitions are only queried when the
+page is not already filled by rows newer than the month in question.
+"""
+import os
+import time
+
+import db
+
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR') or db.DATABASE + '-archive'
+HOT_MONTHS = int(os.environ.get('ARCHIVE_HOT_MONTHS', 3))
+BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 5000))
+BATCH_PAUSE = float(os.environ.get('ARCHIVE_BATCH_PAUSE_MS', 10)) / 1000
+
+# Archive files attached to one connection at a time (SQLite allows 10 by default)
+MAX_ATTACHED = 8
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS archive_partitions (
+        month TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        row_count INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS archive_users (
+        user_id INTEGER NOT NULL,
+        month TEXT NOT NULL,
+        PRIMARY KEY (user_id, month)
+    ) WITHOUT ROWID;
+'''
+
+_MONTHS_BEFORE = 'SELECT month FROM archive_users WHERE user_id = ? AND month <= ? ORDER BY month DESC'
+_FIRST_MONTH = 'SELECT month FROM archive_users WHERE user_id = ? ORDER BY month LIMIT 1'
+_LAST_MONTH = 'SELECT month FROM archive_users WHERE user_id = ? ORDER BY month DESC LIMIT 1'
+
+# created_at of the user's :limit-th newest hot row, i.e. where a first page ends
+PAGE_FLOOR_QUERY = '''
+    SELECT created_at FROM (
+        SELECT * FROM (
+            SELECT created_at, id FROM transactions WHERE from_user_id = :user_id
+            ORDER BY created_at DESC, id DESC LIMIT :limit
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT created_at, id FROM transactions
+            WHERE to_user_id = :user_id AND from_user_id IS NOT :user_id
+            ORDER BY created_at DESC, id DESC LIMIT :limit
+        )
+    )
+    ORDER BY created_at DESC, id DESC
+    LIMIT 1 OFFSET :limit - 1
+'''
+
+
+def _schema_name(month):
+    return 'archive_' + month.replace('-', '_')
+
+
+def _month_end(month):
+    # First timestamp of the following month
+    year, mon = int(month[:4]), int(month[5:7])
+    year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return f'{year:04d}-{mon:02d}-01 00:00:00'
+
+
+def cutoff(now=None):
+    """Rows created before this timestamp belong to closed, archivable months."""
+    now = time.gmtime(now)
+    year, mon = now.tm_year, now.tm_mon - (HOT_MONTHS - 1)
+    while mon < 1:
+        year, mon = year - 1, mon + 12
+    return f'{year:04d}-{mon:02d}-01 00:00:00'
+
+
+def on_partition(sql, schema):
+    """Point a query written against the hot table at an attached month."""
+    return sql.replace('FROM transactions', f'FROM {schema}.transactions')
+
+
+def attach(conn, month):
+    """ATTACH the month's file if it is not already, and return its schema name."""
+    schema = _schema_name(month)
+    attached = [row[1] for row in conn.execute('PRAGMA database_list')]
+    if schema in attached:
+        return schema
+    archives = [name for name in attached if name.startswith('archive_')]
+    if len(archives) >= MAX_ATTACHED and not conn.in_transaction:
+        # database_list is in attach order: let the longest-attached month go
+        conn.execute(f'DETACH DATABASE {archives[0]}')
+    conn.execute(f'ATTACH DATABASE ? AS {schema}', (os.path.join(ARCHIVE_DIR, f'transactions-{month}.db'),))
+    return schema
+
+
+def _sort_key(row):
+    return row['created_at'], row['id']
+
+
+def extend_page(conn, sql, params, rows, user_id, before_ts, limit):
+    """Merge archived rows into a newest-first page read from the hot table.
+
+    sql/params are the query that produced rows; it is re-run against each
+    archived month of the user that could still contribute to the page.
+    """
+    months = [row[0] for row in conn.execute(_MONTHS_BEFORE, (user_id, before_ts[:7]))]
+    for month in months:
+        # Every row of this month and older sorts after a page that is already full
+        if len(rows) >= limit and rows[limit - 1]['created_at'] >= _month_end(month):
+            break
+        schema = attach(conn, month)
+        archived = conn.execute(on_partition(sql, schema), params).fetchall()
+        if archived:
+            merged = {row['id']: row for row in rows}
+            merged.update((row['id'], row) for row in archived)
+            rows = sorted(merged.values(), key=_sort_key, reverse=True)[:limit]
+    return rows
+
+
+def page_is_hot(conn, user_id, limit):
+    """True when the user's newest `limit` rows all live in the hot table."""
+    month = conn.execute(_LAST_MONTH, (user_id,)).fetchone()
+    if month is None:
+        return True
+    floor = conn.execute(PAGE_FLOOR_QUERY, {'user_id': user_id, 'limit': limit}).fetchone()
+    return floor is not None and floor[0] >= _month_end(month[0])
+
+
+def first_row(conn, sql, params, user_id):
+    """Oldest of the hot table's answer to sql and the user's oldest archived month's."""
+    rows = conn.execute(sql, params).fetchall()
+    month = conn.execute(_FIRST_MONTH, (user_id,)).fetchone()
+    if month is not None:
+        rows += conn.execute(on_partition(sql, attach(conn, month[0])), params).fetchall()
+    return min(rows, key=_sort_key) if rows else None
+
+
+# --- archiver ------------------------------------------------------------------
+
+def _columns(conn):
+    return [(row[1], row[2]) for row in conn.execute('PRAGMA main.table_info(transactions)')]
+
+
+def _prepare_partition(conn, month, columns):
+    schema = attach(conn, month)
+    definitions = ', '.join('id INTEGER PRIMARY KEY' if name == 'id' else f'{name} {kind}'
+                            for name, kind in columns)
+    conn.execute(f'PRAGMA {schema}.journal_mode=WAL')
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {schema}.transactions ({definitions})')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_transactions_from_user '
+                 f'ON transactions (from_user_id, created_at)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_transactions_to_user '
+                 f'ON transactions (to_user_id, created_at)')
+    conn.execute('INSERT OR IGNORE INTO archive_partitions (month, filename) VALUES (?, ?)',
+                 (month, f'transactions-{month}.db'))
+    conn.commit()
+    return schema
+
+
+def run(conn=None, before=None, log=print):
+    """Move every hot row created before `before` (default: cutoff()) into its month file.
+
+    Returns the number of rows moved.
+    """
+    own = conn is None
+    conn = conn or db.connect()
+    before = before or cutoff()
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    columns = _columns(conn)
+    names = ', '.join(name for name, _ in columns)
+    placeholders = ', '.join('?' for _ in columns)
+    prepared = set()
+    moved = 0
+    last_id = 0
+    try:
+        while True:
+            rows = conn.execute(f'SELECT {names} FROM main.transactions WHERE id > ? ORDER BY id LIMIT ?',
+                                (last_id, BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1]['id']
+            old = [row for row in rows if row['created_at'] < before]
+            # ids follow created_at, so the first batch with nothing old ends the walk
+            if not old:
+                break
+
+            by_month = {}
+            for row in old:
+                by_month.setdefault(row['created_at'][:7], []).append(tuple(row))
+            # One month at a time, so a batch spanning more than MAX_ATTACHED months
+            # never needs a schema attach() has already let go
+            for month, batch in by_month.items():
+                if month not in prepared:
+                    _prepare_partition(conn, month, columns)
+                    prepared.add(month)
+                schema = attach(conn, month)
+
+                # Copy first; a crash here only leaves rows in both places
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.executemany(f'INSERT OR IGNORE INTO {schema}.transactions ({names}) '
+                                     f'VALUES ({placeholders})', batch)
+                    users = {(row[i], month) for row in batch for i in (1, 2) if row[i] is not None}
+                    conn.executemany('INSERT OR IGNORE INTO archive_users (user_id, month) VALUES (?, ?)', users)
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+
+                # Then delete from the hot table whatever the month file really holds
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.executemany(f'DELETE FROM main.transactions WHERE id = ? AND EXISTS '
+                                     f'(SELECT 1 FROM {schema}.transactions WHERE id = ?)',
+                                     [(row[0], row[0]) for row in batch])
+                    conn.commit()
+                except BaseException:
+                    conn.rollback()
+                    raise
+
+            moved += len(old)
+            if BATCH_PAUSE:
+                time.sleep(BATCH_PAUSE)
+
+        # Count before updating: attach() cannot let a month go inside the UPDATEs' transaction
+        counts = [(conn.execute(f'SELECT count(*) FROM {attach(conn, month)}.transactions').fetchone()[0], month)
+                  for month in sorted(prepared)]
+        conn.executemany('UPDATE archive_partitions SET row_count = ?, updated_at = CURRENT_TIMESTAMP '
+                         'WHERE month = ?', counts)
+        conn.commit()
+        # Give the space the moved rows took in the WAL back to the filesystem
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        log(f'archived {moved} rows created before {before} into {len(prepared)} month file(s)')
+        return moved
+    finally:
+        if own:
+            conn.close()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,111 @@
+"""Fingerprinted, gzip-precompressed static assets served from memory.
+
+build() reads app.js and style.css, names each after its content hash
+(app.<hash>.js, under /static/dist/), gzips it once at level 9 and
+rewrites index.html to reference the hashed names. A hashed URL never
+changes content, so it is served with an immutable Cache-Control and
+browsers do not ask again until index.html points somewhere else.
+index.html itself and the plain /static/app.js and /static/style.css
+(still requested by pages cached before fingerprinting) must revalidate,
+which the ETag turns into a bodyless 304.
+
+Every worker builds the table once at import and answers from it:
+no file system access, no compression per request. Responses are gzipped
+when Accept-Encoding allows it; the ETag differs per encoding.
+
+``python assets.py`` writes the same files (and .gz siblings plus a
+manifest.json) to static/dist/, for a proxy or CDN that serves /static/
+itself, e.g. nginx with gzip_static on.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import Response, request
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST = 'dist'
+FINGERPRINTED = ('app.js', 'style.css')
+PAGES = ('index.html',)
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+_REFERENCE = re.compile(r'/static/(' + '|'.join(map(re.escape, FINGERPRINTED)) + r')(\?[^"\']*)?')
+
+
+class Asset:
+    __slots__ = ('body', 'gzipped', 'etag', 'mimetype', 'cache_control')
+
+    def __init__(self, name, body, cache_control):
+        self.body = body
+        # mtime=0 keeps the .gz bytes identical across builds
+        self.gzipped = gzip.compress(body, 9, mtime=0)
+        self.etag = _digest(body)
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.cache_control = cache_control
+
+
+def _digest(body):
+    return hashlib.sha256(body).hexdigest()[:12]
+
+
+def _read(directory, name):
+    with open(os.path.join(directory, name), 'rb') as f:
+        return f.read()
+
+
+def build(directory=STATIC_DIR):
+    """Path under /static/ (or a page name) -> Asset, plus the name -> hashed path manifest."""
+    assets, manifest = {}, {}
+    for name in FINGERPRINTED:
+        body = _read(directory, name)
+        stem, ext = os.path.splitext(name)
+        hashed = manifest[name] = f'{DIST}/{stem}.{_digest(body)}{ext}'
+        assets[hashed] = Asset(name, body, IMMUTABLE)
+        assets[name] = Asset(name, body, REVALIDATE)
+    for name in PAGES:
+        page = _read(directory, name).decode()
+        page = _REFERENCE.sub(lambda match: f'/static/{manifest[match.group(1)]}', page)
+        assets[name] = Asset(name, page.encode(), REVALIDATE)
+    return assets, manifest
+
+
+def write(assets, manifest, directory=STATIC_DIR):
+    """Write the fingerprinted files and pages, with .gz siblings, to <directory>/dist/."""
+    os.makedirs(os.path.join(directory, DIST), exist_ok=True)
+    # Earlier fingerprints stay: pages still cached by browsers point at them
+    outputs = {path: assets[path] for path in manifest.values()}
+    outputs.update({f'{DIST}/{name}': assets[name] for name in PAGES})
+    for path, asset in outputs.items():
+        for suffix, body in (('', asset.body), ('.gz', asset.gzipped)):
+            with open(os.path.join(directory, path + suffix), 'wb') as f:
+                f.write(body)
+    with open(os.path.join(directory, DIST, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return sorted(outputs)
+
+
+def respond(asset):
+    gzipped = request.accept_encodings['gzip'] > 0
+    etag = asset.etag + '-gz' if gzipped else asset.etag
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(asset.gzipped if gzipped else asset.body, mimetype=asset.mimetype)
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = asset.cache_control
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+if __name__ == '__main__':
+    built, names = build()
+    for path in write(built, names):
+        asset = built[path] if path in built else built[os.path.basename(path)]
+        print(f'static/{path}: {len(asset.body)} bytes, {len(asset.gzipped)} gzipped')
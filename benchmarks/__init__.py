@@ -0,0 +1,5 @@
+import os
+
+# Benchmarks drive a handful of accounts from one address, which the
+# default rate limits would throttle; bench_ratelimit turns them back on
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
@@ -0,0 +1,159 @@
+"""Monthly archive: correctness against the unpartitioned table, and hot-path latency.
+
+Seeds a year of history, keeps a backup copy as the unpartitioned
+reference, then archives the original while a writer keeps posting
+transfers. Asserts that every page (at the API and export page sizes),
+the dashboard's first page and balance_at() read exactly the same from
+the archived database as from the reference, then times the hot paths on
+both.
+
+    python -m benchmarks.bench_archive [transactions] [users]
+
+The default of 10M rows takes a while to seed; pass a smaller count for a
+quick check.
+"""
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import seed as seeding
+
+USERS = 2000
+CHECKED_USERS = 40
+SAMPLES = 2000
+
+
+def timed(fn, n):
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return statistics.median(latencies) * 1000, latencies[int(n * 0.99)] * 1000
+
+
+def all_pages(app, conn, user_id, limit):
+    rows, before = [], app.FIRST_PAGE
+    while True:
+        page = app.fetch_transactions(conn.cursor(), user_id, before, limit)
+        rows += [app.transaction_to_dict(tx, user_id) for tx in page]
+        if len(page) < limit:
+            return rows
+        before = (page[-1]['created_at'], page[-1]['id'])
+
+
+def live_size(conn):
+    pages = conn.execute('PRAGMA page_count').fetchone()[0] - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return pages * conn.execute('PRAGMA page_size').fetchone()[0] / 2 ** 20
+
+
+def main():
+    transactions = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else USERS
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'bench.db')
+    reference_path = os.path.join(workdir, 'reference.db')
+    os.environ['ARCHIVE_DIR'] = os.path.join(workdir, 'archive')
+    os.environ['METRICS_ENABLED'] = '0'
+    accounts = seeding.seed(db_path, users, 1, transactions, days=365, log=lambda message: None)
+
+    import app
+    import archive
+    import db
+    import ledger
+    import statements
+
+    conn = db.connect(db_path)
+    reference = sqlite3.connect(reference_path)
+    conn.backup(reference)
+    reference.close()
+    reference = db.connect(reference_path)
+    size_before = live_size(conn)
+
+    # Archive online while another connection keeps posting transfers
+    stop = threading.Event()
+    write_latencies = []
+
+    def writer():
+        writer_conn = db.connect(db_path)
+        rng = random.Random(1)
+        while not stop.is_set():
+            sender, receiver = rng.sample(accounts, 2)
+            start = time.perf_counter()
+            ledger.post(writer_conn, ledger.transfer, sender['user_id'], receiver['email'], 100, 'archive bench')
+            write_latencies.append(time.perf_counter() - start)
+        writer_conn.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    started = time.perf_counter()
+    try:
+        moved = archive.run(conn, log=lambda message: None)
+        elapsed = time.perf_counter() - started
+    finally:
+        stop.set()
+        thread.join()
+    write_latencies.sort()
+    print(f'archived {moved} of {transactions} rows in {elapsed:.1f}s; concurrent transfers: '
+          f'{len(write_latencies)}, p99 {write_latencies[int(len(write_latencies) * 0.99)] * 1000:.2f}ms, '
+          f'max {write_latencies[-1] * 1000:.2f}ms')
+    print(f'main database live size {size_before:.0f} MiB -> {live_size(conn):.0f} MiB')
+
+    # The writer's transfers only exist in the archived copy; replay them into the reference
+    last_id = reference.execute('SELECT max(id) FROM transactions').fetchone()[0]
+    new_rows = [tuple(row) for row in conn.execute('SELECT * FROM main.transactions WHERE id > ?', (last_id,))]
+    if new_rows:
+        marks = ', '.join('?' for _ in new_rows[0])
+        reference.executemany(f'INSERT INTO transactions VALUES ({marks})', new_rows)
+        reference.executemany('UPDATE users SET balance_minor = ? WHERE id = ?',
+                              conn.execute('SELECT balance_minor, id FROM users').fetchall())
+        reference.commit()
+
+    rng = random.Random(2)
+    checked = rng.sample(accounts, min(CHECKED_USERS, len(accounts)))
+    for account in checked:
+        user_id = account['user_id']
+        for limit in (app.TRANSACTIONS_PAGE_SIZE, app.EXPORT_BATCH_SIZE):
+            assert all_pages(app, conn, user_id, limit) == all_pages(app, reference, user_id, limit), (user_id, limit)
+        for _ in range(20):
+            ts = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - rng.randrange(400 * 86400)))
+            assert statements.balance_at(conn, user_id, ts) == statements.balance_at(reference, user_id, ts), ts
+
+    client = app.app.test_client()
+    for account in checked:
+        headers = {'Authorization': 'Bearer ' + account['token']}
+        dashboard = client.get(f'/api/dashboard/{account["user_id"]}', headers=headers).get_json()
+        expected = [app.transaction_to_dict(tx, account['user_id']) for tx in app.fetch_transactions(
+            reference.cursor(), account['user_id'], app.FIRST_PAGE, app.TRANSACTIONS_PAGE_SIZE)]
+        assert dashboard['transactions'] == expected, account['user_id']
+    print(f'{len(checked)} users: every page, dashboard and balance_at match the unpartitioned table')
+
+    ids = [account['user_id'] for account in accounts]
+    deep = {}
+    for user_id in ids[:200]:
+        row = reference.execute('SELECT created_at, id FROM transactions WHERE from_user_id = ? '
+                                'ORDER BY created_at LIMIT 1 OFFSET 10', (user_id,)).fetchone()
+        deep[user_id] = (row['created_at'], row['id']) if row else app.FIRST_PAGE
+    deep_ids = list(deep)
+    month_ago = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - 30 * 86400))
+    cases = {
+        'first page': lambda c: lambda i: app.fetch_transactions(c.cursor(), ids[i % len(ids)], app.FIRST_PAGE, 50),
+        'page in an archived month': lambda c: lambda i: app.fetch_transactions(
+            c.cursor(), deep_ids[i % len(deep_ids)], deep[deep_ids[i % len(deep_ids)]], 50),
+        'balance_at last month': lambda c: lambda i: statements.balance_at(c, ids[i % len(ids)], month_ago),
+    }
+    print(f'{"":>28} {"unpartitioned p50/p99":>24} {"archived p50/p99":>22}')
+    for name, case in cases.items():
+        timed(case(reference), 200), timed(case(conn), 200)  # warm the page caches
+        ref, arch = timed(case(reference), SAMPLES), timed(case(conn), SAMPLES)
+        print(f'{name:>28} {ref[0]:>10.3f}ms {ref[1]:>9.3f}ms {arch[0]:>10.3f}ms {arch[1]:>9.3f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Payout throughput: /api/send-money/batch at 1k/10k/100k items vs one send-money call per item.
+
+    python benchmarks/bench_batch_payouts.py [sizes...]
+"""
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import sessions  # noqa: E402
+from app import app  # noqa: E402
+
+RECIPIENTS = 1000
+SEQUENTIAL_SAMPLE = 1000
+
+
+def seed():
+    conn = db.connect()
+    conn.execute("INSERT INTO users (email, password, balance_minor) VALUES ('payer@example.com', 'x', ?)",
+                 (10 ** 15,))
+    conn.executemany('INSERT INTO users (email, password) VALUES (?, ?)',
+                     [(f'payee{i}@example.com', 'x') for i in range(RECIPIENTS)])
+    conn.commit()
+    payer = conn.execute("SELECT id FROM users WHERE email = 'payer@example.com'").fetchone()[0]
+    token = sessions.create(conn, payer)
+    conn.close()
+    return payer, token
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 100000]
+    client = app.test_client()
+    payer, token = seed()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + token
+
+    start = time.perf_counter()
+    for i in range(SEQUENTIAL_SAMPLE):
+        resp = client.post('/api/send-money', json={
+            'from_user_id': payer, 'to_email': f'payee{i % RECIPIENTS}@example.com', 'amount': 1.25
+        })
+        assert resp.status_code == 200
+    rate = SEQUENTIAL_SAMPLE / (time.perf_counter() - start)
+    print(f'{"sequential send-money":>24}: {rate:10.0f} payouts/s')
+
+    for size in sizes:
+        items = [{'to_email': f'payee{i % RECIPIENTS}@example.com', 'amount': 1.25, 'description': 'payroll'}
+                 for i in range(size)]
+        start = time.perf_counter()
+        resp = client.post('/api/send-money/batch', json={'from_user_id': payer, 'items': items})
+        elapsed = time.perf_counter() - start
+        assert resp.status_code == 200, resp.get_json()
+        assert all(r['status'] == 'ok' for r in resp.get_json()['results'])
+        print(f'{f"batch of {size}":>24}: {size / elapsed:10.0f} payouts/s ({elapsed * 1000:.0f} ms)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Page load: /api/dashboard vs the old user + cards + transactions + exchange-rates calls.
+
+Runs against a single-worker gunicorn server so the numbers include real
+HTTP round trips; worker CPU comes from /proc/<pid>/stat of the workers.
+
+    python -m benchmarks.bench_dashboard [page_loads]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks import seed as seeding
+from benchmarks.loadtest import GunicornDriver
+
+USERS = 200
+TRANSACTIONS = 200000
+
+
+def worker_cpu_seconds(master_pid):
+    # utime + stime of every child of the gunicorn master
+    total = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master_pid:
+            total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def four_calls(request, account, headers):
+    user_id = account['user_id']
+    for path in (f'/api/user/{user_id}', f'/api/cards/{user_id}', f'/api/transactions/{user_id}'):
+        assert request('GET', path, None, headers)[0] == 200
+    assert request('GET', '/api/exchange-rates', None, {})[0] == 200
+
+
+def dashboard(request, account, headers):
+    assert request('GET', f'/api/dashboard/{account["user_id"]}', None, headers)[0] == 200
+
+
+def measure(driver, accounts, flow, n):
+    request = driver.connect()
+    cpu_before = worker_cpu_seconds(driver.process.pid)
+    latencies = []
+    for i in range(n):
+        account = accounts[i % len(accounts)]
+        headers = {'Authorization': 'Bearer ' + account['token']}
+        start = time.perf_counter()
+        flow(request, account, headers)
+        latencies.append(time.perf_counter() - start)
+    cpu = worker_cpu_seconds(driver.process.pid) - cpu_before
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95)], cpu / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['METRICS_DIR'] = os.path.join(os.path.dirname(db_path), 'metrics')
+    accounts = seeding.seed(db_path, USERS, 2, TRANSACTIONS, log=lambda message: None)
+
+    driver = GunicornDriver(db_path, 1)
+    try:
+        for flow in (four_calls, dashboard):
+            measure(driver, accounts, flow, 200)  # warm the worker's caches
+        results = {flow.__name__: measure(driver, accounts, flow, n) for flow in (four_calls, dashboard)}
+    finally:
+        driver.close()
+
+    for name, (p50, p95, cpu) in results.items():
+        print(f'{name:>10}: p50 {p50 * 1000:6.2f}ms  p95 {p95 * 1000:6.2f}ms  worker cpu {cpu * 1000:6.2f}ms/page')
+    old, new = results['four_calls'], results['dashboard']
+    print(f'page load {old[0] / new[0]:.1f}x faster, worker cpu {old[2] / new[2]:.1f}x lower')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Requests/sec for cheap read endpoints: pooled WAL connections vs connect-per-request.
+
+    python benchmarks/bench_db_pool.py [requests]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from app import app  # noqa: E402
+
+
+class ConnectPerRequest:
+    """The old get_db(): a fresh connection per request, closed at teardown."""
+    pid = os.getpid()
+
+    def acquire(self):
+        conn = sqlite3.connect(db.DATABASE)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def release(self, conn):
+        conn.close()
+
+
+def run(client, paths, n):
+    start = time.perf_counter()
+    for i in range(n):
+        resp = client.get(paths[i % len(paths)])
+        assert resp.status_code == 200, resp.status_code
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    client = app.test_client()
+    resp = client.post('/api/register', json={'email': 'bench@example.com', 'password': 'x'})
+    user_id = resp.get_json()['user_id']
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + resp.get_json()['token']
+    paths = [f'/api/user/{user_id}', '/api/exchange-rates']
+
+    pooled = db.get_pool()
+    results = {}
+    for name, pool in (('connect-per-request', ConnectPerRequest()), ('pooled', pooled)):
+        db._pools[db.DATABASE] = pool
+        run(client, paths, 200)  # warm up
+        results[name] = run(client, paths, n)
+        print(f'{name:>20}: {results[name]:8.0f} req/s')
+    db._pools[db.DATABASE] = pooled
+    print(f'{"speedup":>20}: {results["pooled"] / results["connect-per-request"]:8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
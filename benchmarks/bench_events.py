@@ -0,0 +1,254 @@
+"""Server-sent events: thousands of idle subscribers against polling.
+
+Starts gunicorn with gthread workers, as gunicorn.conf.py configures
+deployments, registers --users accounts and then measures:
+
+1. worker CPU while --subscribers clients poll /api/user and
+   /api/transactions every --poll-interval seconds, the way static/app.js
+   used to refresh;
+2. worker CPU, memory and threads with the same number of /api/events
+   streams open and idle instead;
+3. latency of a plain API call with no streams and with all of them open;
+4. delivery latency from posting a transfer to every open stream of the
+   receiver, asserting each of them got it exactly once.
+
+    python -m benchmarks.bench_events [--subscribers 2000] [--users 100] [--workers 2] [--duration 10]
+"""
+import argparse
+import json
+import os
+import selectors
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.loadtest import GunicornDriver
+
+TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def workers(driver):
+    pid = driver.process.pid
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        total += int(fields[11]) + int(fields[12])  # utime, stime
+    return total / TICKS
+
+
+def memory(pids):
+    rss = threads = 0
+    for pid in pids:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss += int(line.split()[1]) / 1024
+                elif line.startswith('Threads:'):
+                    threads += int(line.split()[1])
+    return rss, threads
+
+
+def register(driver, count):
+    def one(i):
+        email = f'events{i}@bench.local'
+        status, body, _ = driver.connect()('POST', '/api/register', {'email': email, 'password': 'x'}, {})
+        assert status == 201, (status, body)
+        data = json.loads(body)
+        return {'user_id': data['user_id'], 'email': email, 'token': data['token']}
+    with ThreadPoolExecutor(8) as pool:
+        return list(pool.map(one, range(count)))
+
+
+def latencies(driver, account, n=500):
+    request = driver.connect()
+    headers = {'Authorization': 'Bearer ' + account['token']}
+    samples = []
+    for _ in range(n):
+        started = time.perf_counter()
+        status, _, _ = request('GET', f'/api/user/{account["user_id"]}', None, headers)
+        samples.append((time.perf_counter() - started) * 1000)
+        assert status == 200
+    samples.sort()
+    return statistics.median(samples), samples[int(n * 0.99)]
+
+
+def poll(driver, accounts, clients, interval, duration):
+    """Requests per second actually served while clients poll like the old frontend."""
+    rate = clients * 2 / interval
+    deadline = time.monotonic() + duration
+    done = [0]
+    lock = threading.Lock()
+
+    def client(seed):
+        request = driver.connect()
+        # Each thread takes an equal share of the schedule
+        period = 8 / rate
+        next_at = time.monotonic() + seed * period / 8
+        n = seed
+        while time.monotonic() < deadline:
+            account = accounts[n % len(accounts)]
+            headers = {'Authorization': 'Bearer ' + account['token']}
+            request('GET', f'/api/user/{account["user_id"]}', None, headers)
+            request('GET', f'/api/transactions/{account["user_id"]}', None, headers)
+            with lock:
+                done[0] += 2
+            n += 8
+            next_at += period * 2
+            time.sleep(max(0, next_at - time.monotonic()))
+
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return rate, done[0] / duration
+
+
+class Streams:
+    """Many /api/events streams read by one selector thread."""
+
+    def __init__(self, driver, accounts, count):
+        self.selector = selectors.DefaultSelector()
+        self.ready = 0
+        self.received = {}  # stream index -> list of (arrival time, transaction dict)
+        self.by_user = {}
+        self._lock = threading.Lock()
+        request = driver.connect()
+        for i in range(count):
+            account = accounts[i % len(accounts)]
+            status, body, _ = request('POST', '/api/events/ticket', None, {'Authorization': 'Bearer ' + account['token']})
+            assert status == 201, (status, body)
+            sock = socket.create_connection(('127.0.0.1', driver.port))
+            # HTTP/1.0: the body streams unchunked until the server closes it
+            sock.sendall(f'GET /api/events/{account["user_id"]}?ticket={json.loads(body)["ticket"]} HTTP/1.0\r\n'
+                         f'Host: 127.0.0.1\r\n\r\n'.encode())
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, {'index': i, 'buffer': b'', 'headers': False})
+            self.received[i] = []
+            self.by_user.setdefault(account['user_id'], []).append(i)
+        self._stop = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self._stop:
+            for key, _ in self.selector.select(0.1):
+                chunk = key.fileobj.recv(65536)
+                if not chunk:
+                    self.selector.unregister(key.fileobj)
+                    continue
+                state = key.data
+                state['buffer'] += chunk
+                if not state['headers']:
+                    if b'\r\n\r\n' not in state['buffer']:
+                        continue
+                    head, state['buffer'] = state['buffer'].split(b'\r\n\r\n', 1)
+                    assert head.startswith(b'HTTP/1.1 200') or head.startswith(b'HTTP/1.0 200'), head[:100]
+                    state['headers'] = True
+                *messages, state['buffer'] = state['buffer'].split(b'\n\n')
+                for raw in messages:
+                    fields = dict(line.split(': ', 1) for line in raw.decode().split('\n') if ': ' in line)
+                    if fields.get('event') == 'ready':
+                        with self._lock:
+                            self.ready += 1
+                    elif fields.get('event') == 'transaction':
+                        self.received[state['index']].append((time.perf_counter(), json.loads(fields['data'])))
+
+    def close(self):
+        self._stop = True
+        self.thread.join()
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+
+
+def deliveries(driver, accounts, streams, n=50):
+    sender = accounts[0]
+    request = driver.connect()
+    samples = []
+    for i in range(n):
+        receiver = accounts[1 + i % (len(accounts) - 1)]
+        description = f'bench-events-{i}'
+        started = time.perf_counter()
+        status, body, _ = request('POST', '/api/send-money', {
+            'from_user_id': sender['user_id'], 'to_email': receiver['email'], 'amount': 0.01,
+            'description': description
+        }, {'Authorization': 'Bearer ' + sender['token']})
+        assert status == 200, body
+        indexes = streams.by_user[receiver['user_id']]
+        deadline = time.monotonic() + 5
+        while True:
+            arrivals = [[at for at, tx in streams.received[index] if tx['description'] == description]
+                        for index in indexes]
+            if all(arrivals) or time.monotonic() > deadline:
+                break
+            time.sleep(0.001)
+        assert all(len(times) == 1 for times in arrivals), f'{description} reached {arrivals} of {len(indexes)} streams'
+        samples.extend((times[0] - started) * 1000 for times in arrivals)
+        time.sleep(0.05)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99)], len(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--subscribers', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--poll-interval', type=float, default=5)
+    args = parser.parse_args()
+    os.environ['METRICS_ENABLED'] = '0'
+    os.environ.pop('WRITE_PIPELINE', None)
+    os.environ.pop('SHARDS', None)
+
+    threads = args.subscribers // args.workers + 200
+    driver = GunicornDriver(os.path.join(tempfile.mkdtemp(), 'bench.db'), args.workers,
+                            worker_class='gthread', threads=threads)
+    try:
+        accounts = register(driver, args.users)
+        pids = workers(driver)
+        print(f'{os.cpu_count()} cpu(s), {args.workers} gthread workers x {threads} threads, '
+              f'{args.subscribers} clients over {args.users} users')
+
+        p50, p99 = latencies(driver, accounts[0])
+        print(f'{"no streams":>22}: GET /api/user p50 {p50:6.2f} ms  p99 {p99:6.2f} ms')
+
+        before = cpu_seconds(pids)
+        rate, served = poll(driver, accounts, args.subscribers, args.poll_interval, args.duration)
+        busy = (cpu_seconds(pids) - before) / args.duration
+        print(f'{"polling":>22}: {rate:.0f} req/s asked, {served:.0f} req/s served, '
+              f'worker CPU {busy * 100:5.1f}%')
+
+        streams = Streams(driver, accounts, args.subscribers)
+        deadline = time.monotonic() + 60
+        while streams.ready < args.subscribers:
+            assert time.monotonic() < deadline, f'only {streams.ready} streams opened'
+            time.sleep(0.1)
+        before = cpu_seconds(pids)
+        time.sleep(args.duration)
+        idle = (cpu_seconds(pids) - before) / args.duration
+        rss, thread_count = memory(pids)
+        print(f'{"idle streams":>22}: {args.subscribers} open, worker CPU {idle * 100:5.1f}%, '
+              f'RSS {rss:.0f} MiB, {thread_count} threads')
+
+        p50, p99 = latencies(driver, accounts[0])
+        print(f'{"streams open":>22}: GET /api/user p50 {p50:6.2f} ms  p99 {p99:6.2f} ms')
+
+        p50, p99, count = deliveries(driver, accounts, streams)
+        print(f'{"delivery":>22}: {count} stream deliveries, post -> event p50 {p50:6.1f} ms  p99 {p99:6.1f} ms')
+        streams.close()
+    finally:
+        driver.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Postings/sec and p99 latency: commit-per-request vs the group-commit write pipeline.
+
+T threads (as in a gthread worker) post transfers between well-funded
+users. "direct" gives each thread its own connection and transaction;
+"pipeline" hands every posting to one writer that commits in batches.
+Set DB_SYNCHRONOUS=FULL to include a real fsync per commit.
+
+    python benchmarks/bench_group_commit.py [threads] [postings_per_thread]
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import ledger  # noqa: E402
+import pipeline  # noqa: E402
+from app import app  # noqa: E402,F401  (creates the schema)
+
+USERS = 200
+
+
+def seed():
+    conn = db.connect()
+    conn.executemany('INSERT INTO users (email, password, balance_minor) VALUES (?, ?, ?)',
+                     [(f'user{i}@example.com', 'x', 10 ** 12) for i in range(USERS)])
+    conn.commit()
+    conn.close()
+
+
+def run(threads, per_thread):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(seed_value):
+        rng = random.Random(seed_value)
+        conn = db.connect()
+        local = []
+        for _ in range(per_thread):
+            sender, receiver = rng.sample(range(1, USERS + 1), 2)
+            start = time.perf_counter()
+            ledger.post(conn, ledger.transfer, sender, f'user{receiver - 1}@example.com', 100, 'bench')
+            local.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    seed()
+    print(f'synchronous={db.SYNCHRONOUS} threads={threads}')
+
+    for name, writer in (('direct', None), ('pipeline', pipeline.WritePipeline())):
+        ledger.pipeline = writer
+        rate, p50, p99 = run(threads, per_thread)
+        # direct mode commits once per posting
+        per_commit = writer.commands / writer.commits if writer else 1
+        print(f'{name:>9}: {rate:8.0f} postings/s  {rate / per_commit:8.0f} commits/s  '
+              f'p50={p50 * 1000:6.2f}ms  p99={p99 * 1000:6.2f}ms')
+    ledger.pipeline = None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Idempotency keys: concurrent duplicates post once, retries are cheap.
+
+1. gunicorn (gthread) with --workers workers, once plain and once with
+   WRITE_PIPELINE=1: every round fires --duplicates copies of the same
+   /api/send-money with one Idempotency-Key at once, from separate
+   connections. Asserts all copies get the same 200 body, exactly one of
+   them is not a replay, and the ledger holds exactly one transfer per
+   round with the sender debited once.
+2. In process: the statements a retry runs, from this worker's LRU (none)
+   and from the table after the LRU is cleared (one read), and the
+   latency of a first request against a retry.
+
+    python -m benchmarks.bench_idempotency [--rounds 50] [--duplicates 16] [--workers 2]
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+
+from benchmarks.loadtest import GunicornDriver
+
+AMOUNT = 0.01
+
+
+def register(request, email):
+    status, body, _ = request('POST', '/api/register', {'email': email, 'password': 'x'}, {})
+    assert status == 201, body
+    return json.loads(body)
+
+
+def duplicates(label, rounds, copies, workers, env):
+    os.environ.update(env)
+    try:
+        db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        driver = GunicornDriver(db_path, workers, worker_class='gthread', threads=copies + 4)
+    finally:
+        for name in env:
+            del os.environ[name]
+    try:
+        request = driver.connect()
+        sender = register(request, 'sender@bench.local')
+        register(request, 'receiver@bench.local')
+        headers = {'Authorization': 'Bearer ' + sender['token']}
+        body = {'from_user_id': sender['user_id'], 'to_email': 'receiver@bench.local', 'amount': AMOUNT}
+        clients = [driver.connect() for _ in range(copies)]
+        elapsed = []
+        for _ in range(rounds):
+            key_headers = dict(headers, **{'Idempotency-Key': str(uuid.uuid4())})
+            barrier = threading.Barrier(copies)
+            responses = [None] * copies
+
+            def fire(i):
+                barrier.wait()
+                responses[i] = clients[i]('POST', '/api/send-money', body, key_headers)
+
+            threads = [threading.Thread(target=fire, args=(i,)) for i in range(copies)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed.append((time.perf_counter() - started) * 1000)
+            assert {status for status, _, _ in responses} == {200}, [r[:2] for r in responses]
+            assert len({data for _, data, _ in responses}) == 1, 'duplicates got different responses'
+            originals = [h for _, _, h in responses if 'idempotent-replayed' not in h]
+            assert len(originals) == 1, f'{len(originals)} copies were not replays'
+    finally:
+        driver.close()
+
+    conn = sqlite3.connect(db_path)
+    transfers = conn.execute("SELECT count(*) FROM transactions WHERE type = 'transfer'").fetchone()[0]
+    balance = conn.execute('SELECT balance_minor FROM users WHERE id = ?', (sender['user_id'],)).fetchone()[0]
+    keys = conn.execute('SELECT count(*) FROM idempotency_keys').fetchone()[0]
+    conn.close()
+    assert transfers == rounds and keys == rounds, (transfers, keys)
+    assert balance == 10000 - rounds * round(AMOUNT * 100), balance
+    print(f'{label:>18}: {rounds} rounds x {copies} concurrent copies -> {transfers} transfers, '
+          f'{keys} keys, sender debited {rounds} times; round p50 {statistics.median(elapsed):6.1f} ms')
+
+
+def retry_cost(n):
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    import db
+    import idempotency
+
+    # Every statement of every pooled connection, BEGIN and COMMIT included
+    executed = []
+    connect = db.connect
+
+    def traced(path=None):
+        conn = connect(path)
+        conn.set_trace_callback(executed.append)
+        return conn
+
+    db.connect = traced
+    from app import app
+
+    client = app.test_client()
+    sender = client.post('/api/register', json={'email': 'sender@bench.local', 'password': 'x'}).get_json()
+    client.post('/api/register', json={'email': 'receiver@bench.local', 'password': 'x'})
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + sender['token']
+    body = {'from_user_id': sender['user_id'], 'to_email': 'receiver@bench.local', 'amount': AMOUNT}
+
+    first, retries = [], []
+    for i in range(n):
+        key = {'Idempotency-Key': f'k{i}'}
+        started = time.perf_counter()
+        assert client.post('/api/send-money', json=body, headers=key).status_code == 200
+        first.append((time.perf_counter() - started) * 1e6)
+        started = time.perf_counter()
+        assert client.post('/api/send-money', json=body, headers=key).headers['Idempotent-Replayed'] == 'true'
+        retries.append((time.perf_counter() - started) * 1e6)
+
+    del executed[:]
+    client.post('/api/send-money', json=body, headers={'Idempotency-Key': 'k0'})
+    cached = len(executed)
+    idempotency.cache = idempotency.ResponseCache()
+    del executed[:]
+    client.post('/api/send-money', json=body, headers={'Idempotency-Key': 'k0'})
+    uncached = len(executed)
+    assert cached == 0 and uncached == 1, (cached, uncached)
+    print(f'{"retry cost":>18}: first request p50 {statistics.median(first):6.0f} us, retry p50 '
+          f'{statistics.median(retries):6.0f} us; a retry runs {cached} statements from the LRU, '
+          f'{uncached} from the table')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--duplicates', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+    os.environ['METRICS_ENABLED'] = '0'
+
+    duplicates('per request', args.rounds, args.duplicates, args.workers, {})
+    duplicates('WRITE_PIPELINE=1', args.rounds, args.duplicates, args.workers, {'WRITE_PIPELINE': '1'})
+    retry_cost(args.rounds * 10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Concurrency stress test for ledger.post().
+
+N worker processes hammer transfers between a handful of users whose
+balances are deliberately too small to cover every request. Reports
+postings/sec and checks that no balance went negative and no money was
+created or destroyed.
+
+    python benchmarks/bench_ledger_contention.py [writers] [transfers_per_writer]
+"""
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import ledger  # noqa: E402
+from app import app  # noqa: E402,F401  (creates the schema)
+
+USERS = 8
+START_BALANCE = 10000  # minor units (100.00 TL)
+
+
+def seed():
+    conn = db.connect()
+    conn.execute('DELETE FROM users')
+    conn.executemany('INSERT INTO users (email, password, balance_minor) VALUES (?, ?, ?)',
+                     [(f'user{i}@example.com', 'x', START_BALANCE) for i in range(USERS)])
+    conn.commit()
+    ids = [row['id'] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+    conn.close()
+    return ids
+
+
+def writer(ids, count, seed_value, out):
+    rng = random.Random(seed_value)
+    conn = db.connect()
+    ok = rejected = 0
+    for _ in range(count):
+        sender, receiver = rng.sample(ids, 2)
+        try:
+            ledger.post(conn, ledger.transfer, sender, f'user{ids.index(receiver)}@example.com',
+                        rng.choice((500, 2500, 6000)), 'stress')
+            ok += 1
+        except ledger.LedgerError:
+            rejected += 1
+    conn.close()
+    out.put((ok, rejected))
+
+
+def main():
+    writers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    per_writer = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    ids = seed()
+
+    out = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=writer, args=(ids, per_writer, i, out)) for i in range(writers)]
+    start = time.perf_counter()
+    for p in procs:
+        p.start()
+    results = [out.get() for _ in procs]
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - start
+
+    ok = sum(r[0] for r in results)
+    rejected = sum(r[1] for r in results)
+    conn = db.connect()
+    balances = [row['balance_minor'] for row in conn.execute('SELECT balance_minor FROM users')]
+    conn.close()
+
+    print(f'writers={writers} attempts={ok + rejected} committed={ok} rejected={rejected}')
+    print(f'throughput: {(ok + rejected) / elapsed:.0f} postings/s ({elapsed:.2f}s)')
+    print(f'min balance: {min(balances)}  total: {sum(balances)} (expected {USERS * START_BALANCE})')
+    assert min(balances) >= 0, 'overdraft detected'
+    assert sum(balances) == USERS * START_BALANCE, 'money was created or destroyed'
+    print('OK: zero overdrafts')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Login p99 vs everything-else p99 under a mixed load, with and without the bounded KDF pool.
+
+Login threads hammer /api/login while reader threads poll /api/user/<id>.
+"unbounded" lets every login hash at once; "bounded" uses the default
+KDF_WORKERS / KDF_MAX_PENDING and sheds the excess with 503.
+
+    python benchmarks/bench_login_mixed.py [seconds] [login_threads] [reader_threads]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import passwords  # noqa: E402
+from app import app  # noqa: E402
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(seconds, login_threads, reader_threads, user_id, token):
+    stop = time.perf_counter() + seconds
+    samples = {'login': [], 'read': [], 'shed': 0}
+    lock = threading.Lock()
+
+    def loop(kind):
+        client = app.test_client()
+        client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + token
+        local = []
+        shed = 0
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            if kind == 'login':
+                resp = client.post('/api/login', json={'email': 'bench@example.com', 'password': 'secret'})
+            else:
+                resp = client.get(f'/api/user/{user_id}')
+            if resp.status_code == 503:
+                shed += 1
+                continue
+            local.append(time.perf_counter() - start)
+        with lock:
+            samples[kind].extend(local)
+            samples['shed'] += shed
+
+    threads = [threading.Thread(target=loop, args=('login',)) for _ in range(login_threads)]
+    threads += [threading.Thread(target=loop, args=('read',)) for _ in range(reader_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples
+
+
+def configure(workers, pending):
+    passwords.KDF_WORKERS = workers
+    passwords.KDF_MAX_PENDING = pending
+    passwords._pid = None  # rebuild the pool with the new limits
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    login_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    reader_threads = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    client = app.test_client()
+    account = client.post('/api/register', json={'email': 'bench@example.com', 'password': 'secret'}).get_json()
+    user_id, token = account['user_id'], account['token']
+
+    defaults = (passwords.KDF_WORKERS, passwords.KDF_MAX_PENDING)
+    for name, (workers, pending) in (('unbounded', (login_threads, login_threads)), ('bounded', defaults)):
+        configure(workers, pending)
+        s = run(seconds, login_threads, reader_threads, user_id, token)
+        print(f'{name:>10}: login p50={percentile(s["login"], 50) * 1000:7.1f}ms p99={percentile(s["login"], 99) * 1000:7.1f}ms '
+              f'ok={len(s["login"])} shed={s["shed"]} | '
+              f'read p50={percentile(s["read"], 50) * 1000:6.2f}ms p99={percentile(s["read"], 99) * 1000:6.2f}ms '
+              f'n={len(s["read"])}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Cost of leaving metrics on: requests/sec with METRICS_ENABLED=0 vs 1.
+
+Each mode runs in a fresh interpreter because the instrumentation is
+wired up at import time.
+
+    python benchmarks/bench_metrics_overhead.py [requests]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def child(n):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import app
+
+    client = app.test_client()
+    account = client.post('/api/register', json={'email': 'bench@example.com', 'password': 'x'}).get_json()
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + account['token']
+    paths = [f'/api/user/{account["user_id"]}', f'/api/cards/{account["user_id"]}',
+             f'/api/transactions/{account["user_id"]}']
+    for i in range(200):
+        client.get(paths[i % len(paths)])
+    start = time.perf_counter()
+    for i in range(n):
+        client.get(paths[i % len(paths)])
+    print(n / (time.perf_counter() - start))
+
+
+def main():
+    n = sys.argv[1] if len(sys.argv) > 1 else '5000'
+    results = {}
+    for enabled in ('0', '1'):
+        env = dict(os.environ, METRICS_ENABLED=enabled,
+                   DATABASE_PATH=os.path.join(tempfile.mkdtemp(), 'bench.db'),
+                   METRICS_DIR=tempfile.mkdtemp())
+        out = subprocess.run([sys.executable, __file__, '--child', n], env=env,
+                             capture_output=True, text=True, check=True).stdout
+        results[enabled] = float(out.strip().splitlines()[-1])
+        print(f'metrics {"on " if enabled == "1" else "off"}: {results[enabled]:8.0f} req/s')
+    print(f'overhead: {(1 - results["1"] / results["0"]) * 100:.1f}%')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        child(int(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,258 @@
+"""Migrations: writer stalls, crash/resume, one migrator per database, fast path.
+
+Builds a database in the original schema (REAL money columns, no running
+balances or rollups) and migrates it with migrations.py:
+
+1. in a separate process while a writer keeps committing small
+   transactions, once batched and once as a single transaction per step,
+   reporting the longest the writer waited for the lock;
+2. killed part-way through a batched step, then resumed, asserting only
+   the remaining steps ran and the result is the same as an uninterrupted
+   migration;
+3. from several processes at once, asserting exactly one applied the steps;
+4. again on the current database, asserting that costs one statement.
+
+Every migrated database is checked against the legacy values.
+
+    python -m benchmarks.bench_migrations [transactions] [users]
+"""
+import os
+import random
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ['METRICS_ENABLED'] = '0'
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+import money  # noqa: E402
+import statements  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROCESSES = 4
+CURRENCIES = ['TL'] * 6 + ['USD', 'EUR', 'JPY', 'KRW']
+TYPES = ['transfer', 'deposit', 'conversion', 'card_transfer']
+
+MIGRATE = ('import sys, db, migrations; '
+           'print(migrations.migrate(db.connect(sys.argv[1]), sys.argv[1], log=lambda message: None))')
+
+LEGACY_SCHEMA = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        balance REAL DEFAULT 0.0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE cards (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        card_number TEXT NOT NULL,
+        card_holder TEXT NOT NULL,
+        card_type TEXT NOT NULL,
+        expiry TEXT NOT NULL,
+        cvv TEXT NOT NULL,
+        balance_usd REAL DEFAULT 200000.0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_user_id INTEGER,
+        to_user_id INTEGER,
+        from_card_id INTEGER,
+        to_card_id INTEGER,
+        amount REAL NOT NULL,
+        currency TEXT DEFAULT 'TL',
+        type TEXT NOT NULL,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE exchange_rates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        currency_code TEXT UNIQUE NOT NULL,
+        rate_to_usd REAL NOT NULL,
+        currency_name TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE bench_writes (id INTEGER PRIMARY KEY, written_at REAL);
+'''
+
+
+def build_legacy(path, transactions, users):
+    """Original-schema database; returns the minor-unit values it should migrate to."""
+    rng = random.Random(7)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(LEGACY_SCHEMA)
+    balances = [round(rng.uniform(0, 5000), 2) for _ in range(users)]
+    conn.executemany('INSERT INTO users (email, password, balance) VALUES (?, ?, ?)',
+                     [(f'legacy{i}@bench.local', 'x', balance) for i, balance in enumerate(balances)])
+    card_balances = [round(rng.uniform(0, 200000), 2) for _ in range(users)]
+    conn.executemany("INSERT INTO cards (user_id, card_number, card_holder, card_type, expiry, cvv, balance_usd) "
+                     "VALUES (?, '4111111111111111', 'Bench', 'Visa', '12/30', '123', ?)",
+                     [(i + 1, balance) for i, balance in enumerate(card_balances)])
+
+    amounts = []
+    start = time.time() - 365 * 86400
+
+    def rows():
+        for i in range(transactions):
+            currency = rng.choice(CURRENCIES)
+            digits = money.exponent(currency)
+            amount = round(rng.uniform(1, 1000), digits)
+            amounts.append(round(amount * 10 ** digits))
+            sender, receiver = rng.randrange(1, users + 1), rng.randrange(1, users + 1)
+            created = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start + i * 365 * 86400 / transactions))
+            yield sender, receiver, amount, currency, rng.choice(TYPES), created
+
+    conn.executemany('INSERT INTO transactions (from_user_id, to_user_id, amount, currency, type, created_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', rows())
+    conn.execute('CREATE INDEX idx_transactions_from_user ON transactions (from_user_id, created_at)')
+    conn.execute('CREATE INDEX idx_transactions_to_user ON transactions (to_user_id, created_at)')
+    conn.commit()
+    conn.close()
+    return {
+        'users': [round(balance * 100) for balance in balances],
+        'cards': [round(balance * 100) for balance in card_balances],
+        'transactions': amounts,
+    }
+
+
+def check(path, expected):
+    conn = db.connect(path)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(migrations.MIGRATIONS)
+    assert conn.execute('SELECT count(*) FROM migration_progress').fetchone()[0] == 0
+    for table, column in (('users', 'balance_minor'), ('cards', 'balance_usd_minor'),
+                          ('transactions', 'amount_minor')):
+        values = [row[0] for row in conn.execute(f'SELECT {column} FROM {table} ORDER BY id')]
+        assert values == expected[table], f'{table}.{column} differs from the legacy values'
+    assert not {'balance', 'balance_usd', 'amount'} & ({row[1] for row in conn.execute('PRAGMA table_info(users)')}
+                                                      | {row[1] for row in conn.execute('PRAGMA table_info(cards)')}
+                                                      | {row[1] for row in conn.execute('PRAGMA table_info(transactions)')})
+
+    # Every user's latest row carries their balance
+    for user_id, balance in conn.execute('SELECT id, balance_minor FROM users ORDER BY id LIMIT 200').fetchall():
+        latest = conn.execute(statements.BALANCE_AT_QUERY, {'user_id': user_id, 'ts': '9999'}).fetchone()
+        assert latest is None or latest['balance'] == balance, f'user {user_id} is not anchored'
+
+    # Batched rollups equal a rebuild in one statement
+    rollups = conn.execute('SELECT * FROM daily_rollups ORDER BY user_id, day, currency').fetchall()
+    conn.execute('BEGIN')
+    statements.rebuild_rollups(conn)
+    rebuilt = conn.execute('SELECT * FROM daily_rollups ORDER BY user_id, day, currency').fetchall()
+    conn.rollback()
+    assert [tuple(row) for row in rollups] == [tuple(row) for row in rebuilt], 'daily_rollups differ'
+    conn.close()
+
+
+def start_migration(path, env=None):
+    return subprocess.Popen([sys.executable, '-c', MIGRATE, path], cwd=ROOT, stdout=subprocess.PIPE, text=True,
+                            env={**os.environ, **(env or {})})
+
+
+def writer_waits(path, process):
+    """Lock waits (ms) of a writer committing small transactions until process exits."""
+    conn = sqlite3.connect(path, isolation_level=None, timeout=60)
+    waits = []
+    while process.poll() is None:
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        waits.append((time.perf_counter() - started) * 1000)
+        conn.execute('INSERT INTO bench_writes (written_at) VALUES (?)', (time.time(),))
+        conn.execute('COMMIT')
+        time.sleep(0.002)
+    conn.close()
+    return waits
+
+
+def lock_waits(workdir, transactions, users, label, env):
+    path = os.path.join(workdir, f'{label}.db')
+    expected = build_legacy(path, transactions, users)
+    started = time.perf_counter()
+    process = start_migration(path, env)
+    waits = writer_waits(path, process)
+    elapsed = time.perf_counter() - started
+    assert process.wait() == 0
+    check(path, expected)
+    waits.sort()
+    print(f'{label:>18}: migrated in {elapsed:6.2f}s, writer committed {len(waits):6d} times, '
+          f'lock wait p50 {statistics.median(waits):7.2f} ms  p99 {waits[int(len(waits) * 0.99)]:8.2f} ms  '
+          f'max {waits[-1]:8.2f} ms')
+
+
+def kill_and_resume(workdir, transactions, users):
+    path = os.path.join(workdir, 'resume.db')
+    expected = build_legacy(path, transactions, users)
+    process = start_migration(path, {'MIGRATION_BATCH_SIZE': str(max(transactions // 50, 1))})
+    conn = sqlite3.connect(path, timeout=60)
+    progress = None
+    while progress is None:
+        assert process.poll() is None, 'migration finished before it could be interrupted'
+        try:
+            progress = conn.execute('SELECT name, position, last FROM migration_progress '
+                                    'WHERE position > 0').fetchone()
+        except sqlite3.OperationalError:  # migration_progress not created yet
+            pass
+        time.sleep(0.005)
+    process.send_signal(signal.SIGKILL)
+    process.wait()
+    killed_at = (conn.execute('PRAGMA user_version').fetchone()[0],
+                 conn.execute('SELECT name, position, last FROM migration_progress').fetchall())
+    conn.close()
+
+    conn = db.connect(path)
+    applied = migrations.migrate(conn, path, log=lambda message: None)
+    conn.close()
+    check(path, expected)
+    version, pending = killed_at
+    print(f'{"kill and resume":>18}: killed at version {version} with {pending}, '
+          f'resumed and applied the remaining {applied} step(s); result matches')
+    assert applied == len(migrations.MIGRATIONS) - version
+
+
+def concurrent(workdir, transactions, users):
+    path = os.path.join(workdir, 'concurrent.db')
+    expected = build_legacy(path, transactions, users)
+    processes = [start_migration(path) for _ in range(PROCESSES)]
+    applied = [int(process.communicate()[0]) for process in processes]
+    assert all(process.returncode == 0 for process in processes)
+    assert sorted(applied) == [0] * (PROCESSES - 1) + [len(migrations.MIGRATIONS)], applied
+    check(path, expected)
+    print(f'{"concurrent":>18}: {PROCESSES} processes, steps applied per process {applied}')
+    return path
+
+
+def fast_path(path):
+    conn = db.connect(path)
+    executed = []
+    conn.set_trace_callback(executed.append)
+    started = time.perf_counter()
+    for _ in range(1000):
+        migrations.migrate(conn, path)
+    elapsed = (time.perf_counter() - started) / 1000 * 1e6
+    conn.set_trace_callback(None)
+    conn.close()
+    assert executed == ['PRAGMA user_version'] * 1000, executed[:5]
+    print(f'{"up to date":>18}: one statement ({executed[0]}), {elapsed:.1f} us per call')
+
+
+def main():
+    transactions = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    workdir = tempfile.mkdtemp()
+    print(f'{transactions} legacy transactions, {users} users, batch size {migrations.BATCH_SIZE}')
+
+    lock_waits(workdir, transactions, users, 'single transaction', {'MIGRATION_BATCH_SIZE': str(2 ** 62)})
+    lock_waits(workdir, transactions, users, 'batched', {})
+    kill_and_resume(workdir, transactions, users)
+    fast_path(concurrent(workdir, transactions, users))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Pricing N conversions: one /api/quote call vs N sequential /api/convert-currency calls.
+
+    python benchmarks/bench_quote.py [n]
+"""
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    client = app.test_client()
+    account = client.post('/api/register', json={'email': 'bench@example.com', 'password': 'x'}).get_json()
+    user_id = account['user_id']
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Bearer ' + account['token']
+    card_id = client.post('/api/cards', json={
+        'user_id': user_id, 'card_number': '4111111111111111', 'card_holder': 'Bench',
+        'card_type': 'Visa', 'expiry': '12/30', 'cvv': '123'
+    }).get_json()['card_id']
+
+    codes = sorted(client.get('/api/exchange-rates').get_json())
+    targets = [c for c in codes if c != 'USD']
+    triples = [{'from': 'USD', 'to': targets[i % len(targets)], 'amount': 1 + i % 97} for i in range(n)]
+
+    start = time.perf_counter()
+    for t in triples:
+        resp = client.post('/api/convert-currency', json={
+            'user_id': user_id, 'card_id': card_id,
+            'from_currency': t['from'], 'to_currency': t['to'], 'amount': t['amount']
+        })
+        assert resp.status_code == 200, resp.get_json()
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    resp = client.post('/api/quote', json={'quotes': triples})
+    assert resp.status_code == 200 and len(resp.get_json()['quotes']) == n
+    batched = time.perf_counter() - start
+
+    print(f'{n} sequential convert-currency calls: {sequential * 1000:8.1f} ms')
+    print(f'1 quote call with {n} triples:        {batched * 1000:8.1f} ms')
+    print(f'speedup: {sequential / batched:.0f}x')
+
+
+if __name__ == '__main__':
+    main()
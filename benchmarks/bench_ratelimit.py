@@ -0,0 +1,224 @@
+"""Rate limits: cost of a check, exactness across workers, protection under a flood.
+
+1. microseconds per rule check in one process, through SharedTable and
+   through ratelimit.check() in a request context, and asserting that
+   rejected logins run no SQL;
+2. --processes forked processes charging the same token bucket at once,
+   asserting exactly its limit got through in total;
+3. gunicorn (gthread) with an attacker flooding /api/login with wrong
+   passwords and /api/send-money from one address at a fixed
+   --flood-rate, while a client on
+   another address reads its balance and sends money; run with limits
+   off and on, reporting the client's latency and how much of the flood
+   reached the app.
+
+    python -m benchmarks.bench_ratelimit [--checks 100000] [--processes 4] [--duration 10] [--flood-rate 300]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from benchmarks.loadtest import GunicornDriver
+
+ATTACKER_IP = '203.0.113.7'
+CLIENT_IP = '198.51.100.20'
+# The client reads every 100ms and sends money on every SEND_EVERY-th read
+SEND_EVERY = 40
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return statistics.median(samples), samples[int(len(samples) * 0.99)]
+
+
+def check_cost(checks):
+    import db
+    import ratelimit
+
+    # Every statement of every pooled connection
+    executed = []
+    connect = db.connect
+
+    def traced(path=None):
+        conn = connect(path)
+        conn.set_trace_callback(executed.append)
+        return conn
+
+    db.connect = traced
+    from app import app
+
+    shared = ratelimit.table()
+    rule = ratelimit.TokenBucket('ip', 10 ** 9, 1)
+    started = time.perf_counter()
+    for i in range(checks):
+        shared.update(i % 1000 + 1, lambda state, now: rule.charge(state, now, 1), time.time())
+    table_us = (time.perf_counter() - started) / checks * 1e6
+
+    def login_checks(rules):
+        saved, ratelimit.RULES['login'] = ratelimit.RULES['login'], rules
+        try:
+            with app.test_request_context('/api/login', method='POST',
+                                          json={'email': 'a@bench.local', 'password': 'x'},
+                                          environ_base={'REMOTE_ADDR': '10.9.9.9'}):
+                started = time.perf_counter()
+                for _ in range(checks // 10):
+                    ratelimit.check(('ip', 'email'))
+                return (time.perf_counter() - started) / (checks // 10) * 1e6
+        finally:
+            ratelimit.RULES['login'] = saved
+
+    # Both rules pass every time, then the first one turns every call away
+    passed_us = login_checks([ratelimit.TokenBucket('ip', 10 ** 9, 1), ratelimit.TokenBucket('email', 10 ** 9, 1)])
+    rejected_us = login_checks([ratelimit.TokenBucket('ip', 1, 3600), ratelimit.TokenBucket('email', 1, 3600)])
+
+    # Past the email bucket a login is answered without a single statement
+    client = app.test_client()
+    for _ in range(20):
+        client.post('/api/login', json={'email': 'flood@bench.local', 'password': 'x'},
+                    environ_base={'REMOTE_ADDR': '10.9.9.10'})
+    del executed[:]
+    codes = {client.post('/api/login', json={'email': 'flood@bench.local', 'password': 'x'},
+                         environ_base={'REMOTE_ADDR': '10.9.9.10'}).status_code for _ in range(100)}
+    statements = len(executed)
+    assert codes == {429} and statements == 0, (codes, statements)
+    print(f'{"check cost":>18}: {table_us:5.2f} us per shared-table update; login (2 rules) '
+          f'{passed_us:5.2f} us passed, {rejected_us:5.2f} us rejected with its 429; '
+          f'100 rejected logins ran {statements} statements')
+
+
+def _charge(limit, attempts, results):
+    import ratelimit
+    # Refills too slowly to add a token during the run
+    rule = ratelimit.TokenBucket('ip', limit, 10 ** 9)
+    shared = ratelimit.table()
+    accepted = 0
+    started = time.perf_counter()
+    for _ in range(attempts):
+        if shared.update(42, lambda state, now: rule.charge(state, now, 1), time.time()) is None:
+            accepted += 1
+    results.put((accepted, time.perf_counter() - started))
+
+
+def cross_process(processes, attempts):
+    limit = attempts
+    results = multiprocessing.get_context('fork').Queue()
+    workers = [multiprocessing.get_context('fork').Process(target=_charge, args=(limit, attempts, results))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    accepted = [outcome[0] for outcome in outcomes]
+    rate = processes * attempts / max(outcome[1] for outcome in outcomes)
+    assert sum(accepted) == limit, f'{sum(accepted)} got through a bucket of {limit}'
+    print(f'{"across processes":>18}: {processes} processes x {attempts} attempts on one bucket of {limit}: '
+          f'{sum(accepted)} accepted ({accepted}), {rate:,.0f} checks/s in total')
+
+
+def flood(enabled, duration, flooders, rate, workers):
+    os.environ['RATE_LIMIT_ENABLED'] = '1' if enabled else '0'
+    os.environ['RATE_LIMIT_FILE'] = os.path.join(tempfile.mkdtemp(), 'ratelimit')
+    driver = GunicornDriver(os.path.join(tempfile.mkdtemp(), 'bench.db'), workers,
+                            worker_class='gthread', threads=flooders + 8)
+    try:
+        request = driver.connect()
+        accounts = {}
+        for name, ip in (('attacker', ATTACKER_IP), ('client', CLIENT_IP), ('receiver', '192.0.2.1')):
+            status, body, _ = request('POST', '/api/register', {'email': f'{name}@bench.local', 'password': 'x'},
+                                      {'X-Forwarded-For': ip})
+            assert status == 201, body
+            accounts[name] = json.loads(body)
+
+        deadline = time.monotonic() + duration
+        flood_codes = {}
+        lock = threading.Lock()
+
+        def attacker(i):
+            request = driver.connect()
+            headers = {'X-Forwarded-For': ATTACKER_IP, 'Authorization': 'Bearer ' + accounts['attacker']['token']}
+            codes = {}
+            period = flooders / rate
+            next_at = time.monotonic() + i * period / flooders
+            while time.monotonic() < deadline:
+                time.sleep(max(0, next_at - time.monotonic()))
+                next_at += period
+                if i % 2:
+                    status, _, _ = request('POST', '/api/login', {'email': 'client@bench.local', 'password': 'guess'},
+                                           headers)
+                else:
+                    status, _, _ = request('POST', '/api/send-money', {
+                        'from_user_id': accounts['attacker']['user_id'], 'to_email': 'receiver@bench.local',
+                        'amount': 0.01}, headers)
+                codes[status] = codes.get(status, 0) + 1
+            with lock:
+                for status, count in codes.items():
+                    flood_codes[status] = flood_codes.get(status, 0) + count
+
+        threads = [threading.Thread(target=attacker, args=(i,)) for i in range(flooders)]
+        for thread in threads:
+            thread.start()
+        headers = {'X-Forwarded-For': CLIENT_IP, 'Authorization': 'Bearer ' + accounts['client']['token']}
+        reads, sends, failed = [], [], 0
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            status, _, _ = request('GET', f'/api/user/{accounts["client"]["user_id"]}', None, headers)
+            reads.append((time.perf_counter() - started) * 1000)
+            # Within 'user transfers 20/60' (see main)
+            if len(reads) % SEND_EVERY == 1:
+                started = time.perf_counter()
+                status, _, _ = request('POST', '/api/send-money', {
+                    'from_user_id': accounts['client']['user_id'], 'to_email': 'receiver@bench.local',
+                    'amount': 0.01}, headers)
+                sends.append((time.perf_counter() - started) * 1000)
+                failed += status != 200
+            time.sleep(0.1)
+        for thread in threads:
+            thread.join()
+    finally:
+        driver.close()
+
+    total = sum(flood_codes.values())
+    rejected = flood_codes.get(429, 0)
+    label = 'limits on' if enabled else 'limits off'
+    print(f'{label:>18}: flood {total / duration:6.0f} of {rate:.0f} req/s sent, {rejected / max(total, 1) * 100:5.1f}% rejected with 429, '
+          f'{(total - rejected) / duration:6.1f} req/s reached the app')
+    print(f'{"":>18}  client read p50 {percentiles(reads)[0]:7.2f} ms  p99 {percentiles(reads)[1]:7.2f} ms, '
+          f'send p50 {percentiles(sends)[0]:7.2f} ms  p99 {percentiles(sends)[1]:7.2f} ms, '
+          f'{failed} of {len(sends)} sends failed')
+    if enabled:
+        assert failed == 0, 'the rate limits turned away the well-behaved client'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--checks', type=int, default=100000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--flooders', type=int, default=8)
+    parser.add_argument('--flood-rate', type=float, default=300, help='attacker requests/s offered')
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'bench.db')
+    os.environ['RATE_LIMIT_FILE'] = os.path.join(workdir, 'ratelimit')
+    os.environ['RATE_LIMIT_ENABLED'] = '1'
+    os.environ['METRICS_DIR'] = os.path.join(workdir, 'metrics')
+    os.environ['TRUSTED_PROXIES'] = '1'
+    # Velocity windows are opt-in; turn on the single-transfer ones
+    os.environ['RATE_LIMITS'] = json.dumps({
+        'send_money': ['ip 120/60', 'user 30/60', 'user transfers 20/60', 'user amount 50000/3600']})
+
+    check_cost(args.checks)
+    cross_process(args.processes, args.checks // args.processes)
+    for enabled in (False, True):
+        flood(enabled, args.duration, args.flooders, args.flood_rate, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""Finance reports: customer latency with reports on the live tables and on snapshots.
+
+Seeds --transactions rows and starts gunicorn (gthread). The first report
+request builds the first snapshot in the background; its totals are
+checked against the live tables. Then four phases of --duration seconds
+run. In each, --customers clients together request --rate first pages of
+/api/transactions per second for random accounts, and one client posts
+--writes transfers per second:
+
+1. no reports;
+2. live reports: --analysts connections run the finance GROUP BYs
+   (volume per day, currency and type, per card type, cards per type)
+   directly against the live database, as before reports.py;
+3. snapshot reports: --analysts clients read every /api/reports/* route
+   from the snapshot;
+4. snapshot refresh: as 3, while ``python reports.py`` rebuilds the
+   snapshot back to back, the way cron would every REPORTS_MAX_AGE.
+
+Analysts wait --think seconds between two reports. Per phase it prints
+get_transactions p50/p99, the report queries answered, and the most WAL
+frames a checkpoint could not copy back because a reader still needed
+them (sampled with PASSIVE checkpoints).
+
+Asserts that p50 and p99 in phase 3 stay within --tolerance of phase 1,
+that phase 4 keeps p50 within it too and holds checkpoints back less
+than live reports, and that phase 4 served more than one snapshot. A
+rebuild's full-priority copy does show in phase 4's p99; in production
+it happens once per REPORTS_MAX_AGE, not back to back.
+
+    python -m benchmarks.bench_reports [--transactions 500000] [--duration 10] [--rate 100] [--analysts 1] [--think 0.1]
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import seed as seeding
+from benchmarks.loadtest import GunicornDriver, percentile
+
+VIEWER = 'user0@bench.local'
+
+# What the finance team ran against the live tables
+LIVE_REPORTS = (
+    'SELECT substr(created_at, 1, 10), currency, type, count(*), sum(amount_minor) FROM transactions '
+    'GROUP BY 1, 2, 3',
+    'SELECT c.card_type, t.currency, count(*), sum(t.amount_minor) FROM transactions t '
+    'JOIN cards c ON c.id = t.from_card_id GROUP BY 1, 2',
+    'SELECT c.card_type, t.currency, count(*), sum(t.amount_minor) FROM transactions t '
+    'JOIN cards c ON c.id = t.to_card_id GROUP BY 1, 2',
+    'SELECT card_type, count(*), sum(balance_usd_minor) FROM cards GROUP BY card_type',
+)
+REPORT_ROUTES = ('currencies', 'types', 'card-types', 'cards', 'daily')
+
+
+class Phase:
+    def __init__(self, driver, db_path, accounts, args):
+        self.driver = driver
+        self.db_path = db_path
+        self.accounts = accounts
+        self.args = args
+        self.stop = threading.Event()
+        self.latencies = []
+        self.reports = []
+        self.snapshots = set()
+        self.rebuilds = 0
+        self.wal_backlog = 0
+
+    def customer(self, seed):
+        rng = random.Random(seed)
+        request = self.driver.connect()
+        interval = self.args.customers / self.args.rate
+        due = time.perf_counter() + rng.random() * interval
+        while not self.stop.wait(max(due - time.perf_counter(), 0)):
+            account = rng.choice(self.accounts)
+            started = time.perf_counter()
+            status, body, _ = request('GET', f'/api/transactions/{account["user_id"]}', None,
+                                      {'Authorization': 'Bearer ' + account['token']})
+            self.latencies.append(time.perf_counter() - started)
+            assert status == 200, body
+            due += interval
+
+    def writer(self):
+        rng = random.Random(1)
+        request = self.driver.connect()
+        interval = 1 / self.args.writes
+        due = time.perf_counter()
+        while not self.stop.wait(max(due - time.perf_counter(), 0)):
+            sender, receiver = rng.sample(self.accounts, 2)
+            status, body, _ = request('POST', '/api/send-money', {
+                'from_user_id': sender['user_id'], 'to_email': receiver['email'], 'amount': 1
+            }, {'Authorization': 'Bearer ' + sender['token']})
+            assert status == 200, body
+            due += interval
+
+    def live_analyst(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            while not self.stop.is_set():
+                for sql in LIVE_REPORTS:
+                    started = time.perf_counter()
+                    conn.execute(sql).fetchall()
+                    self.reports.append(time.perf_counter() - started)
+                    self.stop.wait(self.args.think)
+        finally:
+            conn.close()
+
+    def snapshot_analyst(self):
+        request = self.driver.connect()
+        headers = {'Authorization': 'Bearer ' + self.accounts[0]['token']}
+        while not self.stop.is_set():
+            for name in REPORT_ROUTES:
+                started = time.perf_counter()
+                status, body, _ = request('GET', f'/api/reports/{name}', None, headers)
+                self.reports.append(time.perf_counter() - started)
+                assert status == 200, body
+                self.snapshots.add(json.loads(body)['snapshot_at'])
+                self.stop.wait(self.args.think)
+
+    def refresher(self):
+        env = dict(os.environ, DATABASE_PATH=self.db_path)
+        while not self.stop.is_set():
+            subprocess.run([sys.executable, 'reports.py'], cwd=seeding.ROOT, env=env, check=True,
+                           stdout=subprocess.DEVNULL)
+            self.rebuilds += 1
+
+    def sampler(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            while not self.stop.wait(0.1):
+                _, frames, copied = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+                self.wal_backlog = max(self.wal_backlog, frames - copied)
+        finally:
+            conn.close()
+
+    def run(self, *extra):
+        targets = [self.writer, self.sampler, *extra]
+        threads = [threading.Thread(target=self.customer, args=(i,)) for i in range(self.args.customers)]
+        threads += [threading.Thread(target=target) for target in targets]
+        for thread in threads:
+            thread.start()
+        time.sleep(self.args.duration)
+        self.stop.set()
+        for thread in threads:
+            thread.join()
+        latencies = sorted(self.latencies)
+        return percentile(latencies, 50), percentile(latencies, 99), self.wal_backlog
+
+
+def first_snapshot(driver, db_path, accounts):
+    # The first report request starts the first build; wait for it before any writes
+    request = driver.connect()
+    headers = {'Authorization': 'Bearer ' + accounts[0]['token']}
+    started = time.perf_counter()
+    while (response := request('GET', '/api/reports/currencies', None, headers))[0] == 503:
+        time.sleep(0.1)
+    assert response[0] == 200, response
+    report = json.loads(response[1])
+    conn = sqlite3.connect(db_path)
+    live = dict(conn.execute("SELECT coalesce(currency, 'TL'), count(*) FROM transactions GROUP BY 1"))
+    conn.close()
+    assert {row['currency']: row['transactions'] for row in report['rows']} == live, (report, live)
+    print(f'{"first snapshot":>18}: {sum(live.values())} transactions in {time.perf_counter() - started:.2f}s, '
+          f'totals match the live tables')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--transactions', type=int, default=500000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--customers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=100, help='get_transactions requests per second')
+    parser.add_argument('--writes', type=float, default=20, help='transfers per second')
+    parser.add_argument('--analysts', type=int, default=1)
+    parser.add_argument('--think', type=float, default=0.1, help='seconds an analyst waits between reports')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    accounts = seeding.seed(db_path, users=args.users, transactions=args.transactions, log=lambda *a: None)
+    # Rebuilds only when phase 4 runs them
+    os.environ.update({'METRICS_ENABLED': '0', 'REPORT_VIEWERS': VIEWER, 'REPORTS_MAX_AGE': str(24 * 3600)})
+    driver = GunicornDriver(db_path, args.workers, worker_class='gthread', threads=args.customers + args.analysts + 8)
+    results = {}
+    try:
+        first_snapshot(driver, db_path, accounts)
+        for label, extra in (('no reports', ()),
+                             ('live reports', ('live_analyst',) * args.analysts),
+                             ('snapshot reports', ('snapshot_analyst',) * args.analysts),
+                             ('snapshot refresh', ('snapshot_analyst',) * args.analysts + ('refresher',))):
+            phase = Phase(driver, db_path, accounts, args)
+            p50, p99, backlog = results[label] = phase.run(*(getattr(phase, name) for name in extra))
+            answered = sorted(phase.reports)
+            line = (f'{label:>18}: get_transactions p50 {p50:5.1f} ms, p99 {p99:5.1f} ms; '
+                    f'WAL backlog {backlog:4d} frames')
+            if answered:
+                line += f'; {len(answered)} reports, p50 {percentile(answered, 50):6.1f} ms'
+            if phase.rebuilds:
+                line += f' from {len(phase.snapshots)} snapshots, {phase.rebuilds} rebuilds'
+            print(line)
+    finally:
+        driver.close()
+
+    base = results['no reports']
+
+    def within(label, index, name):
+        before, after = base[index], results[label][index]
+        assert after <= before * (1 + args.tolerance) + 1, f'{label}: {name} {before} -> {after} ms'
+
+    within('snapshot reports', 0, 'p50')
+    within('snapshot reports', 1, 'p99')
+    within('snapshot refresh', 0, 'p50')
+    assert results['snapshot refresh'][2] < results['live reports'][2], 'rebuilds held checkpoints back longer'
+    assert len(phase.snapshots) > 1, 'no rebuilt snapshot was served during the refresh phase'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Per-request cost of token authorization.
+
+Times sessions.lookup() on the cached path (the normal case) and the
+uncached path (first request on a worker / after CACHE_TTL), single- and
+multi-threaded, and fails if the cached check exceeds BUDGET_US.
+
+    python benchmarks/bench_session_auth.py [lookups] [threads]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import sessions  # noqa: E402
+from app import app  # noqa: E402,F401  (creates the schema)
+
+BUDGET_US = 20
+TOKENS = 1000
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    conn = db.connect()
+    conn.execute("INSERT INTO users (email, password) VALUES ('bench@example.com', 'x')")
+    conn.commit()
+    tokens = [sessions.create(conn, 1) for _ in range(TOKENS)]
+
+    start = time.perf_counter()
+    for i in range(n):
+        sessions.lookup(conn, tokens[i % TOKENS])
+    cached_us = (time.perf_counter() - start) / n * 1e6
+
+    sessions.cache = sessions.TokenCache(ttl=0)  # every lookup goes to SQLite
+    start = time.perf_counter()
+    for i in range(n // 10):
+        sessions.lookup(conn, tokens[i % TOKENS])
+    uncached_us = (time.perf_counter() - start) / (n // 10) * 1e6
+    sessions.cache = sessions.TokenCache()
+
+    for t in tokens:
+        sessions.lookup(conn, t)
+
+    def worker():
+        for i in range(n // threads):
+            sessions.lookup(conn, tokens[i % TOKENS])
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    threaded_us = (time.perf_counter() - start) / (n // threads * threads) * 1e6
+
+    print(f'cached lookup:            {cached_us:6.2f} us')
+    print(f'cached lookup, {threads} threads: {threaded_us:6.2f} us (wall time per lookup)')
+    print(f'uncached lookup (SQLite): {uncached_us:6.2f} us')
+    assert cached_us < BUDGET_US, f'cached auth check {cached_us:.2f}us exceeds {BUDGET_US}us budget'
+    print(f'OK: within {BUDGET_US} us budget')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""Write throughput vs. shard count.
+
+Each configuration starts a fresh gunicorn over a new data directory,
+registers the accounts through the API, then has client threads post
+/api/send-money between random users for a fixed time. Commits are
+fsync'd (DB_SYNCHRONOUS=FULL unless set otherwise), so every transfer
+waits on its database's write lock; that is the ceiling sharding lifts.
+Afterwards the databases are read directly to check that no money was
+created or lost, counting credits still queued in outboxes.
+
+Then, with 2 shards, the receiver's shard is held locked while a
+cross-shard transfer is posted, so its credit is deferred to the outbox;
+asserts the running workers deliver it once the lock is gone, without a
+restart.
+
+    python -m benchmarks.bench_sharding [--shards 0,1,2,4] [--workers 8] [--clients 16] [--duration 10]
+
+Shard count 0 is the plain single-database mode.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.loadtest import GunicornDriver
+
+BONUS_MINOR = 10000  # the 100 TL welcome bonus
+
+
+def register(driver, count):
+    def one(i):
+        email = f'shard{i}@bench.local'
+        status, body, _ = driver.connect()('POST', '/api/register', {'email': email, 'password': 'x'}, {})
+        assert status == 201, (status, body)
+        data = json.loads(body)
+        return {'user_id': data['user_id'], 'email': email, 'token': data['token']}
+    with ThreadPoolExecutor(8) as pool:
+        return list(pool.map(one, range(count)))
+
+
+def hammer(driver, accounts, clients, duration):
+    counts = {'ok': 0, 'failed': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(seed):
+        request = driver.connect()
+        rng = random.Random(seed)
+        ok = failed = 0
+        while time.monotonic() < deadline:
+            sender, receiver = rng.sample(accounts, 2)
+            status, _, _ = request('POST', '/api/send-money', {
+                'from_user_id': sender['user_id'], 'to_email': receiver['email'], 'amount': 0.01
+            }, {'Authorization': 'Bearer ' + sender['token']})
+            if status == 200:
+                ok += 1
+            else:
+                failed += 1
+        with lock:
+            counts['ok'] += ok
+            counts['failed'] += failed
+
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def money_in_system(paths):
+    total = 0
+    for path in paths:
+        conn = sqlite3.connect(path)
+        total += conn.execute("SELECT coalesce(sum(balance_minor), 0) FROM users WHERE password != ''").fetchone()[0]
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'outbox'").fetchone():
+            total += conn.execute('SELECT coalesce(sum(amount_minor), 0) FROM outbox').fetchone()[0]
+        conn.close()
+    return total
+
+
+def run(shards, args):
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'bench.db')
+    os.environ['SHARDS'] = str(shards)
+    os.environ['SHARD_DIR'] = os.path.join(workdir, 'shards')
+    driver = GunicornDriver(db_path, args.workers)
+    try:
+        accounts = register(driver, args.users)
+        hammer(driver, accounts, args.clients, 1)  # warm the workers
+        counts = hammer(driver, accounts, args.clients, args.duration)
+    finally:
+        driver.close()
+
+    paths = ([os.path.join(workdir, 'shards', f'shard-{n}.db') for n in range(shards)] if shards else [db_path])
+    assert money_in_system(paths) == BONUS_MINOR * len(accounts), 'money was created or lost'
+    return counts['ok'] / args.duration, counts['failed']
+
+
+def deferred(args):
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'bench.db')
+    os.environ.update({'SHARDS': '2', 'SHARD_DIR': os.path.join(workdir, 'shards'),
+                       'DB_BUSY_TIMEOUT_MS': '50', 'OUTBOX_RETRY_SECONDS': '1'})
+    driver = GunicornDriver(db_path, args.workers)
+    try:
+        accounts = register(driver, 20)
+        directory = sqlite3.connect(db_path)
+        shards = dict(directory.execute('SELECT user_id, shard FROM accounts'))
+        directory.close()
+        sender = accounts[0]
+        receiver = next(account for account in accounts if shards[account['user_id']] != shards[sender['user_id']])
+        receiver_shard = os.path.join(workdir, 'shards', f'shard-{shards[receiver["user_id"]]}.db')
+        sender_shard = sqlite3.connect(os.path.join(workdir, 'shards', f'shard-{shards[sender["user_id"]]}.db'))
+
+        def received():
+            conn = sqlite3.connect(receiver_shard)
+            balance = conn.execute('SELECT balance_minor FROM users WHERE id = ?', (receiver['user_id'],)).fetchone()[0]
+            conn.close()
+            return balance
+
+        locker = sqlite3.connect(receiver_shard, isolation_level=None)
+        locker.execute('BEGIN IMMEDIATE')
+        try:
+            status, body, _ = driver.connect()('POST', '/api/send-money', {
+                'from_user_id': sender['user_id'], 'to_email': receiver['email'], 'amount': 1
+            }, {'Authorization': 'Bearer ' + sender['token']})
+            assert status == 200, (status, body)
+            queued = sender_shard.execute('SELECT count(*) FROM outbox').fetchone()[0]
+            assert queued == 1, 'the credit was not deferred'
+        finally:
+            locker.execute('ROLLBACK')
+            locker.close()
+
+        released = time.monotonic()
+        while received() == BONUS_MINOR and time.monotonic() - released < 30:
+            time.sleep(0.1)
+        waited = time.monotonic() - released
+        assert received() == BONUS_MINOR + 100, 'the deferred credit was not delivered without a restart'
+        assert sender_shard.execute('SELECT count(*) FROM outbox').fetchone()[0] == 0
+        sender_shard.close()
+    finally:
+        driver.close()
+        for name in ('DB_BUSY_TIMEOUT_MS', 'OUTBOX_RETRY_SECONDS'):
+            os.environ.pop(name)
+    print(f'{"deferred":>12}: credit delivered {waited:.1f}s after the receiver\'s shard was unlocked, no restart')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--shards', default='0,1,2,4')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+    os.environ.setdefault('DB_SYNCHRONOUS', 'FULL')
+    os.environ['METRICS_ENABLED'] = '0'
+    os.environ.pop('WRITE_PIPELINE', None)
+
+    print(f'{os.cpu_count()} cpu(s), {args.workers} workers, {args.clients} clients, '
+          f'synchronous={os.environ["DB_SYNCHRONOUS"]}')
+    baseline = None
+    for shards in (int(n) for n in args.shards.split(',')):
+        rate, failed = run(shards, args)
+        baseline = baseline or rate
+        label = f'{shards} shards' if shards else 'unsharded'
+        print(f'{label:>12}: {rate:8.0f} transfers/s  ({rate / baseline:4.2f}x, {failed} failed, money conserved)')
+    deferred(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""/api/balance-at and /api/statement latency as history grows.
+
+Each size is seeded into a fresh database (in its own interpreter, since
+the app binds its database at import) with a fixed number of users, so
+per-user history grows with it. The answers come from an index seek and
+the rollups, so latency should stay flat; a replay of the user's history
+(what answering without balance_after would take) is timed alongside.
+
+    python -m benchmarks.bench_statements [sizes...]
+"""
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+USERS = 20
+QUERIES = 300
+
+REPLAY_QUERY = '''
+    SELECT SUM(CASE WHEN to_user_id = :user_id THEN amount_minor ELSE -amount_minor END)
+    FROM transactions
+    WHERE (from_user_id = :user_id OR to_user_id = :user_id) AND currency = 'TL' AND created_at <= :ts
+'''
+
+
+def child(size):
+    from benchmarks import seed as seeding
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['METRICS_ENABLED'] = '0'
+    accounts = seeding.seed(db_path, USERS, 2, size, log=lambda message: None)
+    from app import app
+    import db
+
+    client = app.test_client()
+    rng = random.Random(0)
+    today = datetime.utcnow().date()
+
+    def timed(path_for):
+        latencies = []
+        for _ in range(QUERIES):
+            account = rng.choice(accounts)
+            path = path_for(account)
+            start = time.perf_counter()
+            response = client.get(path, headers={'Authorization': 'Bearer ' + account['token']})
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.get_json()
+        return sorted(latencies)[len(latencies) // 2] * 1000
+
+    def random_ts():
+        return (datetime.utcnow() - timedelta(seconds=rng.randrange(365 * 86400))).strftime('%Y-%m-%dT%H:%M:%S')
+
+    balance_at = timed(lambda a: f'/api/balance-at/{a["user_id"]}?ts={random_ts()}')
+    statement = timed(lambda a: f'/api/statement/{a["user_id"]}?from={today - timedelta(days=30)}&to={today}')
+
+    conn = db.connect()
+    latencies = []
+    for _ in range(20):
+        start = time.perf_counter()
+        conn.execute(REPLAY_QUERY, {'user_id': rng.choice(accounts)['user_id'], 'ts': random_ts()}).fetchone()
+        latencies.append(time.perf_counter() - start)
+    replay = sorted(latencies)[len(latencies) // 2] * 1000
+    print(json.dumps({'balance_at': balance_at, 'statement': statement, 'replay': replay}))
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    print(f'{"transactions":>12} {"per user":>9} {"balance-at p50":>15} {"statement p50":>14} {"replay p50":>11}')
+    for size in sizes:
+        out = subprocess.run([sys.executable, '-m', 'benchmarks.bench_statements', '--child', str(size)],
+                             cwd=root, capture_output=True, text=True, check=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        print(f'{size:>12} {size * 2 // USERS:>9} {result["balance_at"]:>13.3f}ms {result["statement"]:>12.3f}ms '
+              f'{result["replay"]:>9.3f}ms')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        child(int(sys.argv[2]))
+    else:
+        main()
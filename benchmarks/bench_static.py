@@ -0,0 +1,126 @@
+"""Static assets: bytes and worker time per page load, before and after fingerprinting.
+
+"before" is the previous setup rebuilt on a bare Flask app: Flask's
+static view and send_from_directory() reading index.html, app.js and
+style.css from disk for every request, uncompressed, revalidated with
+Last-Modified/ETag. "after" is app.py as it is now.
+
+Each setup is driven through a browser model over the test client:
+
+* first visit: empty cache, GET / and every asset the page references;
+* repeat visit: the browser's cache from the first visit; entries marked
+  immutable are used without a request, the rest are revalidated.
+
+Bytes count the status line, headers and body of every response. Worker
+time is CPU time in this process per page load.
+
+    python -m benchmarks.bench_static [page_loads]
+"""
+import os
+import re
+import sys
+import tempfile
+import time
+
+from flask import Flask, send_from_directory
+
+import assets
+
+ACCEPT = {'Accept-Encoding': 'gzip, deflate, br'}
+
+
+def legacy_app():
+    legacy = Flask('legacy', static_folder=assets.STATIC_DIR)
+
+    @legacy.route('/')
+    def index():
+        return send_from_directory(assets.STATIC_DIR, 'index.html')
+
+    return legacy
+
+
+def response_bytes(response):
+    head = f'HTTP/1.1 {response.status}\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in response.headers.items())
+    return len(head) + 2 + len(response.data)
+
+
+class Browser:
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.cache = {}  # url -> (validators, immutable)
+
+    def get(self, url):
+        cached = self.cache.get(url)
+        if cached and cached[1]:
+            return 0, 0
+        headers = dict(ACCEPT)
+        if cached:
+            headers.update(cached[0])
+        response = self.client.get(url, headers=headers)
+        assert response.status_code in (200, 304), (url, response.status_code)
+        validators = {}
+        if response.headers.get('ETag'):
+            validators['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+        if response.status_code == 200:
+            self.cache[url] = (validators, 'immutable' in response.headers.get('Cache-Control', ''))
+        return 1, response_bytes(response)
+
+
+def page_urls(app):
+    body = app.test_client().get('/').get_data(as_text=True)
+    return ['/'] + re.findall(r'(?:src|href)="(/static/[^"]+)"', body)
+
+
+def measure(app, loads):
+    urls = page_urls(app)
+    browser = Browser(app)
+
+    def visit():
+        requests = transferred = 0
+        for url in urls:
+            made, sent = browser.get(url)
+            requests += made
+            transferred += sent
+        return requests, transferred
+
+    first = visit()
+    repeat = visit()
+
+    # CPU per page load: a fresh browser for first visits, the warm one for repeats
+    started = time.process_time()
+    for _ in range(loads):
+        browser.cache.clear()
+        visit()
+    first_cpu = (time.process_time() - started) / loads * 1e6
+    visit()
+    started = time.process_time()
+    for _ in range(loads):
+        visit()
+    repeat_cpu = (time.process_time() - started) / loads * 1e6
+    return urls, first, repeat, first_cpu, repeat_cpu
+
+
+def main():
+    loads = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    os.environ['METRICS_ENABLED'] = '0'
+    from app import app
+
+    results = {}
+    for label, flask_app in (('before', legacy_app()), ('after', app)):
+        urls, first, repeat, first_cpu, repeat_cpu = results[label] = measure(flask_app, loads)
+        print(f'{label}: {", ".join(urls)}')
+        print(f'{"first visit":>16}: {first[0]} requests, {first[1]:7d} bytes, {first_cpu:7.0f} us worker CPU')
+        print(f'{"repeat visit":>16}: {repeat[0]} requests, {repeat[1]:7d} bytes, {repeat_cpu:7.0f} us worker CPU')
+
+    before, after = results['before'], results['after']
+    assert after[1][1] < before[1][1] / 3, 'gzip should cut first-visit bytes by more than 3x'
+    assert after[2][0] == 1, 'a repeat visit should only revalidate the page'
+    print(f'first visit {before[1][1] / after[1][1]:.1f}x fewer bytes; repeat visit {before[2][0]} -> '
+          f'{after[2][0]} requests, {before[4] / after[4]:.1f}x less worker CPU')
+
+
+if __name__ == '__main__':
+    main()
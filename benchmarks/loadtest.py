@@ -0,0 +1,480 @@
+"""Load test every /api route and report throughput, latency and SQL counts as JSON.
+
+    python -m benchmarks.loadtest --driver testclient --mix dashboard --duration 10
+    python -m benchmarks.loadtest --driver gunicorn --workers 4 --mix payout --out run.json
+    python -m benchmarks.loadtest --mix mixed --baseline baseline.json --tolerance 0.15
+
+The database is seeded with benchmarks.seed (reused if --db already has
+an accounts file). The testclient driver runs the app in-process; the
+gunicorn driver starts a real multi-process server on a free port and
+talks HTTP to it. Per-query counts are the difference between two
+/metrics scrapes, so they cover every worker.
+
+With --baseline, the run is compared against an earlier report and the
+exit status is 1 if throughput dropped, p95/p99 grew or queries per
+request grew by more than --tolerance.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from benchmarks import seed as seeding
+
+ROOT = seeding.ROOT
+CURRENCIES = ('USD', 'EUR', 'GBP', 'JPY', 'TRY', 'CHF')
+BATCH_SIZE = 20
+
+
+# --- scenario operations -----------------------------------------------------
+# Each op gets the per-thread Session and issues one or more requests
+# through session.send(route, method, path, body, token).
+
+def op_login(s):
+    s.send('/api/login', 'POST', '/api/login', {'email': s.account['email'], 'password': s.account['password']})
+
+
+def op_logout(s):
+    status, body, _ = s.send('/api/login', 'POST', '/api/login',
+                             {'email': s.account['email'], 'password': s.account['password']})
+    if status == 200:
+        s.send('/api/logout', 'POST', '/api/logout', token=json.loads(body)['token'])
+
+
+def op_register(s):
+    s.send('/api/register', 'POST', '/api/register',
+           {'email': f'load-{os.getpid()}-{s.name}-{s.next_id()}@bench.local', 'password': 'bench-password'})
+
+
+def op_user(s):
+    s.send('/api/user/<int:user_id>', 'GET', f'/api/user/{s.account["user_id"]}')
+
+
+def op_cards(s):
+    s.send('/api/cards/<int:user_id>', 'GET', f'/api/cards/{s.account["user_id"]}')
+
+
+def op_dashboard(s):
+    s.send('/api/dashboard/<int:user_id>', 'GET', f'/api/dashboard/{s.account["user_id"]}')
+
+
+def op_add_card(s):
+    s.send('/api/cards', 'POST', '/api/cards', {
+        'user_id': s.account['user_id'], 'card_number': f'5{s.rng.randrange(10 ** 15):015d}',
+        'card_holder': 'Load Test', 'card_type': s.rng.choice(('Visa', 'Mastercard', 'Troy')),
+        'expiry': '12/30', 'cvv': '123'})
+
+
+def op_add_balance(s):
+    s.send('/api/add-balance', 'POST', '/api/add-balance', {
+        'user_id': s.account['user_id'], 'card_id': s.rng.choice(s.account['card_ids']), 'amount': 1})
+
+
+def op_send_money(s):
+    s.send('/api/send-money', 'POST', '/api/send-money', {
+        'from_user_id': s.account['user_id'], 'to_email': s.other()['email'],
+        'amount': s.rng.randrange(1, 500) / 100, 'description': 'load test'})
+
+
+def op_send_batch(s):
+    s.send('/api/send-money/batch', 'POST', '/api/send-money/batch', {
+        'from_user_id': s.account['user_id'],
+        'items': [{'to_email': s.other()['email'], 'amount': s.rng.randrange(1, 500) / 100,
+                   'description': 'payout'} for _ in range(BATCH_SIZE)]})
+
+
+def op_exchange_rates(s):
+    # Browsers revalidate with the ETag they already hold
+    headers = {'If-None-Match': s.rates_etag} if s.rates_etag else {}
+    _, _, response_headers = s.send('/api/exchange-rates', 'GET', '/api/exchange-rates', headers=headers)
+    s.rates_etag = response_headers.get('etag') or s.rates_etag
+
+
+def op_quote(s):
+    s.send('/api/quote', 'POST', '/api/quote', {'from': s.rng.choice(CURRENCIES), 'to': 'all', 'amount': 100})
+
+
+def op_convert(s):
+    source, target = s.rng.sample(CURRENCIES, 2)
+    s.send('/api/convert-currency', 'POST', '/api/convert-currency', {
+        'user_id': s.account['user_id'], 'card_id': s.rng.choice(s.account['card_ids']),
+        'from_currency': source, 'to_currency': target, 'amount': 1})
+
+
+def op_card_transfer(s):
+    cards = s.account['card_ids']
+    if len(cards) < 2:
+        return op_add_balance(s)
+    source, target = s.rng.sample(cards, 2)
+    s.send('/api/transfer-between-cards', 'POST', '/api/transfer-between-cards', {
+        'user_id': s.account['user_id'], 'from_card_id': source, 'to_card_id': target, 'amount': 1})
+
+
+def op_transactions(s):
+    s.send('/api/transactions/<int:user_id>', 'GET', f'/api/transactions/{s.account["user_id"]}')
+
+
+def op_transactions_pages(s):
+    # First page, then follow the keyset cursor twice, like scrolling the history
+    path = f'/api/transactions/{s.account["user_id"]}'
+    next_cursor = ''
+    for _ in range(3):
+        _, _, headers = s.send('/api/transactions/<int:user_id>', 'GET',
+                               path + (f'?cursor={next_cursor}' if next_cursor else ''))
+        next_cursor = headers.get('x-next-cursor')
+        if not next_cursor:
+            break
+
+
+def op_export(s):
+    s.send('/api/transactions/<int:user_id>/export', 'GET',
+           f'/api/transactions/{s.account["user_id"]}/export?format={s.rng.choice(("ndjson", "csv"))}')
+
+
+MIXES = {
+    # Logged-in users looking at their account
+    'dashboard': {
+        op_dashboard: 20, op_user: 20, op_cards: 15, op_transactions: 20, op_transactions_pages: 5,
+        op_exchange_rates: 10, op_quote: 6, op_login: 2, op_logout: 1, op_export: 1,
+    },
+    # Money moving: single sends, bulk payouts, card top-ups
+    'payout': {
+        op_send_money: 40, op_send_batch: 10, op_add_balance: 15, op_convert: 10, op_card_transfer: 10,
+        op_user: 10, op_transactions: 5,
+    },
+    # Every route
+    'mixed': {
+        op_dashboard: 10, op_user: 10, op_cards: 8, op_transactions: 12, op_transactions_pages: 3, op_export: 1,
+        op_exchange_rates: 10, op_quote: 5, op_send_money: 15, op_send_batch: 2, op_add_balance: 6,
+        op_convert: 5, op_card_transfer: 5, op_add_card: 1, op_login: 3, op_logout: 2, op_register: 2,
+    },
+}
+
+
+# --- drivers -----------------------------------------------------------------
+
+class TestClientDriver:
+    def __init__(self, db_path, workers):
+        os.environ['DATABASE_PATH'] = db_path
+        from app import app
+        self.app = app
+
+    def connect(self):
+        client = self.app.test_client()
+
+        def request(method, path, body, headers):
+            response = client.open(path, method=method, json=body, headers=headers)
+            data = response.get_data()
+            return response.status_code, data, {k.lower(): v for k, v in response.headers.items()}
+        return request
+
+    def close(self):
+        pass
+
+
+class GunicornDriver:
+    # Sync workers unless asked otherwise, so runs stay comparable to the
+    # ones from before gunicorn.conf.py switched deployments to gthread
+    def __init__(self, db_path, workers, worker_class='sync', threads=1):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{self.port}',
+             '--worker-class', worker_class, '--threads', str(threads), '--worker-connections', str(threads + 100),
+             '--log-level', 'warning', 'app:app'],
+            cwd=ROOT, env=dict(os.environ, DATABASE_PATH=db_path))
+        request = self.connect()
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                if request('GET', '/api/exchange-rates', None, {})[0] == 200:
+                    break
+            except OSError:
+                pass
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                self.close()
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.1)
+
+    def connect(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+
+        def request(method, path, body, headers):
+            payload = None
+            if body is not None:
+                payload = json.dumps(body).encode()
+                headers = dict(headers, **{'Content-Type': 'application/json'})
+            try:
+                conn.request(method, path, payload, headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                # Sync workers close the socket after each response; reconnect once
+                conn.close()
+                conn.request(method, path, payload, headers)
+                response = conn.getresponse()
+            data = response.read()
+            return response.status, data, {k.lower(): v for k, v in response.getheaders()}
+        return request
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+DRIVERS = {'testclient': TestClientDriver, 'gunicorn': GunicornDriver}
+
+
+# --- running -----------------------------------------------------------------
+
+class Session:
+    def __init__(self, name, request, accounts, rng):
+        self.name = name
+        self.request = request
+        self.accounts = accounts
+        self.rng = rng
+        self.account = None
+        self.rates_etag = None
+        self.recording = False
+        self.latencies = {}   # route -> [seconds]
+        self.statuses = {}    # route -> Counter
+        self.failures = 0
+        self._ids = 0
+
+    def next_id(self):
+        self._ids += 1
+        return self._ids
+
+    def other(self):
+        while True:
+            account = self.rng.choice(self.accounts)
+            if account is not self.account:
+                return account
+
+    def send(self, route, method, path, body=None, token=None, headers=None):
+        headers = dict(headers or {})
+        token = token or (self.account['token'] if route not in ('/api/login', '/api/register') else None)
+        if token:
+            headers['Authorization'] = 'Bearer ' + token
+        start = time.perf_counter()
+        try:
+            status, data, response_headers = self.request(method, path, body, headers)
+        except Exception:
+            status, data, response_headers = 'exception', b'', {}
+        elapsed = time.perf_counter() - start
+        if self.recording:
+            self.latencies.setdefault(route, []).append(elapsed)
+            self.statuses.setdefault(route, Counter())[status] += 1
+            if status == 'exception' or status >= 500:
+                self.failures += 1
+        return status, data, response_headers
+
+
+def run_phase(sessions, mix, seconds):
+    ops, weights = zip(*mix.items())
+    deadline = time.monotonic() + seconds
+
+    def loop(session):
+        while time.monotonic() < deadline:
+            session.account = session.rng.choice(session.accounts)
+            session.rng.choices(ops, weights)[0](session)
+
+    threads = [threading.Thread(target=loop, args=(s,)) for s in sessions]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+_QUERY_LINE = re.compile(r'^sqlite_query_calls_total\{query="(.*)"\} (\S+)$')
+
+
+def scrape_query_calls(driver, settle=0):
+    # Each worker only writes its snapshot when it serves a request (at most
+    # once a second) or a scrape; a burst of concurrent scrapes makes every
+    # worker flush before the one that is actually read
+    if settle:
+        threads = [threading.Thread(target=driver.connect(), args=('GET', '/metrics', None, {}))
+                   for _ in range(settle)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    status, body, _ = driver.connect()('GET', '/metrics', None, {})
+    if status != 200:
+        return None
+    calls = {}
+    for line in body.decode().splitlines():
+        match = _QUERY_LINE.match(line)
+        if match:
+            sql = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), match.group(1))
+            calls[sql] = int(float(match.group(2)))
+    return calls
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return round(sorted_values[index] * 1000, 3)
+
+
+def summarize(latencies, seconds):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / seconds, 1),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+
+def build_report(config, sessions, seconds, before, after):
+    routes = {}
+    all_latencies = []
+    for route in sorted({r for s in sessions for r in s.latencies}):
+        latencies = [x for s in sessions for x in s.latencies.get(route, ())]
+        statuses = Counter()
+        for s in sessions:
+            statuses.update(s.statuses.get(route, {}))
+        routes[route] = dict(summarize(latencies, seconds), statuses={str(k): v for k, v in sorted(statuses.items(),
+                                                                                                 key=str)})
+        all_latencies += latencies
+
+    overall = summarize(all_latencies, seconds)
+    overall['failures'] = sum(s.failures for s in sessions)
+    report = {'config': config, 'overall': overall, 'routes': routes}
+
+    if before is not None and after is not None:
+        diff = {sql: calls - before.get(sql, 0) for sql, calls in after.items()}
+        diff = {sql: calls for sql, calls in diff.items() if calls > 0}
+        total = sum(diff.values())
+        report['queries'] = {
+            'total': total,
+            'per_request': round(total / overall['requests'], 2) if overall['requests'] else None,
+            'by_query': dict(sorted(diff.items(), key=lambda item: -item[1])),
+        }
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """Human-readable regressions of report against baseline."""
+    regressions = []
+
+    def check(name, current, previous):
+        if not current or not previous:
+            return
+        if current.get('rps') and previous.get('rps') and current['rps'] < previous['rps'] * (1 - tolerance):
+            regressions.append(f'{name}: rps {previous["rps"]} -> {current["rps"]}')
+        for key in ('p95_ms', 'p99_ms'):
+            if current.get(key) and previous.get(key) and current[key] > previous[key] * (1 + tolerance):
+                regressions.append(f'{name}: {key} {previous[key]} -> {current[key]}')
+
+    check('overall', report['overall'], baseline.get('overall'))
+    for route, stats in report['routes'].items():
+        check(route, stats, baseline.get('routes', {}).get(route))
+
+    current = report.get('queries', {}).get('per_request')
+    previous = baseline.get('queries', {}).get('per_request')
+    if current and previous and current > previous * (1 + tolerance):
+        regressions.append(f'queries per request {previous} -> {current}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--driver', choices=sorted(DRIVERS), default='testclient')
+    parser.add_argument('--mix', choices=sorted(MIXES), default='mixed')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--db', help='database to use; seeded if it has no accounts file')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--cards-per-user', type=int, default=2)
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='earlier report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='paypal_mvp_load_')
+    db_path = os.path.abspath(args.db) if args.db else os.path.join(workdir, 'bench.db')
+    # A private metrics dir so the scrapes only see this run's workers
+    os.environ['METRICS_DIR'] = os.path.join(workdir, 'metrics')
+    os.environ['METRICS_ENABLED'] = '1'
+
+    log = lambda message: print(message, file=sys.stderr)  # noqa: E731
+    if os.path.exists(db_path + '.accounts.json'):
+        with open(db_path + '.accounts.json') as f:
+            accounts = json.load(f)
+    else:
+        accounts = seeding.seed(db_path, args.users, args.cards_per_user, args.transactions,
+                                rng_seed=args.seed, log=log)
+
+    driver = DRIVERS[args.driver](db_path, args.workers)
+    try:
+        sessions = [Session(f't{i}', driver.connect(), accounts, random.Random(args.seed * 1000 + i))
+                    for i in range(args.concurrency)]
+        mix = MIXES[args.mix]
+        if args.warmup > 0:
+            log(f'warming up for {args.warmup}s')
+            run_phase(sessions, mix, args.warmup)
+
+        settle = args.workers * 8 if args.driver == 'gunicorn' else 0
+        before = scrape_query_calls(driver, settle)
+        for s in sessions:
+            s.recording = True
+        log(f'running {args.mix} mix on {args.driver} for {args.duration}s with {args.concurrency} clients')
+        started = time.perf_counter()
+        run_phase(sessions, mix, args.duration)
+        elapsed = time.perf_counter() - started
+        after = scrape_query_calls(driver, settle)
+    finally:
+        driver.close()
+
+    config = {
+        'driver': args.driver, 'mix': args.mix, 'duration': round(elapsed, 2), 'concurrency': args.concurrency,
+        'workers': args.workers if args.driver == 'gunicorn' else 1, 'users': len(accounts),
+        'python': sys.version.split()[0], 'sqlite': sqlite3.sqlite_version,
+    }
+    report = build_report(config, sessions, elapsed, before, after)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    overall = report['overall']
+    log(f'{overall["requests"]} requests, {overall["rps"]} req/s, p50 {overall["p50_ms"]}ms '
+        f'p95 {overall["p95_ms"]}ms p99 {overall["p99_ms"]}ms, {overall["failures"]} failures')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            log('REGRESSION ' + line)
+        if regressions:
+            return 1
+        log(f'no regressions against {args.baseline} (tolerance {args.tolerance:.0%})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
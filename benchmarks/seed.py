@@ -0,0 +1,148 @@
+"""Build a benchmark database of a given size.
+
+    python -m benchmarks.seed bench.db --users 1000 --cards-per-user 2 --transactions 1000000
+
+Rows are written oldest first with consistent running balances and daily
+rollups, as the ledger would have left them. Writes the database plus
+``<db>.accounts.json`` with every seeded user's id, email, card ids and a
+ready-to-use session token, which the load test reads so it never has to
+log in just to get started.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = 'bench-password'
+CARD_TYPES = ('Visa', 'Mastercard', 'Troy')
+CURRENCIES = ('USD', 'EUR', 'GBP', 'JPY', 'TRY')
+BATCH = 50000
+START_BALANCE = 10 ** 12
+
+
+def _load_app(path):
+    # app reads DATABASE_PATH at import time and creates the schema
+    os.environ['DATABASE_PATH'] = path
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app  # noqa: F401
+    import db
+    import passwords
+    import sessions
+    import statements
+    return db, passwords, sessions, statements
+
+
+def _transactions(rng, user_ids, cards_by_user, balances, count, days):
+    # Rows come out oldest first, carrying each party's running TL balance
+    now = datetime.utcnow()
+    for offset in sorted((rng.randrange(days * 86400) for _ in range(count)), reverse=True):
+        created_at = (now - timedelta(seconds=offset)).strftime('%Y-%m-%d %H:%M:%S')
+        kind = rng.random()
+        user = rng.choice(user_ids)
+        if kind < 0.6:
+            other = rng.choice(user_ids)
+            while other == user:
+                other = rng.choice(user_ids)
+            amount = rng.randrange(100, 50000)
+            balances[user] -= amount
+            balances[other] += amount
+            yield (user, other, None, None, amount, 'TL', 'transfer', 'seed', created_at,
+                   balances[user], balances[other])
+        elif kind < 0.8:
+            amount = rng.randrange(1000, 100000)
+            balances[user] += amount
+            yield (None, user, None, None, amount, 'TL', 'deposit', 'seed', created_at, None, balances[user])
+        else:
+            # Card-side movements leave the TL balance alone
+            cards = cards_by_user[user]
+            if len(cards) >= 2 and kind < 0.9:
+                a, b = rng.sample(cards, 2)
+                yield (user, None, a, b, rng.randrange(100, 100000), 'USD', 'card_transfer', 'seed', created_at,
+                       balances[user], None)
+            else:
+                yield (user, None, cards[0] if cards else None, None, rng.randrange(100, 100000), 'USD',
+                       'conversion', 'seed', created_at, balances[user], None)
+
+
+def seed(path, users=1000, cards_per_user=2, transactions=100000, days=365, rng_seed=0, log=print):
+    if os.path.exists(path):
+        os.remove(path)
+    db, passwords, sessions, statements = _load_app(path)
+    rng = random.Random(rng_seed)
+    conn = db.connect(path)
+    started = time.perf_counter()
+
+    # One hash for everyone: a realistic KDF cost per user would dominate seeding
+    password_hash = passwords._hash(PASSWORD)
+    conn.executemany('INSERT INTO users (email, password, balance_minor) VALUES (?, ?, ?)',
+                     ((f'user{i}@bench.local', password_hash, START_BALANCE) for i in range(users)))
+    user_ids = [row[0] for row in conn.execute('SELECT id FROM users ORDER BY id')]
+
+    conn.executemany('''
+        INSERT INTO cards (user_id, card_number, card_holder, card_type, expiry, cvv, balance_usd_minor)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', ((uid, f'{4000000000000000 + uid * 10 + c}', f'User {uid}', CARD_TYPES[c % 3], '12/30', '123', 10 ** 12)
+          for uid in user_ids for c in range(cards_per_user)))
+    conn.commit()
+
+    cards_by_user = {uid: [] for uid in user_ids}
+    for row in conn.execute('SELECT id, user_id FROM cards'):
+        cards_by_user[row[1]].append(row[0])
+
+    balances = dict.fromkeys(user_ids, START_BALANCE)
+    rows = _transactions(rng, user_ids, cards_by_user, balances, transactions, days)
+    written = 0
+    while written < transactions:
+        chunk = [next(rows) for _ in range(min(BATCH, transactions - written))]
+        conn.executemany('''
+            INSERT INTO transactions (from_user_id, to_user_id, from_card_id, to_card_id, amount_minor, currency,
+                                      type, description, created_at, from_balance_after, to_balance_after)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', chunk)
+        conn.commit()
+        written += len(chunk)
+        log(f'  transactions: {written}/{transactions}')
+
+    conn.executemany('UPDATE users SET balance_minor = ? WHERE id = ?',
+                     [(balance, uid) for uid, balance in balances.items()])
+    statements.rebuild_rollups(conn)
+    conn.commit()
+
+    accounts = [{
+        'user_id': uid,
+        'email': f'user{i}@bench.local',
+        'password': PASSWORD,
+        'card_ids': cards_by_user[uid],
+        'token': sessions.create(conn, uid)
+    } for i, uid in enumerate(user_ids)]
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+    with open(path + '.accounts.json', 'w') as f:
+        json.dump(accounts, f)
+    log(f'seeded {users} users, {users * cards_per_user} cards, {transactions} transactions '
+        f'in {time.perf_counter() - started:.1f}s -> {path}')
+    return accounts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--cards-per-user', type=int, default=2)
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    seed(os.path.abspath(args.path), args.users, args.cards_per_user, args.transactions, args.days, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import os
+import queue
+import sqlite3
+
+from flask import g
+
+import metrics
+
+# Use /tmp directory for SQLite on Render (ephemeral but writable)
+DATABASE = os.environ.get('DATABASE_PATH') or (
+    os.path.join('/tmp', 'paypal_mvp.db') if os.path.exists('/tmp') else 'paypal_mvp.db'
+)
+
+# Idle connections kept per gunicorn worker
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+
+# WAL + NORMAL is still durable across app crashes; FULL also survives power loss
+SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'NORMAL')
+
+# How long a statement waits for another connection's write lock
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+
+# Applied once when a pooled connection is opened, not on every request
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    f'PRAGMA synchronous={SYNCHRONOUS}',
+    'PRAGMA cache_size=-16000',      # ~16 MB page cache per connection
+    'PRAGMA mmap_size=268435456',    # 256 MB memory-mapped reads
+    f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}',
+    'PRAGMA temp_store=MEMORY',
+)
+
+
+def connect(path=None):
+    factory = metrics.Connection if metrics.ENABLED else sqlite3.Connection
+    conn = sqlite3.connect(path or DATABASE, check_same_thread=False, factory=factory)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, path=None, size=POOL_SIZE):
+        self.path = path or DATABASE
+        self.pid = os.getpid()
+        # LIFO keeps the most recently used (warmest) connection on top
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.path)
+
+    def release(self, conn):
+        # Never hand a half-finished transaction to the next request
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+
+
+def get_pool(path=None):
+    path = path or DATABASE
+    pool = _pools.get(path)
+    # gunicorn forks workers after import; connections must not cross a fork
+    if pool is None or pool.pid != os.getpid():
+        pool = _pools[path] = ConnectionPool(path)
+    return pool
+
+
+def get_db(path=None):
+    """Request-scoped pooled connection to path.
+
+    Defaults to g.db_path, which login_required points at the signed-in
+    user's shard in sharded mode (see sharding.py), else DATABASE.
+    """
+    path = path or g.get('db_path') or DATABASE
+    conns = g.setdefault('db', {})
+    if path not in conns:
+        conns[path] = get_pool(path).acquire()
+    return conns[path]
+
+
+def close_db(error=None):
+    for path, conn in g.pop('db', {}).items():
+        get_pool(path).release(conn)
+
+
+class QueryPlanError(RuntimeError):
+    pass
+
+
+def check_query_plans(conn, queries):
+    """Fail loudly if any hot query would full-scan a table instead of seeking an index.
+
+    "SCAN (subquery-N)" is fine: it iterates an already index-limited result.
+    """
+    for name, (sql, params) in queries.items():
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[3]
+            if detail.startswith('SCAN ') and not detail.startswith('SCAN ('):
+                raise QueryPlanError(f'Hot query {name!r} regressed to a full scan: {detail}')
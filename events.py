@@ -0,0 +1,337 @@
+"""Per-user change feed, streamed to browsers as Server-Sent Events.
+
+Every posting appends to the events table in its own transaction (see
+ledger.py): a 'transaction' event for each party whose balance the row
+records, carrying the row as /api/transactions renders it (balance_after
+included), and a 'card' event with the new state of every card it
+changed. Adding a card does the same. Event ids only grow (AUTOINCREMENT),
+so a client that reconnects with Last-Event-ID is replayed exactly what it
+missed.
+
+/api/events/<user_id> holds one connection open per subscribed tab; it
+is opened with a ticket from /api/events/ticket (see sessions.py). No
+query runs per subscriber: each worker has one tailer thread (Hub) that
+reads new events every POLL_INTERVAL and hands them to the streams of
+their users, which sleep until then. An open stream still occupies a
+request thread, so run gunicorn with the gthread worker class (see
+gunicorn.conf.py); a sync worker would be tied up by a single tab.
+
+Events older than RETENTION_SECONDS are pruned every PRUNE_INTERVAL by
+a thread in each worker (Pruner), whether or not anyone is subscribed.
+A client resuming from before the oldest kept event gets 'reset' and
+reloads.
+"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import db
+import money
+
+POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_MS', 100)) / 1000
+HEARTBEAT_SECONDS = 15
+# Streams end after this long; EventSource reconnects with Last-Event-ID
+STREAM_SECONDS = float(os.environ.get('EVENTS_STREAM_SECONDS', 600))
+RETENTION_SECONDS = int(os.environ.get('EVENTS_RETENTION_SECONDS', 24 * 3600))
+PRUNE_INTERVAL = 60
+PRUNE_BATCH = 5000
+# More missed events than this are not replayed; the client reloads instead
+REPLAY_LIMIT = 500
+# Events queued for a stream that is not draining them before it is dropped
+MAX_PENDING = 1000
+RETRY_MS = 2000
+
+log = logging.getLogger('paypal_mvp.events')
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        data TEXT NOT NULL,
+        created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+    );
+    CREATE INDEX IF NOT EXISTS idx_events_user ON events (user_id, id);
+'''
+
+# One event per party whose running balance the row records, i.e. who holds
+# it on this database; same fields as app.transaction_to_dict()
+_TRANSACTION_EVENTS = f'''
+    INSERT INTO events (user_id, kind, data)
+    SELECT p.user_id, 'transaction', json_object(
+        'id', t.id,
+        'amount', {money.from_minor_sql('t.amount_minor', currency_column='t.currency')},
+        'currency', coalesce(t.currency, 'TL'),
+        'type', t.type,
+        'description', t.description,
+        'from_email', u_from.email,
+        'to_email', u_to.email,
+        'from_card_type', c_from.card_type,
+        'to_card_type', c_to.card_type,
+        'created_at', t.created_at,
+        'is_incoming', json(iif(t.to_user_id IS p.user_id, 'true', 'false')),
+        'balance_after', {money.from_minor_sql('p.balance_after')}
+    )
+    FROM (
+        SELECT id, from_user_id AS user_id, from_balance_after AS balance_after FROM transactions
+        WHERE id BETWEEN :first AND :last AND from_balance_after IS NOT NULL
+        UNION ALL
+        SELECT id, to_user_id, to_balance_after FROM transactions
+        WHERE id BETWEEN :first AND :last AND to_balance_after IS NOT NULL
+    ) p
+    JOIN transactions t ON t.id = p.id
+    LEFT JOIN users u_from ON t.from_user_id = u_from.id
+    LEFT JOIN users u_to ON t.to_user_id = u_to.id
+    LEFT JOIN cards c_from ON t.from_card_id = c_from.id
+    LEFT JOIN cards c_to ON t.to_card_id = c_to.id
+    ORDER BY t.id
+'''
+
+# Same fields as /api/cards
+_CARD_EVENTS = f'''
+    INSERT INTO events (user_id, kind, data)
+    SELECT user_id, 'card', json_object(
+        'id', id,
+        'card_number', '**** **** **** ' || substr(card_number, -4),
+        'card_holder', card_holder,
+        'card_type', card_type,
+        'expiry', expiry,
+        'balance_usd', {money.from_minor_sql('balance_usd_minor', money.CARD_CURRENCY)}
+    )
+    FROM cards WHERE id IN (SELECT value FROM json_each(?))
+'''
+
+SINCE_QUERY = '''
+    SELECT id, kind, data FROM events WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?
+'''
+
+TAIL_QUERY = 'SELECT id, user_id, kind, data FROM events WHERE id > ? ORDER BY id LIMIT 1000'
+
+# Oldest id a resuming client can still be replayed from
+_OLDEST_QUERY = '''
+    SELECT coalesce((SELECT min(id) FROM events),
+                    (SELECT seq + 1 FROM sqlite_sequence WHERE name = 'events'), 1)
+'''
+
+_LATEST_QUERY = "SELECT coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'events'), 0)"
+
+
+def transactions(cursor, first_id, last_id=None):
+    """Publish the transactions rows first_id..last_id just written in this transaction."""
+    cursor.execute(_TRANSACTION_EVENTS, {'first': first_id, 'last': last_id or first_id})
+
+
+def cards(cursor, card_ids):
+    """Publish the current state of these cards."""
+    cursor.execute(_CARD_EVENTS, (json.dumps([int(card_id) for card_id in card_ids]),))
+
+
+def message(event_id, kind, data):
+    """One SSE message."""
+    return f'id: {event_id}\nevent: {kind}\ndata: {data}\n\n'
+
+
+def replay(conn, user_id, last_id):
+    """SSE messages a stream starts with, and the event id it continues after.
+
+    Without last_id the client is told to load its state ('ready'); with
+    one it gets what it missed, or 'reset' if that is no longer all there.
+    """
+    latest = conn.execute(_LATEST_QUERY).fetchone()[0]
+    if last_id is None or last_id > latest:
+        return [message(latest, 'ready', '{}')], latest
+    if last_id + 1 < conn.execute(_OLDEST_QUERY).fetchone()[0]:
+        return [message(latest, 'reset', '{}')], latest
+    rows = conn.execute(SINCE_QUERY, (user_id, last_id, REPLAY_LIMIT + 1)).fetchall()
+    if len(rows) > REPLAY_LIMIT:
+        return [message(latest, 'reset', '{}')], latest
+    return [message(row['id'], row['kind'], row['data']) for row in rows], max([last_id] + [row['id'] for row in rows])
+
+
+def prune(conn, now=None):
+    """Delete up to PRUNE_BATCH events older than RETENTION_SECONDS; returns how many."""
+    cutoff = int(now or time.time()) - RETENTION_SECONDS
+    deleted = conn.execute('DELETE FROM events WHERE id IN (SELECT id FROM events ORDER BY id LIMIT ?) '
+                           'AND created_at < ?', (PRUNE_BATCH, cutoff)).rowcount
+    conn.commit()
+    return deleted
+
+
+class Subscription:
+    def __init__(self, path, user_id):
+        self.path = path
+        self.user_id = user_id
+        self.last_id = None
+        self.overflowed = False
+        self._pending = collections.deque()
+        self._ready = threading.Event()
+
+    def push(self, rows):
+        if len(self._pending) >= MAX_PENDING:
+            self.overflowed = True
+        else:
+            self._pending.extend(rows)
+        self._ready.set()
+
+    def wait(self, timeout):
+        """Rows delivered since the last call that are newer than last_id; [] on timeout."""
+        self._ready.wait(timeout)
+        self._ready.clear()
+        rows = []
+        while self._pending:
+            row = self._pending.popleft()
+            # The replay may already have sent what the tailer picks up next
+            if row[0] > self.last_id:
+                rows.append(row)
+                self.last_id = row[0]
+        return rows
+
+
+class Hub:
+    """Tails the events table of each subscribed database and fans rows out to streams.
+
+    A stream subscribes before it reads its replay and then start()s from
+    where the replay ended, so every event reaches it through one or the
+    other (Subscription.wait() drops the overlap).
+    """
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self._subscribers = {}  # path -> user_id -> set of Subscription
+        self._positions = {}    # path -> last event id handed out
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self, path, user_id):
+        with self._lock:
+            # The tailer thread does not survive gunicorn's fork; start one per worker
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._subscribers, self._positions = {}, {}
+                self._thread = threading.Thread(target=self._run, name='events-tailer', daemon=True)
+                self._thread.start()
+            subscription = Subscription(path, user_id)
+            self._subscribers.setdefault(path, {}).setdefault(user_id, set()).add(subscription)
+            return subscription
+
+    def start(self, subscription, last_id):
+        with self._lock:
+            subscription.last_id = last_id
+            # A database nobody was subscribed to is tailed from the first replay's end
+            if self._positions.get(subscription.path) is None:
+                self._positions[subscription.path] = last_id
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            users = self._subscribers.get(subscription.path, {})
+            streams = users.get(subscription.user_id, set())
+            streams.discard(subscription)
+            if not streams:
+                users.pop(subscription.user_id, None)
+
+    def subscribers(self):
+        with self._lock:
+            return sum(len(streams) for users in self._subscribers.values() for streams in users.values())
+
+    def _run(self):
+        connections = {}
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                paths = [path for path in self._subscribers if self._positions.get(path) is not None]
+            for path in paths:
+                try:
+                    conn = connections.get(path) or connections.setdefault(path, db.connect(path))
+                    self._poll(conn, path)
+                except Exception as e:  # a locked or missing file must not end the tailer
+                    log.warning('events tailer: %s: %s', path, e)
+
+    def _poll(self, conn, path):
+        position = self._positions[path]
+        while True:
+            rows = conn.execute(TAIL_QUERY, (position,)).fetchall()
+            if not rows:
+                return
+            position = self._positions[path] = rows[-1]['id']
+            by_user = {}
+            for row in rows:
+                by_user.setdefault(row['user_id'], []).append((row['id'], row['kind'], row['data']))
+            with self._lock:
+                users = self._subscribers.get(path, {})
+                targets = [(streams, by_user[user_id]) for user_id, streams in users.items() if user_id in by_user]
+                targets = [(subscription, user_rows) for streams, user_rows in targets
+                           for subscription in list(streams)]
+            for subscription, user_rows in targets:
+                subscription.push(user_rows)
+
+
+hub = Hub()
+
+
+class Pruner:
+    """Prunes the events table of every database, one thread per worker."""
+
+    def __init__(self, interval=PRUNE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # The thread does not survive gunicorn's fork; start one per worker
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._run, name='events-pruner', daemon=True).start()
+                    self._pid = os.getpid()
+
+    def _run(self):
+        import sharding  # sharding -> ledger -> events
+        connections = {}
+        while True:
+            time.sleep(self.interval)
+            for path in sharding.database_paths():
+                try:
+                    conn = connections.get(path) or connections.setdefault(path, db.connect(path))
+                    # A full batch means more is due; keep going in short transactions
+                    while prune(conn) >= PRUNE_BATCH:
+                        time.sleep(0.01)
+                except Exception as e:  # a locked or missing file must not end the pruner
+                    log.warning('events pruner: %s: %s', path, e)
+                    if path in connections:
+                        connections[path].rollback()
+
+
+pruner = Pruner()
+
+
+def stream(subscription, first_messages):
+    """SSE body: the replay, then live events and heartbeats until STREAM_SECONDS."""
+    try:
+        yield f'retry: {RETRY_MS}\n\n' + ''.join(first_messages)
+        deadline = time.monotonic() + STREAM_SECONDS
+        while time.monotonic() < deadline:
+            rows = subscription.wait(HEARTBEAT_SECONDS)
+            if subscription.overflowed:
+                # Too far behind to keep queueing; the reconnect replays from the database
+                return
+            if rows:
+                yield ''.join(message(*row) for row in rows)
+            else:
+                yield ': keepalive\n\n'
+    finally:
+        hub.unsubscribe(subscription)
+
+
+if __name__ == '__main__':
+    import sharding
+    for path in [db.DATABASE] + (sharding.database_paths() if sharding.ENABLED else []):
+        conn = db.connect(path)
+        total = 0
+        while (deleted := prune(conn)):
+            total += deleted
+        conn.close()
+        print(f'pruned {total} events from {path}')
@@ -0,0 +1,19 @@
+"""gunicorn settings, read from the working directory by ``gunicorn app:app``.
+
+Every open dashboard keeps an /api/events stream open (see events.py). The
+gthread worker runs requests on a thread pool and parks idle keep-alive
+sockets in a selector, so an open stream costs one mostly sleeping thread;
+under the default sync worker it would hold the whole worker.
+"""
+import os
+import time
+
+worker_class = 'gthread'
+# Open event streams plus requests in flight, per worker
+threads = int(os.environ.get('GUNICORN_THREADS', 1000))
+worker_connections = threads + 100
+
+
+def on_starting(server):
+    # Workers inherit it: metrics snapshots older than this belong to an earlier run
+    os.environ['METRICS_SINCE'] = str(time.time())
@@ -0,0 +1,160 @@
+"""Idempotency-Key handling for the mutation routes.
+
+A client that retries a POST after a timeout sends the same
+Idempotency-Key header again. The first request to complete claims the
+key in the transaction of its ledger posting: recorded() inserts the
+key, runs the posting, renders the route's response and stores it in the
+same transaction, so a key is recorded exactly when its money moved.
+
+A retry is answered with the stored status and body: from the per-worker
+LRU when this worker has seen the key, otherwise with one read of
+idempotency_keys; neither takes the write lock. A duplicate that races
+the original waits for the write lock like any posting, finds the key
+claimed (Duplicate) and is rolled back, then replays the winner's
+response. Reusing a key for a different request is refused.
+
+Only completed postings are recorded. A request that failed changed
+nothing and runs again when retried. Keys are per user and expire after
+IDEMPOTENCY_TTL; an expired key can be claimed again straight away, and
+the posting transactions delete expired rows in small batches, at most
+every PRUNE_INTERVAL per worker.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+MAX_KEY_LENGTH = 255
+PRUNE_INTERVAL = 60
+PRUNE_BATCH = 1000
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        user_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        status INTEGER NOT NULL,
+        response TEXT NOT NULL,
+        expires_at INTEGER NOT NULL,
+        PRIMARY KEY (user_id, key)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at);
+'''
+
+LOOKUP_QUERY = '''
+    SELECT fingerprint, status, response, expires_at FROM idempotency_keys
+    WHERE user_id = ? AND key = ? AND expires_at > ?
+'''
+
+# An expired key that has not been pruned yet is taken over like a new one
+_CLAIM_QUERY = '''
+    INSERT INTO idempotency_keys (user_id, key, fingerprint, status, response, expires_at)
+    VALUES (?, ?, ?, 0, '', ?)
+    ON CONFLICT (user_id, key) DO UPDATE SET
+        fingerprint = excluded.fingerprint, status = 0, response = '', expires_at = excluded.expires_at
+    WHERE idempotency_keys.expires_at <= ?
+'''
+
+_PRUNE_QUERY = '''
+    DELETE FROM idempotency_keys WHERE (user_id, key) IN (
+        SELECT user_id, key FROM idempotency_keys WHERE expires_at <= ? LIMIT ?
+    )
+'''
+
+
+class Duplicate(Exception):
+    """The key was claimed by another request first; its posting is rolled back."""
+
+
+class Stored:
+    __slots__ = ('fingerprint', 'status', 'response', 'expires_at')
+
+    def __init__(self, fingerprint, status, response, expires_at):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.response = response
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()  # (user_id, key) -> Stored
+        self._lock = threading.Lock()
+
+    def get(self, user_id, key, now):
+        with self._lock:
+            stored = self._entries.get((user_id, key))
+            if stored is None:
+                return None
+            if stored.expires_at <= now:
+                del self._entries[(user_id, key)]
+                return None
+            self._entries.move_to_end((user_id, key))
+            return stored
+
+    def put(self, user_id, key, stored):
+        with self._lock:
+            self._entries[(user_id, key)] = stored
+            self._entries.move_to_end((user_id, key))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+cache = ResponseCache()
+_pruned_at = 0.0
+
+
+def fingerprint(method, path, body):
+    return hashlib.sha256(b'%s %s\n%s' % (method.encode(), path.encode(), body)).hexdigest()
+
+
+def lookup(conn, user_id, key):
+    """The stored response for this user's key, or None."""
+    now = time.time()
+    stored = cache.get(user_id, key, now)
+    if stored is not None:
+        return stored
+    row = conn.execute(LOOKUP_QUERY, (user_id, key, int(now))).fetchone()
+    if row is None:
+        return None
+    stored = Stored(row['fingerprint'], row['status'], row['response'], row['expires_at'])
+    cache.put(user_id, key, stored)
+    return stored
+
+
+class Claim:
+    """A key being used for the first time by this request."""
+
+    def __init__(self, user_id, key, fingerprint):
+        self.user_id = user_id
+        self.key = key
+        self.fingerprint = fingerprint
+        self.stored = None
+
+    def recorded(self, posting, render):
+        """posting wrapped to claim the key and store render(result) -> (body, status) with it."""
+        def run(cursor, *args):
+            global _pruned_at
+            now = int(time.time())
+            cursor.execute(_CLAIM_QUERY, (self.user_id, self.key, self.fingerprint, now + TTL, now))
+            if cursor.rowcount != 1:
+                raise Duplicate(self.key)
+            # The write lock is held anyway; expire a batch of old keys with it
+            if time.monotonic() - _pruned_at >= PRUNE_INTERVAL:
+                _pruned_at = time.monotonic()
+                cursor.execute(_PRUNE_QUERY, (now, PRUNE_BATCH))
+            result = posting(cursor, *args)
+            body, status = render(result)
+            self.stored = Stored(self.fingerprint, status, json.dumps(body), now + TTL)
+            cursor.execute('UPDATE idempotency_keys SET status = ?, response = ? WHERE user_id = ? AND key = ?',
+                           (status, self.stored.response, self.user_id, self.key))
+            return result
+        return run
+
+    def committed(self):
+        cache.put(self.user_id, self.key, self.stored)
@@ -0,0 +1,404 @@
+"""Money movement.
+
+Every balance change goes through post(), which runs one posting function
+inside BEGIN IMMEDIATE so the write lock is taken up front instead of being
+upgraded mid-transaction. Debits are guarded UPDATEs (``WHERE balance_minor >= ?``)
+so a balance can never go negative, even if two requests race.
+
+Each posting also stamps the parties' running balances on the rows it
+writes, updates daily_rollups (see statements.py) and appends to the
+change feed (see events.py) in the same transaction.
+"""
+import json
+import random
+import sqlite3
+import time
+import uuid
+
+import events
+import money
+import rates
+import statements
+
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.01  # seconds, doubled per attempt with jitter
+
+
+class LedgerError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _is_busy(error):
+    msg = str(error)
+    return 'database is locked' in msg or 'database is busy' in msg
+
+
+# Set to a pipeline.WritePipeline to hand postings to a dedicated writer thread
+pipeline = None
+
+
+def post(conn, posting, *args):
+    """Run posting(cursor, *args) atomically and return its result."""
+    if pipeline is not None:
+        return pipeline.submit(posting, args)
+    return run_posting(conn, posting, *args)
+
+
+def run_posting(conn, posting, *args):
+    """Run posting(cursor, *args) in its own BEGIN IMMEDIATE transaction on conn."""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e) or attempt == MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(BACKOFF_BASE * (2 ** attempt) * (0.5 + random.random()))
+            continue
+        try:
+            result = posting(conn.cursor(), *args)
+            conn.commit()
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+def _debit_user(cursor, user_id, amount_minor, error):
+    cursor.execute('UPDATE users SET balance_minor = balance_minor - ? WHERE id = ? AND balance_minor >= ?',
+                   (amount_minor, user_id, amount_minor))
+    if cursor.rowcount != 1:
+        raise LedgerError(error)
+
+
+def _debit_card(cursor, card_id, amount_minor, error):
+    cursor.execute('UPDATE cards SET balance_usd_minor = balance_usd_minor - ? WHERE id = ? AND balance_usd_minor >= ?',
+                   (amount_minor, card_id, amount_minor))
+    if cursor.rowcount != 1:
+        raise LedgerError(error)
+
+
+def _holding(currency, minor):
+    # USD lives on the card; every other currency is held in the user balance
+    if currency == money.CARD_CURRENCY:
+        return currency, minor
+    return money.BALANCE_CURRENCY, money.rescale(minor, currency, money.BALANCE_CURRENCY)
+
+
+def _user_balance(cursor, user_id):
+    cursor.execute('SELECT balance_minor FROM users WHERE id = ?', (user_id,))
+    return cursor.fetchone()['balance_minor']
+
+
+# Amounts below are integer minor units (see money.py); balances are returned the same way.
+
+def open_account(cursor, email, password_hash, bonus_minor, user_id=None):
+    """Create a user; the welcome bonus is posted like any other credit so
+    statements add up from the first day.
+
+    Sharded deployments pass the user_id the directory allocated."""
+    cursor.execute('INSERT INTO users (id, email, password, balance_minor) VALUES (?, ?, ?, ?)',
+                   (user_id, email, password_hash, bonus_minor))
+    user_id = cursor.lastrowid
+    created_at = statements.now()
+    cursor.execute('''
+        INSERT INTO transactions (to_user_id, amount_minor, type, description, created_at, to_balance_after)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, bonus_minor, 'bonus', 'Hoş geldin bonusu', created_at, bonus_minor))
+    events.transactions(cursor, cursor.lastrowid)
+    statements.record(cursor, [(user_id, created_at, money.BALANCE_CURRENCY, bonus_minor, 0, 1)])
+    return user_id
+
+
+def open_card(cursor, user_id, card_number, card_holder, card_type, expiry, cvv, balance_usd_minor):
+    """Add a (simulated) card with its starting USD balance."""
+    cursor.execute('''
+        INSERT INTO cards (user_id, card_number, card_holder, card_type, expiry, cvv, balance_usd_minor)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, card_number, card_holder, card_type, expiry, cvv, balance_usd_minor))
+    card_id = cursor.lastrowid
+    events.cards(cursor, [card_id])
+    return {'card_id': card_id}
+
+
+def deposit(cursor, user_id, card_id, amount_minor):
+    # Verify card belongs to user
+    cursor.execute('SELECT id FROM cards WHERE id = ? AND user_id = ?', (card_id, user_id))
+    if not cursor.fetchone():
+        raise LedgerError('Kart bulunamadı', 404)
+
+    cursor.execute('UPDATE users SET balance_minor = balance_minor + ? WHERE id = ?', (amount_minor, user_id))
+    balance = _user_balance(cursor, user_id)
+    created_at = statements.now()
+    cursor.execute('''
+        INSERT INTO transactions (to_user_id, amount_minor, type, description, created_at, to_balance_after)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, amount_minor, 'deposit', f'Kredi kartından {money.format_amount(amount_minor)} TL yükleme',
+          created_at, balance))
+    events.transactions(cursor, cursor.lastrowid)
+    statements.record(cursor, [(user_id, created_at, money.BALANCE_CURRENCY, amount_minor, 0, 1)])
+
+    return {'new_balance': balance}
+
+
+def transfer(cursor, from_user_id, to_email, amount_minor, description):
+    cursor.execute('SELECT email FROM users WHERE id = ?', (from_user_id,))
+    sender = cursor.fetchone()
+    if not sender:
+        raise LedgerError('Gönderen kullanıcı bulunamadı', 404)
+
+    cursor.execute('SELECT id FROM users WHERE email = ?', (to_email,))
+    receiver = cursor.fetchone()
+    if not receiver:
+        raise LedgerError('Alıcı kullanıcı bulunamadı', 404)
+
+    if sender['email'] == to_email:
+        raise LedgerError('Kendinize para gönderemezsiniz')
+
+    _debit_user(cursor, from_user_id, amount_minor, 'Yetersiz bakiye')
+    cursor.execute('UPDATE users SET balance_minor = balance_minor + ? WHERE id = ?', (amount_minor, receiver['id']))
+    sender_balance = _user_balance(cursor, from_user_id)
+    created_at = statements.now()
+    cursor.execute('''
+        INSERT INTO transactions (from_user_id, to_user_id, amount_minor, type, description, created_at,
+                                  from_balance_after, to_balance_after)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (from_user_id, receiver['id'], amount_minor, 'transfer', description, created_at,
+          sender_balance, _user_balance(cursor, receiver['id'])))
+    events.transactions(cursor, cursor.lastrowid)
+    statements.record(cursor, [(from_user_id, created_at, money.BALANCE_CURRENCY, 0, amount_minor, 1),
+                               (receiver['id'], created_at, money.BALANCE_CURRENCY, amount_minor, 0, 1)])
+
+    return {'new_balance': sender_balance}
+
+
+def _shadow_user(cursor, user_id, email):
+    # Users from other shards get a password-less row so history joins still find their email
+    cursor.execute("INSERT OR IGNORE INTO users (id, email, password, balance_minor) VALUES (?, ?, '', 0)",
+                   (user_id, email))
+
+
+def _queue_remote_credit(cursor, from_user_id, from_email, receiver, amount_minor, description):
+    _shadow_user(cursor, receiver['user_id'], receiver['email'])
+    transfer_id = uuid.uuid4().hex
+    cursor.execute('''
+        INSERT INTO outbox (transfer_id, to_shard, from_user_id, from_email, to_user_id, amount_minor, description)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (transfer_id, receiver['shard'], from_user_id, from_email, receiver['user_id'], amount_minor, description))
+    return transfer_id
+
+
+def transfer_out(cursor, from_user_id, receiver, amount_minor, description):
+    """Debit side of a transfer to a user on another shard.
+
+    receiver is the recipient's directory entry (user_id, email, shard). The
+    credit is queued in the outbox in the same transaction and applied on
+    the receiver's shard by transfer_in (see sharding.deliver).
+    """
+    cursor.execute('SELECT email FROM users WHERE id = ?', (from_user_id,))
+    sender = cursor.fetchone()
+    if not sender:
+        raise LedgerError('Gönderen kullanıcı bulunamadı', 404)
+
+    _debit_user(cursor, from_user_id, amount_minor, 'Yetersiz bakiye')
+    sender_balance = _user_balance(cursor, from_user_id)
+    transfer_id = _queue_remote_credit(cursor, from_user_id, sender['email'], receiver, amount_minor, description)
+    created_at = statements.now()
+    cursor.execute('''
+        INSERT INTO transactions (from_user_id, to_user_id, amount_minor, type, description, created_at,
+                                  from_balance_after)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (from_user_id, receiver['user_id'], amount_minor, 'transfer', description, created_at, sender_balance))
+    events.transactions(cursor, cursor.lastrowid)
+    statements.record(cursor, [(from_user_id, created_at, money.BALANCE_CURRENCY, 0, amount_minor, 1)])
+
+    return {'new_balance': sender_balance, 'transfer_ids': [transfer_id]}
+
+
+def transfer_in(cursor, transfer):
+    """Credit side of a cross-shard transfer, keyed by an outbox row.
+
+    Safe to run more than once: the inbox remembers applied transfer ids.
+    Returns False if the transfer had already been applied.
+    """
+    cursor.execute('INSERT OR IGNORE INTO inbox (transfer_id) VALUES (?)', (transfer['transfer_id'],))
+    if cursor.rowcount != 1:
+        return False
+
+    cursor.execute('UPDATE users SET balance_minor = balance_minor + ? WHERE id = ?',
+                   (transfer['amount_minor'], transfer['to_user_id']))
+    if cursor.rowcount != 1:
+        raise LedgerError('Alıcı kullanıcı bulunamadı', 404)
+    _shadow_user(cursor, transfer['from_user_id'], transfer['from_email'])
+    # Stamped with the arrival time so running balances stay in order on this shard
+    created_at = statements.now()
+    cursor.execute('''
+        INSERT INTO transactions (from_user_id, to_user_id, amount_minor, type, description, created_at,
+                                  to_balance_after)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (transfer['from_user_id'], transfer['to_user_id'], transfer['amount_minor'], 'transfer',
+          transfer['description'], created_at, _user_balance(cursor, transfer['to_user_id'])))
+    events.transactions(cursor, cursor.lastrowid)
+    statements.record(cursor, [(transfer['to_user_id'], created_at, money.BALANCE_CURRENCY,
+                                transfer['amount_minor'], 0, 1)])
+    return True
+
+
+def convert(cursor, user_id, card_id, from_currency, to_currency, amount_minor):
+    """amount_minor is in from_currency's minor units."""
+    table = rates.current(cursor.connection)
+    if from_currency not in table.rates or to_currency not in table.rates:
+        raise LedgerError('Geçersiz para birimi')
+
+    cursor.execute('SELECT id FROM cards WHERE id = ? AND user_id = ?', (card_id, user_id))
+    if not cursor.fetchone():
+        raise LedgerError('Kart bulunamadı', 404)
+
+    converted_minor = money.convert(amount_minor, from_currency, to_currency, table.scaled)
+
+    debit_account, debit_minor = _holding(from_currency, amount_minor)
+    credit_account, credit_minor = _holding(to_currency, converted_minor)
+    if debit_account == money.CARD_CURRENCY:
+        _debit_card(cursor, card_id, debit_minor, 'Yetersiz USD bakiye')
+    else:
+        _debit_user(cursor, user_id, debit_minor, f'Yetersiz {from_currency} bakiye')
+
+    if credit_account == money.CARD_CURRENCY:
+        cursor.execute('UPDATE cards SET balance_usd_minor = balance_usd_minor + ? WHERE id = ?',
+                       (credit_minor, card_id))
+    else:
+        cursor.execute('UPDATE users SET balance_minor = balance_minor + ? WHERE id = ?', (credit_minor, user_id))
+
+    amount = money.from_minor(amount_minor, from_currency)
+    converted_amount = money.from_minor(converted_minor, to_currency)
+    exchange_rate = converted_amount / amount
+    description = f'{money.format_amount(amount_minor, from_currency)} {table.symbols[from_currency]} {from_currency} → {money.format_amount(converted_minor, to_currency)} {table.symbols[to_currency]} {to_currency} (Kur: {exchange_rate:.4f})'
+
+    created_at = statements.now()
+    cursor.execute('''
+        INSERT INTO transactions (from_user_id, from_card_id, amount_minor, currency, type, description, created_at,
+                                  from_balance_after)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, card_id, amount_minor, from_currency, 'conversion', description, created_at,
+          _user_balance(cursor, user_id)))
+    events.transactions(cursor, cursor.lastrowid)
+    if money.CARD_CURRENCY in (debit_account, credit_account):
+        events.cards(cursor, [card_id])
+    # Rolled up per account that actually moved, so statements reconcile with the balances
+    statements.record(cursor, [(user_id, created_at, debit_account, 0, debit_minor, 1),
+                               (user_id, created_at, credit_account, credit_minor, 0, 0)])
+
+    return {'description': description, 'converted_minor': converted_minor}
+
+
+def card_transfer(cursor, user_id, from_card_id, to_card_id, amount_minor):
+    cursor.execute('SELECT id, card_type FROM cards WHERE id IN (?, ?) AND user_id = ?',
+                   (from_card_id, to_card_id, user_id))
+    card_types = {str(row['id']): row['card_type'] for row in cursor.fetchall()}
+    from_type = card_types.get(str(from_card_id))
+    to_type = card_types.get(str(to_card_id))
+    if not from_type or not to_type:
+        raise LedgerError('Kart(lar) bulunamadı', 404)
+
+    _debit_card(cursor, from_card_id, amount_minor, 'Yetersiz bakiye')
+    cursor.execute('UPDATE cards SET balance_usd_minor = balance_usd_minor + ? WHERE id = ?', (amount_minor, to_card_id))
+    created_at = statements.now()
+    cursor.execute('''
+        INSERT INTO transactions (from_user_id, from_card_id, to_card_id, amount_minor, currency, type, description,
+                                  created_at, from_balance_after)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, from_card_id, to_card_id, amount_minor, 'USD', 'card_transfer',
+          f'{from_type} → {to_type} ({money.format_amount(amount_minor, "USD")} USD)',
+          created_at, _user_balance(cursor, user_id)))
+    events.transactions(cursor, cursor.lastrowid)
+    events.cards(cursor, [from_card_id, to_card_id])
+    # Moves between the user's own cards: out of one, into the other
+    statements.record(cursor, [(user_id, created_at, 'USD', amount_minor, amount_minor, 1)])
+
+    return {}
+
+
+def transfer_batch(cursor, from_user_id, items, remote=None):
+    """Pay many recipients from one sender in a single transaction.
+
+    items are (to_email, amount_minor, description) tuples. Unknown or self
+    recipients fail individually; the sender's balance is checked once for
+    the sum of everything that can be paid, and if it does not cover the
+    total nothing is paid.
+
+    remote maps the emails of recipients on other shards to their directory
+    entries; their credits go to the outbox like transfer_out's.
+    """
+    remote = remote or {}
+    cursor.execute('SELECT email FROM users WHERE id = ?', (from_user_id,))
+    sender = cursor.fetchone()
+    if not sender:
+        raise LedgerError('Gönderen kullanıcı bulunamadı', 404)
+
+    # One lookup for every distinct recipient; json_each avoids the bound-parameter limit
+    emails = sorted({item[0] for item in items} - remote.keys())
+    cursor.execute('SELECT id, email FROM users WHERE email IN (SELECT value FROM json_each(?))',
+                   (json.dumps(emails),))
+    recipient_ids = {row['email']: row['id'] for row in cursor.fetchall()}
+    recipient_ids.update((email, receiver['user_id']) for email, receiver in remote.items())
+
+    results = []
+    credits = []
+    total = 0
+    for to_email, amount_minor, description in items:
+        receiver_id = recipient_ids.get(to_email)
+        if receiver_id is None:
+            results.append({'status': 'error', 'error': 'Alıcı kullanıcı bulunamadı'})
+        elif to_email == sender['email']:
+            results.append({'status': 'error', 'error': 'Kendinize para gönderemezsiniz'})
+        else:
+            results.append({'status': 'ok'})
+            total += amount_minor
+            credits.append((amount_minor, receiver_id, description, remote.get(to_email)))
+
+    if not credits:
+        return {'results': results, 'total': 0, 'new_balance': _user_balance(cursor, from_user_id)}
+
+    _debit_user(cursor, from_user_id, total, 'Yetersiz bakiye')
+    local = [(amount_minor, receiver_id) for amount_minor, receiver_id, _, receiver in credits if receiver is None]
+    cursor.executemany('UPDATE users SET balance_minor = balance_minor + ? WHERE id = ?', local)
+    transfer_ids = [_queue_remote_credit(cursor, from_user_id, sender['email'], receiver, amount_minor, description)
+                    for amount_minor, _, description, receiver in credits if receiver is not None]
+
+    # Balances were moved in bulk; replay the batch in order for each row's running balances
+    cursor.execute('SELECT id, balance_minor FROM users WHERE id IN (SELECT value FROM json_each(?))',
+                   (json.dumps(sorted({receiver_id for _, receiver_id in local})),))
+    received = {row['id']: row['balance_minor'] for row in cursor.fetchall()}
+    for amount_minor, receiver_id in local:
+        received[receiver_id] -= amount_minor
+    sender_balance = _user_balance(cursor, from_user_id) + total
+
+    created_at = statements.now()
+    postings = []
+    totals_in = {}
+    for amount_minor, receiver_id, description, receiver in credits:
+        sender_balance -= amount_minor
+        if receiver is not None:
+            # Credited on the receiver's shard, which records its balance there
+            postings.append((from_user_id, receiver_id, amount_minor, 'transfer', description, created_at,
+                             sender_balance, None))
+            continue
+        received[receiver_id] += amount_minor
+        postings.append((from_user_id, receiver_id, amount_minor, 'transfer', description, created_at,
+                         sender_balance, received[receiver_id]))
+        in_minor, count = totals_in.get(receiver_id, (0, 0))
+        totals_in[receiver_id] = (in_minor + amount_minor, count + 1)
+    cursor.executemany('''
+        INSERT INTO transactions (from_user_id, to_user_id, amount_minor, type, description, created_at,
+                                  from_balance_after, to_balance_after)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', postings)
+    last_id = cursor.execute('SELECT last_insert_rowid()').fetchone()[0]
+    events.transactions(cursor, last_id - len(postings) + 1, last_id)
+    statements.record(cursor, [(from_user_id, created_at, money.BALANCE_CURRENCY, 0, total, len(credits))] +
+                      [(receiver_id, created_at, money.BALANCE_CURRENCY, in_minor, 0, count)
+                       for receiver_id, (in_minor, count) in totals_in.items()])
+
+    return {'results': results, 'total': total, 'new_balance': sender_balance, 'transfer_ids': transfer_ids}
@@ -0,0 +1,288 @@
+"""Request and SQL instrumentation, exported in Prometheus text format.
+
+Each worker keeps its own counters in memory:
+
+* per-endpoint latency histograms, status counts and an in-flight gauge,
+  recorded by before/after/teardown request hooks;
+* per-statement call count, total time and rows returned, recorded by
+  the Connection/Cursor subclasses that db.connect() uses.
+
+About once a second (and on every /metrics scrape) a worker writes a
+snapshot to METRICS_DIR/<pid>.json; /metrics merges the snapshots of all
+workers, so any worker can answer a scrape for the whole server. The
+snapshots of exited workers stay, so the merged counters never go back;
+only those written before this run started (METRICS_SINCE, set by the
+gunicorn master in gunicorn.conf.py) are removed when a worker starts.
+
+With SLOW_QUERY_MS set, statements slower than that are logged together
+with their EXPLAIN QUERY PLAN.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from flask import g, request
+
+ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(
+    '/tmp' if os.path.exists('/tmp') else '.', 'paypal_mvp_metrics')
+FLUSH_SECONDS = 1.0
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))
+# Start of this run: the master's start under gunicorn, else this process's
+SINCE = float(os.environ.get('METRICS_SINCE') or time.time())
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_log = logging.getLogger('paypal_mvp.slow_query')
+
+_lock = threading.Lock()
+_requests = {}    # (endpoint, method) -> [bucket counts..., sum, count]
+_statuses = {}    # (endpoint, method, status) -> count
+_queries = {}     # normalised sql -> [calls, seconds, rows]
+_normalised = {}  # raw sql -> normalised sql
+_in_flight = 0
+_last_flush = 0.0
+
+
+def _query_stats(sql):
+    key = _normalised.get(sql)
+    if key is None:
+        key = _normalised[sql] = ' '.join(sql.split())
+    stats = _queries.get(key)
+    if stats is None:
+        stats = _queries.setdefault(key, [0, 0.0, 0])
+    return stats
+
+
+def _explain(conn, sql, params):
+    try:
+        return [row[3] for row in sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, params)]
+    except sqlite3.Error:
+        return []
+
+
+def _record_query(cursor, sql, params, elapsed, rows):
+    stats = _query_stats(sql)
+    with _lock:
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += rows
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_log.warning('slow query %.1fms: %s plan=%s', elapsed * 1000, ' '.join(sql.split()),
+                         _explain(cursor.connection, sql, params))
+    return stats
+
+
+class Cursor(sqlite3.Cursor):
+    _stats = None
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        result = super().execute(sql, params)
+        # Rows fetched later are added to the same statement by the fetch* methods
+        self._stats = _record_query(self, sql, params, time.perf_counter() - start, max(self.rowcount, 0))
+        return result
+
+    def executemany(self, sql, seq_of_params):
+        start = time.perf_counter()
+        result = super().executemany(sql, seq_of_params)
+        _record_query(self, sql, (), time.perf_counter() - start, max(self.rowcount, 0))
+        return result
+
+    def _fetched(self, start, rows):
+        stats = self._stats
+        if stats is not None:
+            with _lock:
+                stats[1] += time.perf_counter() - start
+                stats[2] += rows
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(size if size is not None else self.arraysize)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+
+class Connection(sqlite3.Connection):
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    # The C-level Connection.execute() never reaches Cursor.execute; route it through one
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def _before_request():
+    global _in_flight
+    g.metrics_start = time.perf_counter()
+    g.metrics_in_flight = True
+    with _lock:
+        _in_flight += 1
+
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    key = (endpoint, request.method)
+    with _lock:
+        hist = _requests.get(key)
+        if hist is None:
+            hist = _requests[key] = [0] * len(BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                hist[i] += 1
+        hist[-2] += elapsed
+        hist[-1] += 1
+        status_key = key + (response.status_code,)
+        _statuses[status_key] = _statuses.get(status_key, 0) + 1
+    maybe_flush()
+    return response
+
+
+def _teardown_request(error=None):
+    global _in_flight
+    if g.pop('metrics_in_flight', False):
+        with _lock:
+            _in_flight -= 1
+
+
+def _snapshot():
+    with _lock:
+        return {
+            'requests': [[list(k), list(v)] for k, v in _requests.items()],
+            'statuses': [[list(k), v] for k, v in _statuses.items()],
+            'queries': [[k, list(v)] for k, v in _queries.items()],
+            'in_flight': _in_flight,
+        }
+
+
+def flush():
+    global _last_flush
+    _last_flush = time.monotonic()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(_snapshot(), f)
+    os.replace(tmp, path)
+
+
+def maybe_flush():
+    if time.monotonic() - _last_flush >= FLUSH_SECONDS:
+        flush()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _collect():
+    requests, statuses, queries = {}, {}, {}
+    in_flight = 0
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for key, values in snap['requests']:
+            merged = requests.setdefault(tuple(key), [0] * len(values))
+            for i, v in enumerate(values):
+                merged[i] += v
+        for key, count in snap['statuses']:
+            statuses[tuple(key)] = statuses.get(tuple(key), 0) + count
+        for sql, values in snap['queries']:
+            merged = queries.setdefault(sql, [0, 0.0, 0])
+            for i, v in enumerate(values):
+                merged[i] += v
+        # Counters of exited workers still count; their in-flight gauge does not
+        if _alive(int(name[:-5])):
+            in_flight += snap['in_flight']
+    return requests, statuses, queries, in_flight
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    flush()
+    requests, statuses, queries, in_flight = _collect()
+    out = [
+        '# HELP http_request_duration_seconds Request latency by endpoint.',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for (endpoint, method), values in sorted(requests.items()):
+        labels = f'endpoint="{_label(endpoint)}",method="{method}"'
+        for bound, count in zip(BUCKETS, values):
+            out.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+        out.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {values[-1]}')
+        out.append(f'http_request_duration_seconds_sum{{{labels}}} {values[-2]}')
+        out.append(f'http_request_duration_seconds_count{{{labels}}} {values[-1]}')
+
+    out += ['# HELP http_requests_total Responses by endpoint and status.', '# TYPE http_requests_total counter']
+    for (endpoint, method, status), count in sorted(statuses.items()):
+        out.append(f'http_requests_total{{endpoint="{_label(endpoint)}",method="{method}",status="{status}"}} {count}')
+
+    out += ['# HELP http_requests_in_flight Requests currently being served.', '# TYPE http_requests_in_flight gauge',
+            f'http_requests_in_flight {in_flight}']
+
+    for name, index, help_text in (('sqlite_query_calls_total', 0, 'Statement executions.'),
+                                   ('sqlite_query_seconds_total', 1, 'Time spent executing and fetching.'),
+                                   ('sqlite_query_rows_total', 2, 'Rows returned or changed.')):
+        out += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for sql, values in sorted(queries.items()):
+            out.append(f'{name}{{query="{_label(sql)}"}} {values[index]}')
+    return '\n'.join(out) + '\n'
+
+
+def _remove_stale_snapshots():
+    # Files left by workers of a previous run would otherwise be merged forever. A worker of
+    # this run that gunicorn replaced keeps its file: dropping its totals would read as a
+    # counter reset to Prometheus
+    if not os.path.isdir(METRICS_DIR):
+        return
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith('.json') and name[:-5].isdigit() and not _alive(int(name[:-5])):
+            path = os.path.join(METRICS_DIR, name)
+            try:
+                if os.path.getmtime(path) < SINCE:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def init_app(app):
+    _remove_stale_snapshots()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
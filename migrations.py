@@ -0,0 +1,339 @@
+"""Schema migrations keyed on PRAGMA user_version.
+
+MIGRATIONS is an ordered list of steps and a database's user_version is
+the number of them it has applied. Every gunicorn worker calls migrate()
+at startup; on an up-to-date database that is a single pragma read. When
+steps are pending, the first worker takes an exclusive lock file next to
+the database and applies them while the others block on the same lock,
+then find the version already current.
+
+A schema step runs in one BEGIN IMMEDIATE transaction that also bumps
+user_version, so it is applied completely or not at all. Rewriting rows
+is left to batched steps: a schema step schedules one by writing a
+migration_progress row (next position and last id), and the batched step
+then works through the id range MIGRATION_BATCH_SIZE ids per short
+transaction, committing its position with each batch and pausing in
+between so request writers get the write lock. A migration killed halfway
+resumes from the last committed batch on the next start.
+
+``python migrations.py`` applies pending steps to DATABASE and every
+shard without starting the app, e.g. ahead of a deploy.
+"""
+import contextlib
+import logging
+import os
+import sqlite3
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: BEGIN IMMEDIATE and the version re-check still serialise workers
+    fcntl = None
+
+import archive
+import db
+import events
+import idempotency
+import money
+import rates
+import sessions
+import sharding
+import statements
+
+BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', 5000))
+BATCH_PAUSE = float(os.environ.get('MIGRATION_BATCH_PAUSE_MS', 10)) / 1000
+
+logger = logging.getLogger('paypal_mvp.migrations')
+
+PROGRESS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS migration_progress (
+        name TEXT PRIMARY KEY,
+        position INTEGER NOT NULL,
+        last INTEGER NOT NULL
+    ) WITHOUT ROWID;
+'''
+
+
+class Step:
+    """Schema change applied in one transaction by apply(conn)."""
+
+    def __init__(self, name, apply):
+        self.name = name
+        self.apply = apply
+
+    def run(self, conn, version):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if _version(conn) == version:
+                self.apply(conn)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+class BatchedStep:
+    """Data rewrite over an id range scheduled by an earlier Step.
+
+    batch(conn, after, last) handles after < id <= last; finish(conn, last),
+    if given, runs in the transaction of the final batch. Nothing scheduled
+    means nothing to do, as on a database created by the current code.
+    """
+
+    def __init__(self, name, batch, finish=None):
+        self.name = name
+        self.batch = batch
+        self.finish = finish
+
+    def run(self, conn, version):
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if _version(conn) != version:
+                    conn.rollback()
+                    return
+                progress = conn.execute('SELECT position, last FROM migration_progress WHERE name = ?',
+                                        (self.name,)).fetchone()
+                done = progress is None
+                if not done:
+                    position, last = progress
+                    upto = min(position + BATCH_SIZE, last)
+                    self.batch(conn, position, upto)
+                    done = upto >= last
+                    if done:
+                        if self.finish:
+                            self.finish(conn, last)
+                        conn.execute('DELETE FROM migration_progress WHERE name = ?', (self.name,))
+                    else:
+                        conn.execute('UPDATE migration_progress SET position = ? WHERE name = ?',
+                                     (upto, self.name))
+                if done:
+                    conn.execute(f'PRAGMA user_version = {version + 1}')
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            if done:
+                return
+            if BATCH_PAUSE:
+                time.sleep(BATCH_PAUSE)
+
+
+def _version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def _execute_script(conn, script):
+    # executescript() would COMMIT first; run it statement by statement instead
+    statement = ''
+    for part in script.split(';'):
+        statement += part + ';'
+        if sqlite3.complete_statement(statement):
+            if statement.strip(' \n;'):
+                conn.execute(statement)
+            statement = ''
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _max_id(conn, table):
+    return conn.execute(f'SELECT coalesce(max(rowid), 0) FROM {table}').fetchone()[0]
+
+
+def _schedule(conn, name, last):
+    conn.execute('INSERT OR REPLACE INTO migration_progress (name, position, last) VALUES (?, 0, ?)',
+                 (name, last))
+
+
+# --- 1: base schema --------------------------------------------------------------
+
+def _create_base(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            balance_minor INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Cards (simulated) hold a USD balance
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            card_number TEXT NOT NULL,
+            card_holder TEXT NOT NULL,
+            card_type TEXT NOT NULL,
+            expiry TEXT NOT NULL,
+            cvv TEXT NOT NULL,
+            balance_usd_minor INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_user_id INTEGER,
+            to_user_id INTEGER,
+            from_card_id INTEGER,
+            to_card_id INTEGER,
+            amount_minor INTEGER NOT NULL,
+            currency TEXT DEFAULT 'TL',
+            type TEXT NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            from_balance_after INTEGER,
+            to_balance_after INTEGER,
+            FOREIGN KEY (from_user_id) REFERENCES users (id),
+            FOREIGN KEY (to_user_id) REFERENCES users (id),
+            FOREIGN KEY (from_card_id) REFERENCES cards (id),
+            FOREIGN KEY (to_card_id) REFERENCES cards (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS exchange_rates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            currency_code TEXT UNIQUE NOT NULL,
+            rate_to_usd REAL NOT NULL,
+            currency_name TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    for script in (PROGRESS_SCHEMA, rates.SCHEMA, sessions.SCHEMA, statements.SCHEMA, archive.SCHEMA,
+                   sharding.DIRECTORY_SCHEMA, sharding.SHARD_SCHEMA):
+        _execute_script(conn, script)
+
+    if conn.execute('SELECT count(*) FROM exchange_rates').fetchone()[0] == 0:
+        conn.executemany('INSERT INTO exchange_rates (currency_code, rate_to_usd, currency_name, symbol) '
+                         'VALUES (?, ?, ?, ?)', rates.DEFAULT_RATES)
+
+    # Indexes for the per-user lookups on the hot read paths
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_from_user ON transactions (from_user_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_to_user ON transactions (to_user_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cards_user ON cards (user_id)')
+
+
+# --- 2, 3: REAL money columns -> INTEGER minor units -----------------------------
+
+# table -> (legacy REAL column, minor-unit column, to_minor_sql keyword arguments)
+_MONEY_COLUMNS = {
+    'users': ('balance', 'balance_minor', {}),
+    'cards': ('balance_usd', 'balance_usd_minor', {'currency': money.CARD_CURRENCY}),
+    'transactions': ('amount', 'amount_minor', {'currency_column': 'currency'}),
+}
+
+
+def _add_minor_columns(conn):
+    # Databases created before minor-unit storage still have REAL money columns
+    if 'balance' not in _columns(conn, 'users'):
+        return
+    for table, (_, minor, _) in _MONEY_COLUMNS.items():
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {minor} INTEGER NOT NULL DEFAULT 0')
+    _schedule(conn, 'money_columns', max(_max_id(conn, table) for table in _MONEY_COLUMNS))
+
+
+def _convert_money(conn, after, last):
+    for table, (real, minor, kwargs) in _MONEY_COLUMNS.items():
+        conn.execute(f'UPDATE {table} SET {minor} = {money.to_minor_sql(real, **kwargs)} '
+                     f'WHERE rowid > ? AND rowid <= ?', (after, last))
+
+
+def _drop_real_columns(conn, last):
+    # Old workers keep writing the REAL columns until the step is done (new ones wait on the
+    # lock), so reconvert what they changed behind the batches: balances of any row, and the
+    # transactions they appended (they never update one). Then drop the columns themselves.
+    # DROP COLUMN rewrites each table: the one long write lock left (~0.5s per 1M rows)
+    for table, (real, minor, kwargs) in _MONEY_COLUMNS.items():
+        converted = money.to_minor_sql(real, **kwargs)
+        if table == 'transactions':
+            conn.execute(f'UPDATE {table} SET {minor} = {converted} WHERE rowid > ?', (last,))
+        else:
+            conn.execute(f'UPDATE {table} SET {minor} = {converted} WHERE {minor} IS NOT {converted}')
+    for table, (real, _, _) in _MONEY_COLUMNS.items():
+        conn.execute(f'ALTER TABLE {table} DROP COLUMN {real}')
+
+
+# --- 4, 5, 6: running balances and daily rollups ---------------------------------
+
+def _add_balance_columns(conn):
+    if 'from_balance_after' in _columns(conn, 'transactions'):
+        return
+    conn.execute('ALTER TABLE transactions ADD COLUMN from_balance_after INTEGER')
+    conn.execute('ALTER TABLE transactions ADD COLUMN to_balance_after INTEGER')
+    # Postings from here on record their own rollups; the batches add the history up to now
+    conn.execute('DELETE FROM daily_rollups')
+    _schedule(conn, 'anchor_balances', _max_id(conn, 'users'))
+    _schedule(conn, 'daily_rollups', _max_id(conn, 'transactions'))
+
+
+# --- 7: change feed ---------------------------------------------------------------
+
+def _create_events(conn):
+    _execute_script(conn, events.SCHEMA)
+
+
+# --- 8: idempotency keys -------------------------------------------------------
+
+def _create_idempotency_keys(conn):
+    _execute_script(conn, idempotency.SCHEMA)
+
+
+MIGRATIONS = [
+    Step('base', _create_base),
+    Step('money_columns', _add_minor_columns),
+    BatchedStep('money_columns', _convert_money, _drop_real_columns),
+    Step('balance_columns', _add_balance_columns),
+    BatchedStep('anchor_balances', statements.anchor_balances),
+    BatchedStep('daily_rollups', statements.add_rollups),
+    Step('events', _create_events),
+    Step('idempotency_keys', _create_idempotency_keys),
+]
+
+
+@contextlib.contextmanager
+def _lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.migrate-lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def migrate(conn, path=None, log=logger.info):
+    """Apply the pending MIGRATIONS to the database behind conn (at path).
+
+    Returns the number of steps this call applied; 0 when the database
+    was current or another process applied them while this one waited.
+    """
+    if _version(conn) >= len(MIGRATIONS):
+        return 0
+    applied = 0
+    with _lock(path or db.DATABASE):
+        started, first = time.perf_counter(), _version(conn)
+        while (version := _version(conn)) < len(MIGRATIONS):
+            MIGRATIONS[version].run(conn, version)
+            applied += 1
+        if applied:
+            log(f'migrated {path or db.DATABASE} from version {first} to {len(MIGRATIONS)} '
+                f'in {time.perf_counter() - started:.2f}s')
+    return applied
+
+
+if __name__ == '__main__':
+    paths = [db.DATABASE] + (sharding.database_paths() if sharding.ENABLED else [])
+    if sharding.ENABLED:
+        os.makedirs(sharding.SHARD_DIR, exist_ok=True)
+    for path in paths:
+        conn = db.connect(path)
+        migrate(conn, path, log=print)
+        conn.close()
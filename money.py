@@ -0,0 +1,91 @@
+"""Integer minor-unit money.
+
+Balances and transaction amounts are stored as INTEGER minor units
+(kuruş, cents, ...) so SUMs in SQLite are exact. Request amounts are
+converted once at the edge with to_minor(); conversions between
+currencies use integer math on pre-scaled rates (see rates.RateTable),
+so the hot path never builds Decimal objects.
+"""
+import math
+
+# Digits after the decimal point; everything not listed uses 2
+EXPONENTS = {'JPY': 0, 'KRW': 0}
+DEFAULT_EXPONENT = 2
+
+# User balances are held in TL; card balances in USD
+BALANCE_CURRENCY = 'TL'
+CARD_CURRENCY = 'USD'
+
+# Rates are kept as integers scaled by this factor
+RATE_SCALE = 10 ** 8
+
+
+def exponent(currency):
+    return EXPONENTS.get(currency, DEFAULT_EXPONENT)
+
+
+def to_minor(amount, currency=BALANCE_CURRENCY):
+    """Minor units for a request amount, or None if it is not a finite
+    number or has more decimals than the currency allows."""
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)):
+        return None
+    if isinstance(amount, int):
+        return amount * 10 ** exponent(currency)
+    if not math.isfinite(amount):
+        return None
+    scaled = amount * 10 ** exponent(currency)
+    minor = round(scaled)
+    if abs(scaled - minor) > 1e-6:
+        return None
+    return minor
+
+
+def from_minor(minor, currency=BALANCE_CURRENCY):
+    return minor / 10 ** exponent(currency)
+
+
+def format_amount(minor, currency=BALANCE_CURRENCY):
+    digits = exponent(currency)
+    return f'{minor / 10 ** digits:.{digits}f}'
+
+
+def from_minor_sql(column, currency=BALANCE_CURRENCY, currency_column=None):
+    """SQL expression computing from_minor() inside SQLite, for a fixed
+    currency or, with currency_column, each row's own currency."""
+    if currency_column is None:
+        return f'({column} / {10 ** exponent(currency)}.0)'
+    whens = ' '.join(f"WHEN '{code}' THEN {10 ** exp}.0" for code, exp in EXPONENTS.items())
+    return f'({column} / CASE {currency_column} {whens} ELSE {10 ** DEFAULT_EXPONENT}.0 END)'
+
+
+def _div_round(num, den):
+    # Round half to even, integers only
+    q, r = divmod(num, den)
+    twice = 2 * r
+    if twice > den or (twice == den and q % 2):
+        q += 1
+    return q
+
+
+def rescale(minor, from_currency, to_currency):
+    """Same numeric amount expressed in another currency's minor units."""
+    shift = exponent(to_currency) - exponent(from_currency)
+    if shift >= 0:
+        return minor * 10 ** shift
+    return _div_round(minor, 10 ** -shift)
+
+
+def convert(minor, from_currency, to_currency, scaled_rates):
+    """Convert minor units via USD using integer rates scaled by RATE_SCALE."""
+    num = minor * scaled_rates[to_currency] * 10 ** exponent(to_currency)
+    den = scaled_rates[from_currency] * 10 ** exponent(from_currency)
+    return _div_round(num, den)
+
+
+def to_minor_sql(column, currency=BALANCE_CURRENCY, currency_column=None):
+    """SQL expression rounding a legacy REAL amount column to integer minor
+    units, for a fixed currency or, with currency_column, each row's own."""
+    if currency_column is None:
+        return f'CAST(ROUND({column} * {10 ** exponent(currency)}) AS INTEGER)'
+    whens = ' '.join(f"WHEN '{code}' THEN {10 ** exp}" for code, exp in EXPONENTS.items())
+    return f'CAST(ROUND({column} * CASE {currency_column} {whens} ELSE {10 ** DEFAULT_EXPONENT} END) AS INTEGER)'
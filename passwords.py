@@ -0,0 +1,114 @@
+"""Password hashing.
+
+Hashes are salted scrypt, stored as ``scrypt$n$r$p$salt$hash`` so the
+cost parameters travel with each hash and can be raised later; stored
+hashes with older parameters (or the legacy unsalted SHA-256 hex) are
+upgraded on the next successful login.
+
+The KDF is deliberately expensive, so it runs on a small bounded thread
+pool (hashlib releases the GIL while hashing). When more than
+KDF_MAX_PENDING hashes are already queued, new ones are refused with
+PasswordPoolBusy instead of piling up behind each other, so a login
+storm cannot eat every worker thread.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+SCRYPT_N = int(os.environ.get('SCRYPT_N', 2 ** 14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+KDF_WORKERS = int(os.environ.get('KDF_WORKERS', 2))
+KDF_MAX_PENDING = int(os.environ.get('KDF_MAX_PENDING', 16))
+KDF_TIMEOUT = float(os.environ.get('KDF_TIMEOUT', 5))
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode()
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r, dklen=KEY_BYTES)
+
+
+def _hash(password):
+    salt = secrets.token_bytes(SALT_BYTES)
+    key = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(key)}'
+
+
+def _verify(password, stored):
+    if stored.startswith('scrypt$'):
+        _, n, r, p, salt, key = stored.split('$')
+        candidate = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+        return hmac.compare_digest(candidate, base64.b64decode(key))
+    # Legacy: unsalted SHA-256 hex digest
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+
+
+def needs_rehash(stored):
+    return not stored.startswith(f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$')
+
+
+# Verifying against this keeps unknown-email logins as slow as real ones
+_DUMMY_HASH = None
+
+_executor = None
+_slots = None
+_pid = None
+_pool_lock = threading.Lock()
+
+
+def _pool():
+    global _executor, _slots, _pid
+    # Threads do not survive gunicorn's fork; build the pool per worker, once
+    if _pid != os.getpid():
+        with _pool_lock:
+            if _pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=KDF_WORKERS, thread_name_prefix='kdf')
+                _slots = threading.BoundedSemaphore(KDF_WORKERS + KDF_MAX_PENDING)
+                _pid = os.getpid()
+    return _executor, _slots
+
+
+def _submit(fn, *args):
+    executor, slots = _pool()
+    if not slots.acquire(blocking=False):
+        raise PasswordPoolBusy()
+    try:
+        future = executor.submit(fn, *args)
+    except BaseException:
+        slots.release()
+        raise
+    # Release the semaphore this call acquired
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=KDF_TIMEOUT)
+    except FutureTimeout:
+        raise PasswordPoolBusy()
+
+
+def hash_password(password):
+    return _submit(_hash, password)
+
+
+def verify_password(password, stored):
+    global _DUMMY_HASH
+    if stored is None:
+        if _DUMMY_HASH is None:
+            _DUMMY_HASH = _submit(_hash, secrets.token_hex(8))
+        _submit(_verify, password, _DUMMY_HASH)
+        return False
+    return _submit(_verify, password, stored)
@@ -0,0 +1,139 @@
+"""Group commit for balance mutations.
+
+With WRITE_PIPELINE=1 every ledger posting in a worker is handed to one
+writer thread instead of committing on the request thread. The writer
+takes whatever queued up while the previous batch was committing (up to
+WRITE_PIPELINE_MAX_BATCH commands, optionally waiting
+WRITE_PIPELINE_LINGER_MS for stragglers), runs each command
+under its own SAVEPOINT inside a single BEGIN IMMEDIATE transaction and
+commits once. A command that raises is rolled back to its savepoint and
+fails alone; the others still commit.
+
+A request waits at most WRITE_PIPELINE_TIMEOUT seconds for its command.
+One the writer has not picked up by then is withdrawn and the request
+fails with PipelineTimeout (503), so it is never applied behind the
+client's back. The writer survives failures to connect or commit by
+failing that batch, and submit() restarts it if it died anyway.
+
+Batching only happens when several requests are in flight in the same
+worker, so run gunicorn with threads (``--worker-class gthread
+--threads N``) when enabling it.
+"""
+import os
+import queue
+import threading
+import time
+
+import db
+import ledger
+
+ENABLED = os.environ.get('WRITE_PIPELINE', '0') == '1'
+MAX_BATCH = int(os.environ.get('WRITE_PIPELINE_MAX_BATCH', 64))
+LINGER = float(os.environ.get('WRITE_PIPELINE_LINGER_MS', 0)) / 1000
+TIMEOUT = float(os.environ.get('WRITE_PIPELINE_TIMEOUT', 10))
+
+
+class PipelineTimeout(Exception):
+    pass
+
+
+class _Command:
+    __slots__ = ('posting', 'args', 'result', 'error', 'done', 'state')
+
+    def __init__(self, posting, args):
+        self.posting = posting
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        # 'queued', then 'claimed' by the writer or 'withdrawn' by a request that gave up
+        self.state = 'queued'
+
+
+def _apply_batch(cursor, batch):
+    for cmd in batch:
+        cursor.execute('SAVEPOINT command')
+        try:
+            cmd.result = cmd.posting(cursor, *cmd.args)
+        except Exception as e:
+            cursor.execute('ROLLBACK TO command')
+            cmd.error = e
+        cursor.execute('RELEASE command')
+
+
+class WritePipeline:
+    def __init__(self, max_batch=MAX_BATCH, linger=LINGER, path=None, timeout=TIMEOUT):
+        self.max_batch = max_batch
+        self.linger = linger
+        self.path = path
+        self.timeout = timeout
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.commits = 0
+        self.commands = 0
+
+    def _start(self):
+        # The writer thread does not survive gunicorn's fork; start one per worker,
+        # and again should it ever die
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ledger-writer', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def submit(self, posting, args):
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            self._start()
+        cmd = _Command(posting, args)
+        self._queue.put(cmd)
+        if not cmd.done.wait(self.timeout):
+            with self._lock:
+                withdrawn = cmd.state == 'queued'
+                if withdrawn:
+                    cmd.state = 'withdrawn'
+            # A claimed command is being committed; its outcome is only a moment away
+            if withdrawn or not cmd.done.wait(self.timeout):
+                raise PipelineTimeout()
+        if cmd.error is not None:
+            raise cmd.error
+        return cmd.result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        with self._lock:
+            batch = [cmd for cmd in batch if cmd.state == 'queued']
+            for cmd in batch:
+                cmd.state = 'claimed'
+        return batch
+
+    def _run(self):
+        conn = None
+        while True:
+            batch = self._collect()
+            if not batch:
+                continue
+            try:
+                if conn is None:
+                    conn = db.connect(self.path)
+                ledger.run_posting(conn, _apply_batch, batch)
+                self.commits += 1
+                self.commands += len(batch)
+            except BaseException as e:
+                # The connect or the commit failed, so nothing in the batch was applied
+                for cmd in batch:
+                    cmd.result, cmd.error = None, e
+                if not isinstance(e, Exception):
+                    raise
+            finally:
+                for cmd in batch:
+                    cmd.done.set()
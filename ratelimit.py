@@ -0,0 +1,324 @@
+"""Per-route rate limits and transfer velocity checks, shared by all workers.
+
+LIMITS lists the rules of each endpoint; RATE_LIMITS (JSON, endpoint ->
+list of rule specs) replaces the rules of the endpoints it names. A spec
+is "<scope> <limit>/<seconds>" for a token bucket or "<scope> <measure>
+<limit>/<seconds>" for a sliding window:
+
+* scope is 'ip' (the client address, see TRUSTED_PROXIES), 'email' (the
+  email in the request body, for login attempts per account) or 'user'
+  (the signed-in user);
+* a token bucket lets <limit> requests through at once and refills at
+  <limit> per <seconds>; buckets are per endpoint;
+* a window counts 'transfers' or their 'amount' (in TL) over the last
+  <seconds>; windows with the same measure and length are shared by every
+  route that declares them, so a sender's single and batch transfers add
+  up. Transfers that fail (any 4xx/5xx response) or are replayed for a
+  repeated Idempotency-Key are given back. A request that alone costs
+  more than a window's limit is refused with a 400, as no wait lets it
+  through.
+
+The defaults only throttle request rates. Velocity windows depend on who
+the customers are, so they are opt-in, e.g.
+
+    RATE_LIMITS='{"send_money": ["ip 120/60", "user 30/60", "user amount 50000/3600"],
+                  "send_money_batch": ["ip 20/60", "user 5/60", "user amount 5000000/86400"]}'
+
+A batch route's transfer window should allow at least MAX_BATCH_ITEMS
+(app.py), or the largest batches can never be sent.
+
+The limits are off unless RATE_LIMIT_ENABLED=1 or TRUSTED_PROXIES is set:
+behind a load balancer (Render, Railway, Heroku: TRUSTED_PROXIES=1) the
+socket address is the balancer's, and the ip rules would throttle every
+client as one. Run without a proxy with TRUSTED_PROXIES=0.
+
+ip and email rules run before the view, user rules as soon as
+login_required has resolved the token, which its cache normally answers
+without a query; a rejected request never reaches SQLite.
+
+State lives in a memory-mapped file (RATE_LIMIT_FILE) that every worker
+maps, not in the database: a fixed-size hash table of SLOTS slots in
+buckets of BUCKET_SLOTS, each bucket guarded by a thread lock in this
+worker and an fcntl byte-range lock across workers. A full bucket evicts
+its least recently touched key. The file only holds counters; deleting
+it resets them.
+"""
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: the thread locks still serialise a single worker
+    fcntl = None
+
+from flask import g, jsonify, request
+
+import money
+
+# Proxies in front of the app that append to X-Forwarded-For (0: use the socket address)
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+# Off until TRUSTED_PROXIES is set: behind an unconfigured proxy every client would share its address
+ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1' if 'TRUSTED_PROXIES' in os.environ else '0') == '1'
+RATE_LIMIT_FILE = os.environ.get('RATE_LIMIT_FILE') or os.path.join(
+    '/tmp' if os.path.exists('/tmp') else '.', 'paypal_mvp_ratelimit')
+
+SLOTS = int(os.environ.get('RATE_LIMIT_SLOTS', 2 ** 16))
+BUCKET_SLOTS = 8
+STRIPES = 256
+
+LIMITS = {
+    'login': ['ip 20/60', 'email 10/300'],
+    'register': ['ip 5/60'],
+    'send_money': ['ip 120/60', 'user 30/60'],
+    'send_money_batch': ['ip 20/60', 'user 5/60'],
+}
+LIMITS.update(json.loads(os.environ.get('RATE_LIMITS') or '{}'))
+
+TOO_MANY = 'Çok fazla istek, lütfen biraz sonra tekrar deneyin'
+OVER_LIMIT = 'Transfer limitinize ulaştınız, lütfen daha sonra tekrar deneyin'
+ABOVE_LIMIT = 'Bu işlem tek başına transfer limitinizi aşıyor'
+
+# key hash, last touched, three floats of rule state
+_SLOT = struct.Struct('<Qdddd')
+
+
+class SharedTable:
+    """Fixed-size hash table of rule state in a shared memory-mapped file."""
+
+    def __init__(self, path, slots=SLOTS):
+        self.buckets = max(slots // BUCKET_SLOTS, 1)
+        size = self.buckets * BUCKET_SLOTS * _SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._locks = [threading.Lock() for _ in range(STRIPES)]
+
+    def update(self, key, apply, now):
+        """Run apply(state, now) -> (state, result) on key's state under its lock.
+
+        state is a tuple of three floats, all 0.0 for a key not seen before.
+        """
+        bucket = key % self.buckets
+        stripe = bucket % STRIPES
+        base = bucket * BUCKET_SLOTS * _SLOT.size
+        with self._locks[stripe]:
+            if fcntl:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                found = free = None
+                oldest = math.inf
+                for i in range(BUCKET_SLOTS):
+                    offset = base + i * _SLOT.size
+                    slot_key, touched, *state = _SLOT.unpack_from(self._map, offset)
+                    if slot_key == key:
+                        found = offset
+                        break
+                    if touched < oldest:
+                        free, oldest = offset, touched
+                if found is None:
+                    found, state = free, (0.0, 0.0, 0.0)
+                state, result = apply(tuple(state), now)
+                _SLOT.pack_into(self._map, found, key, now, *state)
+                return result
+            finally:
+                if fcntl:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+
+
+class TokenBucket:
+    """limit requests at once, refilled at limit per seconds.
+
+    Kept as the time the bucket will be full again (GCRA), so the state is
+    one float and an unseen key (0.0) is a full bucket.
+    """
+
+    message = TOO_MANY
+
+    def __init__(self, scope, limit, seconds):
+        self.scope = scope
+        self.limit = limit
+        self.seconds = seconds
+        self.interval = seconds / limit
+
+    def key(self, endpoint, value):
+        return f'{endpoint}|{self.scope}={value}|{self.limit}/{self.seconds}'
+
+    def charge(self, state, now, cost):
+        full_at = max(state[0], now) + self.interval * cost
+        if full_at - now > self.seconds:
+            return state, full_at - now - self.seconds
+        return (full_at, 0.0, 0.0), None
+
+    def refund(self, state, now, cost):
+        return state, None
+
+
+class SlidingWindow:
+    """At most limit transfers (or TL amount) over the last seconds.
+
+    The previous fixed window's total is weighted by how much of it still
+    overlaps the sliding one, so a key needs three floats: the current
+    window's index, its total and the previous window's total.
+    """
+
+    message = OVER_LIMIT
+
+    def __init__(self, scope, measure, limit, seconds):
+        self.scope = scope
+        self.measure = measure
+        self.limit = money.to_minor(limit, 'TL') if measure == 'amount' else limit
+        self.seconds = seconds
+
+    def key(self, endpoint, value):
+        return f'{self.measure}|{self.scope}={value}|{self.seconds}'
+
+    def _roll(self, state, now):
+        window = now // self.seconds
+        index, current, previous = state
+        if window == index + 1:
+            return window, 0.0, current
+        if window != index:
+            return window, 0.0, 0.0
+        return state
+
+    def charge(self, state, now, cost):
+        if cost > self.limit:
+            return state, math.inf
+        window, current, previous = self._roll(state, now)
+        overlap = 1 - (now % self.seconds) / self.seconds
+        if previous * overlap + current + cost > self.limit:
+            room = self.limit - current - cost
+            if room < 0 or not previous:
+                wait = self.seconds - now % self.seconds
+            else:
+                # until enough of the previous window has slid out
+                wait = (1 - room / previous) * self.seconds - now % self.seconds
+            return (window, current, previous), max(wait, 0.001)
+        return (window, current + cost, previous), None
+
+    def refund(self, state, now, cost):
+        window, current, previous = self._roll(state, now)
+        if window == state[0]:
+            current = max(current - cost, 0.0)
+        return (window, current, previous), None
+
+
+def parse(spec):
+    *names, rate = spec.split()
+    limit, seconds = rate.split('/')
+    if len(names) == 1:
+        return TokenBucket(names[0], int(limit), float(seconds))
+    return SlidingWindow(names[0], names[1], float(limit), float(seconds))
+
+
+RULES = {endpoint: [parse(spec) for spec in specs] for endpoint, specs in LIMITS.items()}
+
+_table = None
+_table_pid = None
+_table_lock = threading.Lock()
+
+
+def table():
+    global _table, _table_pid
+    # Opened after gunicorn's fork; one descriptor per process, as closing any would drop its fcntl locks
+    if _table_pid != os.getpid():
+        with _table_lock:
+            if _table_pid != os.getpid():
+                _table, _table_pid = SharedTable(RATE_LIMIT_FILE), os.getpid()
+    return _table
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+
+def client_ip():
+    if TRUSTED_PROXIES:
+        route = request.access_route
+        return route[max(len(route) - TRUSTED_PROXIES, 0)]
+    return request.remote_addr
+
+
+def _body():
+    body = request.get_json(silent=True)
+    return body if isinstance(body, dict) else {}
+
+
+def _scope_value(scope):
+    if scope == 'ip':
+        return client_ip()
+    if scope == 'email':
+        email = _body().get('email')
+        return email.strip().lower() if isinstance(email, str) else None
+    return g.get('user_id')
+
+
+def _cost(rule):
+    if isinstance(rule, TokenBucket):
+        return 1
+    items = _body().get('items')
+    transfers = items if isinstance(items, list) else [_body()]
+    if rule.measure == 'transfers':
+        return len(transfers)
+    amounts = [money.to_minor(item.get('amount'), 'TL') if isinstance(item, dict) else None
+               for item in transfers]
+    # Malformed amounts are rejected by the view; they move nothing
+    return sum(amount for amount in amounts if amount and amount > 0)
+
+
+def check(scopes):
+    """Charge the rules of this request's endpoint in the given scopes.
+
+    Returns a 429 response if one of them is over its limit, a 400 if the
+    request alone costs more than a limit, else None.
+    """
+    rules = RULES.get(request.endpoint)
+    if not rules:
+        return None
+    now = time.time()
+    charges = g.setdefault('ratelimit_charges', [])
+    for rule in rules:
+        if rule.scope not in scopes:
+            continue
+        value = _scope_value(rule.scope)
+        if value is None:
+            continue
+        key, cost = _hash(rule.key(request.endpoint, value)), _cost(rule)
+        retry_after = table().update(key, lambda state, now: rule.charge(state, now, cost), now)
+        if retry_after == math.inf:
+            return jsonify({'error': ABOVE_LIMIT}), 400
+        if retry_after is not None:
+            response = jsonify({'error': rule.message})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(retry_after))
+            return response
+        charges.append((rule, key, cost))
+    return None
+
+
+def _before_request():
+    return check(('ip', 'email'))
+
+
+def _after_request(response):
+    # A failed transfer moved no money, nor did a replayed one (see idempotency.py);
+    # give their share of the windows back
+    charges = g.pop('ratelimit_charges', None)
+    if charges and (response.status_code >= 400 or 'Idempotent-Replayed' in response.headers):
+        now = time.time()
+        for rule, key, cost in charges:
+            if isinstance(rule, SlidingWindow):
+                table().update(key, lambda state, now: rule.refund(state, now, cost), now)
+    return response
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
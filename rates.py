@@ -0,0 +1,112 @@
+"""Per-worker exchange rate cache.
+
+The rate table is read once per worker and kept in memory together with
+the pre-rendered /api/exchange-rates body, its ETag and the cross-rate
+matrix used for conversions and quotes. Triggers on
+exchange_rates bump exchange_rates_version on every change; the cache
+compares that counter at most every REFRESH_SECONDS and reloads when it
+moved.
+"""
+import hashlib
+import json
+import os
+import time
+from decimal import Decimal
+
+import money
+
+REFRESH_SECONDS = float(os.environ.get('RATES_REFRESH_SECONDS', 5))
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS exchange_rates_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO exchange_rates_version (id, version) VALUES (1, 0);
+    CREATE TRIGGER IF NOT EXISTS exchange_rates_bump_insert AFTER INSERT ON exchange_rates
+    BEGIN UPDATE exchange_rates_version SET version = version + 1 WHERE id = 1; END;
+    CREATE TRIGGER IF NOT EXISTS exchange_rates_bump_update AFTER UPDATE ON exchange_rates
+    BEGIN UPDATE exchange_rates_version SET version = version + 1 WHERE id = 1; END;
+    CREATE TRIGGER IF NOT EXISTS exchange_rates_bump_delete AFTER DELETE ON exchange_rates
+    BEGIN UPDATE exchange_rates_version SET version = version + 1 WHERE id = 1; END;
+'''
+
+
+# Seeded into an empty exchange_rates table by the first migration
+DEFAULT_RATES = [
+    ('USD', 1.0, 'US Dollar', '$'),
+    ('EUR', 0.92, 'Euro', '€'),
+    ('GBP', 0.79, 'British Pound', '£'),
+    ('JPY', 149.50, 'Japanese Yen', '¥'),
+    ('CHF', 0.88, 'Swiss Franc', 'Fr'),
+    ('CAD', 1.35, 'Canadian Dollar', 'C$'),
+    ('AUD', 1.52, 'Australian Dollar', 'A$'),
+    ('TRY', 34.50, 'Turkish Lira', '₺'),
+    ('CNY', 7.24, 'Chinese Yuan', '¥'),
+    ('RUB', 92.50, 'Russian Ruble', '₽'),
+    ('SAR', 3.75, 'Saudi Riyal', '﷼'),
+    ('AED', 3.67, 'UAE Dirham', 'د.إ'),
+    ('INR', 83.12, 'Indian Rupee', '₹'),
+    ('BRL', 4.97, 'Brazilian Real', 'R$'),
+    ('KRW', 1305.50, 'South Korean Won', '₩'),
+    ('MXN', 17.15, 'Mexican Peso', '$'),
+    ('SEK', 10.35, 'Swedish Krona', 'kr'),
+    ('NOK', 10.52, 'Norwegian Krone', 'kr'),
+    ('DKK', 6.87, 'Danish Krone', 'kr'),
+    ('PLN', 4.02, 'Polish Zloty', 'zł'),
+]
+
+
+class RateTable:
+    def __init__(self, version, rows):
+        self.version = version
+        self.rates = {row['currency_code']: row['rate_to_usd'] for row in rows}
+        self.symbols = {row['currency_code']: row['symbol'] for row in rows}
+        # Exact integer rates for money.convert(); Decimal only here, at load time
+        self.scaled = {code: int(Decimal(str(rate)) * money.RATE_SCALE)
+                       for code, rate in self.rates.items()}
+        # cross[a][b]: units of b per unit of a, via USD
+        self.cross = {
+            a: {b: rate_b / rate_a for b, rate_b in self.rates.items()}
+            for a, rate_a in self.rates.items()
+        }
+
+        body = {
+            row['currency_code']: {
+                'rate_to_usd': row['rate_to_usd'],
+                'currency_name': row['currency_name'],
+                'symbol': row['symbol']
+            } for row in rows
+        }
+        self.json = json.dumps(body, sort_keys=True, separators=(',', ':')).encode()
+        self.etag = hashlib.sha256(self.json).hexdigest()[:32]
+        self.checked_at = time.monotonic()
+
+
+_table = None
+
+
+def _version(conn):
+    return conn.execute('SELECT version FROM exchange_rates_version WHERE id = 1').fetchone()[0]
+
+
+def load(conn):
+    global _table
+    version = _version(conn)
+    rows = conn.execute('SELECT currency_code, rate_to_usd, currency_name, symbol '
+                        'FROM exchange_rates ORDER BY currency_code').fetchall()
+    _table = RateTable(version, rows)
+    return _table
+
+
+def current(conn):
+    """Return the cached RateTable, reloading it if exchange_rates changed."""
+    table = _table
+    if table is None:
+        return load(conn)
+    now = time.monotonic()
+    if now - table.checked_at >= REFRESH_SECONDS:
+        if _version(conn) != table.version:
+            return load(conn)
+        table.checked_at = now
+    return table
@@ -0,0 +1,375 @@
+"""Finance reports answered from a snapshot instead of the live tables.
+
+refresh() copies each live database file (DATABASE, or every shard with
+SHARDS set) into REPORTS_DIR with SQLite's online backup API and then,
+working on the copy only:
+
+* folds in the rows the archiver moved to month files (see archive.py),
+  so the copy holds the whole history;
+* blanks passwords, CVVs and card numbers and drops the tables reporting
+  never reads (sessions, idempotency keys, the change feed);
+* adds covering indexes for ad-hoc GROUP BYs over transactions and cards,
+  and fills the report_* aggregate tables the /api/reports routes read;
+* switches the file to a rollback journal and renames it over the previous
+  snapshot.
+
+The backup is a single step. A paged backup starts over whenever another
+connection writes between two steps, which on a live ledger is always; a
+single step holds one read transaction for as long as copying the pages
+takes. Writers carry on under WAL meanwhile, and everything slow happens
+on the copy.
+
+A published snapshot is never written again, so readers open it read-only
+and immutable (no locking at all) for the length of a request; a rename
+does not disturb readers of the previous file. Each snapshot records when
+its copy was taken, which the routes return as snapshot_at.
+
+A worker refreshes in a background thread when a report is asked for and
+the snapshot is older than REPORTS_MAX_AGE; a lock file keeps it to one
+build at a time across workers. The copies are taken at full priority,
+the work on them at REPORTS_NICE niceness. ``python reports.py`` (e.g.
+from cron) refreshes without the app. Analysts can
+point ad-hoc queries at the files in REPORTS_DIR (open them with
+?mode=ro) rather than at the live database.
+"""
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows: the thread lock still keeps a worker to one build
+    fcntl = None
+
+import archive
+import db
+import money
+import sharding
+import statements
+
+REPORTS_DIR = os.environ.get('REPORTS_DIR') or db.DATABASE + '-reports'
+MAX_AGE = int(os.environ.get('REPORTS_MAX_AGE', 300))
+NICE = int(os.environ.get('REPORTS_NICE', 19))
+# Report users, by email; nobody else may read the reports
+VIEWERS = {email.strip().lower() for email in os.environ.get('REPORT_VIEWERS', '').split(',') if email.strip()}
+MAX_DAYS = 366
+
+log = logging.getLogger('paypal_mvp.reports')
+
+# Created fresh in every snapshot, after the copy
+SCHEMA = '''
+    CREATE TABLE report_snapshot (
+        taken_at TEXT NOT NULL,
+        source TEXT NOT NULL,
+        archived_months INTEGER NOT NULL,
+        build_seconds REAL NOT NULL
+    );
+    CREATE TABLE report_daily (
+        day TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        type TEXT NOT NULL,
+        transactions INTEGER NOT NULL,
+        amount_minor INTEGER NOT NULL,
+        PRIMARY KEY (day, currency, type)
+    ) WITHOUT ROWID;
+    CREATE TABLE report_currencies (
+        currency TEXT PRIMARY KEY,
+        transactions INTEGER NOT NULL,
+        amount_minor INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE report_types (
+        type TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        transactions INTEGER NOT NULL,
+        amount_minor INTEGER NOT NULL,
+        PRIMARY KEY (type, currency)
+    ) WITHOUT ROWID;
+    CREATE TABLE report_card_types (
+        card_type TEXT NOT NULL,
+        direction TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        transactions INTEGER NOT NULL,
+        amount_minor INTEGER NOT NULL,
+        PRIMARY KEY (card_type, direction, currency)
+    ) WITHOUT ROWID;
+    CREATE TABLE report_cards (
+        card_type TEXT PRIMARY KEY,
+        currency TEXT NOT NULL,
+        cards INTEGER NOT NULL,
+        balance_minor INTEGER NOT NULL
+    ) WITHOUT ROWID;
+'''
+
+# Covering: the aggregates below, and the usual hand-written report
+# queries, read these instead of the wide transaction rows
+INDEXES = '''
+    CREATE INDEX report_transactions_day ON transactions (created_at, currency, type, amount_minor);
+    CREATE INDEX report_transactions_from_card ON transactions (from_card_id, currency, amount_minor)
+        WHERE from_card_id IS NOT NULL;
+    CREATE INDEX report_transactions_to_card ON transactions (to_card_id, currency, amount_minor)
+        WHERE to_card_id IS NOT NULL;
+    CREATE INDEX report_cards_type ON cards (card_type, balance_usd_minor);
+'''
+
+_SCRUB = '''
+    DROP TABLE IF EXISTS sessions;
+    DROP TABLE IF EXISTS idempotency_keys;
+    DROP TABLE IF EXISTS events;
+    UPDATE users SET password = '';
+    UPDATE cards SET cvv = '', card_number = substr(card_number, -4);
+'''
+
+# With shards a cross-shard transfer has a row on each side; only the
+# debit is counted (the credit has no sender balance)
+_SHARD_FILTER = '''
+    WHERE NOT (type = 'transfer' AND from_user_id IS NOT NULL AND from_balance_after IS NULL
+               AND to_balance_after IS NOT NULL)
+'''
+
+_AGGREGATES = '''
+    INSERT INTO report_daily
+    SELECT substr(created_at, 1, 10), coalesce(currency, '{balance}'), type, count(*), sum(amount_minor)
+    FROM transactions {where}
+    GROUP BY 1, 2, 3;
+
+    INSERT INTO report_currencies
+    SELECT currency, sum(transactions), sum(amount_minor) FROM report_daily GROUP BY currency;
+
+    INSERT INTO report_types
+    SELECT type, currency, sum(transactions), sum(amount_minor) FROM report_daily GROUP BY type, currency;
+
+    INSERT INTO report_card_types
+    SELECT c.card_type, 'out', coalesce(t.currency, '{balance}'), count(*), sum(t.amount_minor)
+    FROM transactions t JOIN cards c ON c.id = t.from_card_id
+    GROUP BY 1, 3;
+
+    INSERT INTO report_card_types
+    SELECT c.card_type, 'in', coalesce(t.currency, '{balance}'), count(*), sum(t.amount_minor)
+    FROM transactions t JOIN cards c ON c.id = t.to_card_id
+    GROUP BY 1, 3;
+
+    INSERT INTO report_cards
+    SELECT card_type, '{card}', count(*), sum(balance_usd_minor) FROM cards GROUP BY card_type;
+'''
+
+# name -> (query against one snapshot, number of leading key columns);
+# the other columns of rows with equal keys from different shards add up
+REPORTS = {
+    'currencies': ('SELECT currency, transactions, amount_minor FROM report_currencies', 1),
+    'types': ('SELECT type, currency, transactions, amount_minor FROM report_types', 2),
+    'card-types': ('SELECT card_type, direction, currency, transactions, amount_minor FROM report_card_types', 3),
+    'cards': ('SELECT card_type, currency, cards, balance_minor FROM report_cards', 2),
+    'daily': ('SELECT day, currency, type, transactions, amount_minor FROM report_daily '
+              'WHERE day BETWEEN :from AND :to', 3),
+}
+
+
+def _uri(path, **params):
+    query = '&'.join(f'{key}={value}' for key, value in params.items())
+    return f'{pathlib.Path(path).absolute().as_uri()}?{query}'
+
+
+def snapshot_paths():
+    return [os.path.join(REPORTS_DIR, os.path.basename(path)) for path in sharding.database_paths()]
+
+
+def age():
+    """Seconds since the oldest snapshot was published; inf if one is missing."""
+    try:
+        oldest = min(os.stat(path).st_mtime for path in snapshot_paths())
+    except FileNotFoundError:
+        return float('inf')
+    return time.time() - oldest
+
+
+def _fold_archive(conn):
+    """Copy the archived months' rows into the snapshot's transactions table."""
+    columns = [row[1] for row in conn.execute('PRAGMA main.table_info(transactions)')]
+    months = conn.execute('SELECT filename FROM archive_partitions ORDER BY month').fetchall()
+    for (filename,) in months:
+        conn.execute('ATTACH DATABASE ? AS archived', (_uri(os.path.join(archive.ARCHIVE_DIR, filename), mode='ro'),))
+        try:
+            archived = {row[1] for row in conn.execute('PRAGMA archived.table_info(transactions)')}
+            names = ', '.join(name for name in columns if name in archived)
+            # A half-archived row is in both places; the copy already has it
+            conn.execute(f'INSERT OR IGNORE INTO main.transactions ({names}) '
+                         f'SELECT {names} FROM archived.transactions')
+        finally:
+            conn.execute('DETACH DATABASE archived')
+    return len(months)
+
+
+def copy(source, scratch):
+    """Back source up into scratch in one step; returns when the copy was taken."""
+    if os.path.exists(scratch):
+        os.remove(scratch)
+    live = sqlite3.connect(source)
+    try:
+        live.execute('PRAGMA busy_timeout=5000')
+        conn = sqlite3.connect(scratch)
+        try:
+            taken_at = statements.now()
+            live.backup(conn)
+        finally:
+            conn.close()
+    finally:
+        live.close()
+    return taken_at
+
+
+def prepare(scratch, source, taken_at):
+    """Scrub the copy in scratch and add the indexes and report tables."""
+    started = time.perf_counter()
+    conn = sqlite3.connect(_uri(scratch, mode='rw'), uri=True, isolation_level=None)
+    try:
+        # A scratch file until it is renamed: no journal, no fsync per statement
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('PRAGMA secure_delete=ON')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.executescript(_SCRUB)
+        months = _fold_archive(conn)
+        conn.executescript(INDEXES)
+        conn.executescript(SCHEMA)
+        conn.executescript(_AGGREGATES.format(where=_SHARD_FILTER if sharding.ENABLED else '',
+                                              balance=money.BALANCE_CURRENCY, card=money.CARD_CURRENCY))
+        conn.execute('PRAGMA analysis_limit=1000')
+        conn.execute('ANALYZE')
+        conn.execute('INSERT INTO report_snapshot (taken_at, source, archived_months, build_seconds) '
+                     'VALUES (?, ?, ?, ?)', (taken_at, source, months, round(time.perf_counter() - started, 3)))
+        conn.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        conn.close()
+    with open(scratch, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def _lower_priority(nice):
+    # Linux nices a single thread by its native id: the rest of the build
+    # only gets the CPU that request threads leave
+    if nice and hasattr(os, 'setpriority'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+        except OSError:
+            pass
+
+
+_build_lock = threading.Lock()
+
+
+def refresh(max_age=0, wait=True, nice=NICE, log=print):
+    """Rebuild every snapshot unless they are all younger than max_age seconds.
+
+    Returns the number of files rebuilt; 0 when the snapshots were fresh
+    enough or, with wait=False, another build was already running. The
+    calling thread is niced by nice once the copies are taken.
+    """
+    os.makedirs(REPORTS_DIR, exist_ok=True)
+    if not _build_lock.acquire(blocking=wait):
+        return 0
+    try:
+        with open(os.path.join(REPORTS_DIR, 'refresh.lock'), 'a') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    return 0
+            # Whoever held the lock may just have rebuilt them
+            if age() < max_age:
+                return 0
+            sources, targets = sharding.database_paths(), snapshot_paths()
+            scratches = [f'{target}.tmp-{os.getpid()}' for target in targets]
+            try:
+                # Every copy first, at full priority: each holds a read transaction on a live file
+                taken = [copy(source, scratch) for source, scratch in zip(sources, scratches)]
+                _lower_priority(nice)
+                for source, scratch, target, taken_at in zip(sources, scratches, targets, taken):
+                    started = time.perf_counter()
+                    prepare(scratch, source, taken_at)
+                    os.replace(scratch, target)
+                    log(f'snapshot of {source} taken at {taken_at} built in '
+                        f'{time.perf_counter() - started:.2f}s -> {target}')
+            finally:
+                for scratch in scratches:
+                    if os.path.exists(scratch):
+                        os.remove(scratch)
+            return len(targets)
+    finally:
+        _build_lock.release()
+
+
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def _refresh_in_background():
+    try:
+        refresh(max_age=MAX_AGE, wait=False, log=log.info)
+    except Exception:
+        log.exception('Report snapshot refresh failed')
+
+
+def refresh_if_stale():
+    """Start a background refresh if the snapshots are older than MAX_AGE."""
+    global _refresher
+    if age() < MAX_AGE:
+        return
+    with _refresher_lock:
+        if _refresher is None or not _refresher.is_alive():
+            _refresher = threading.Thread(target=_refresh_in_background, name='reports-refresh', daemon=True)
+            _refresher.start()
+
+
+def _format(row, keys):
+    result = dict(zip(keys, row))
+    for key in keys:
+        if key.endswith('_minor'):
+            result[key[:-len('_minor')]] = money.from_minor(result.pop(key), result['currency'])
+    return result
+
+
+def read(name, params=None):
+    """The named report over every snapshot, or None until they all exist.
+
+    Returns {'report', 'snapshot_at', 'rows'}; snapshot_at is the oldest
+    snapshot's copy time, in UTC.
+    """
+    sql, key_columns = REPORTS[name]
+    merged = {}
+    taken = []
+    keys = None
+    for path in snapshot_paths():
+        try:
+            conn = sqlite3.connect(_uri(path, mode='ro', immutable=1), uri=True)
+        except sqlite3.OperationalError:
+            return None
+        try:
+            taken.append(conn.execute('SELECT taken_at FROM report_snapshot').fetchone()[0])
+            cursor = conn.execute(sql, params or {})
+            keys = [column[0] for column in cursor.description]
+            for row in cursor:
+                key = row[:key_columns]
+                if key in merged:
+                    merged[key] = key + tuple(a + b for a, b in zip(merged[key][key_columns:], row[key_columns:]))
+                else:
+                    merged[key] = tuple(row)
+        finally:
+            conn.close()
+    return {
+        'report': name,
+        'snapshot_at': min(taken),
+        'rows': [_format(merged[key], keys) for key in sorted(merged)],
+    }
+
+
+def snapshot_age(snapshot_at):
+    taken = datetime.strptime(snapshot_at, statements.TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - taken).total_seconds()
+
+
+if __name__ == '__main__':
+    refresh()
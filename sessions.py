@@ -0,0 +1,129 @@
+"""Session tokens.
+
+/api/login hands out a random bearer token; only its SHA-256 is stored in
+the sessions table. Lookups go through a per-worker LRU so the
+authorization check on every request is normally a dict hit rather than
+a query. Entries live in the cache for at most CACHE_TTL seconds, which
+bounds how long another worker can keep honouring a token after logout;
+the worker that handles the logout drops it immediately.
+
+EventSource cannot send an Authorization header, so the event stream is
+opened with a ticket in its URL instead, where proxies and access logs
+record it. Tickets are issued to a signed-in session, live for
+STREAM_TICKET_TTL seconds and are stored under a hash of their own
+('stream:' + ticket), so a logged ticket opens a stream for a minute and
+is never accepted as a bearer token.
+"""
+import hashlib
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 7 * 24 * 3600))
+CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', 30))
+CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+STREAM_TICKET_TTL = int(os.environ.get('STREAM_TICKET_TTL', 60))
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        token_hash TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        expires_at INTEGER NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at);
+'''
+
+
+class TokenCache:
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # token_hash -> (user_id, cached_until)
+        self._lock = threading.Lock()
+
+    def get(self, token_hash, now):
+        with self._lock:
+            entry = self._entries.get(token_hash)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self._entries[token_hash]
+                return None
+            self._entries.move_to_end(token_hash)
+            return entry[0]
+
+    def put(self, token_hash, user_id, expires_at, now):
+        with self._lock:
+            self._entries[token_hash] = (user_id, min(now + self.ttl, expires_at))
+            self._entries.move_to_end(token_hash)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, token_hash):
+        with self._lock:
+            self._entries.pop(token_hash, None)
+
+
+cache = TokenCache()
+
+
+def _digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _create(conn, user_id, token_hash, ttl):
+    now = int(time.time())
+    expires_at = now + ttl
+    # Opportunistic cleanup; the expires_at index keeps it a range delete
+    conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+    conn.execute('INSERT INTO sessions (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)',
+                 (token_hash, user_id, now, expires_at))
+    conn.commit()
+    cache.put(token_hash, user_id, expires_at, now)
+
+
+def _lookup(conn, token_hash):
+    now = time.time()
+    user_id = cache.get(token_hash, now)
+    if user_id is not None:
+        return user_id
+    row = conn.execute('SELECT user_id, expires_at FROM sessions WHERE token_hash = ? AND expires_at > ?',
+                       (token_hash, int(now))).fetchone()
+    if row is None:
+        return None
+    cache.put(token_hash, row['user_id'], row['expires_at'], now)
+    return row['user_id']
+
+
+def create(conn, user_id):
+    token = secrets.token_urlsafe(32)
+    _create(conn, user_id, _digest(token), SESSION_TTL)
+    return token
+
+
+def lookup(conn, token):
+    """Return the user_id for a live token, or None."""
+    return _lookup(conn, _digest(token))
+
+
+def create_ticket(conn, user_id):
+    """Short-lived credential that only opens the user's event stream."""
+    ticket = secrets.token_urlsafe(32)
+    _create(conn, user_id, _digest('stream:' + ticket), STREAM_TICKET_TTL)
+    return ticket
+
+
+def lookup_ticket(conn, ticket):
+    """Return the user_id for a live stream ticket, or None."""
+    return _lookup(conn, _digest('stream:' + ticket))
+
+
+def revoke(conn, token):
+    token_hash = _digest(token)
+    cache.discard(token_hash)
+    conn.execute('DELETE FROM sessions WHERE token_hash = ?', (token_hash,))
+    conn.commit()
@@ -0,0 +1,245 @@
+"""Optional sharded storage.
+
+With SHARDS=N, users and their cards, transactions and rollups live in N
+database files under SHARD_DIR (shard-0.db, shard-1.db, ...), picked by a
+hash of the user_id, so postings for users on different shards commit
+under different write locks. DATABASE becomes the directory: it allocates
+user ids, maps email -> (user_id, shard) for login and send-money, and
+keeps the sessions and exchange rates. login_required points get_db() at
+the signed-in user's shard, so the per-user routes are unchanged.
+
+A send to a user on another shard is two local transactions joined by an
+outbox on the sender's shard and an inbox on the receiver's:
+
+1. sender's shard: debit, history row and outbox row (ledger.transfer_out)
+2. receiver's shard: credit, history row and inbox row (ledger.transfer_in);
+   a transfer id already in the inbox is skipped
+3. sender's shard: the outbox row is deleted
+
+If anything stops between 1 and 3 the outbox row stays behind. Each
+worker's OutboxRetrier thread delivers rows older than
+OUTBOX_RETRY_SECONDS every OUTBOX_RETRY_SECONDS, and recover() (run at
+startup, or ``python sharding.py``) delivers all of them; the inbox
+turns a replay of an already applied credit into a no-op. Money in flight
+is delayed, never lost or credited twice.
+
+Registration follows the same pattern: the directory row is written
+inactive, the account is opened on its shard, then the row is activated.
+recover() finishes or removes registrations that were interrupted.
+
+Every shard is migrated like DATABASE (see migrations.py), default
+exchange rates included; conversions read the rates of the user's shard,
+so rate changes must be applied to every file. Write group commit (WRITE_PIPELINE) has a
+single writer connection per worker, so it is only used without sharding.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+import db
+import ledger
+
+SHARDS = int(os.environ.get('SHARDS', 0))
+ENABLED = SHARDS > 0
+SHARD_DIR = os.environ.get('SHARD_DIR') or db.DATABASE + '-shards'
+
+# Inactive registrations older than this were interrupted, not in progress
+STALE_REGISTRATION_SECONDS = 60
+# Outbox rows older than this were deferred, not being delivered by their request
+RETRY_SECONDS = float(os.environ.get('OUTBOX_RETRY_SECONDS', 5))
+
+log = logging.getLogger('paypal_mvp.sharding')
+
+DIRECTORY_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS accounts (
+        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE NOT NULL,
+        shard INTEGER NOT NULL,
+        active INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+'''
+
+SHARD_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        transfer_id TEXT PRIMARY KEY,
+        to_shard INTEGER NOT NULL,
+        from_user_id INTEGER NOT NULL,
+        from_email TEXT NOT NULL,
+        to_user_id INTEGER NOT NULL,
+        amount_minor INTEGER NOT NULL,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS inbox (
+        transfer_id TEXT PRIMARY KEY,
+        received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID;
+'''
+
+_ACCOUNTS_QUERY = '''
+    SELECT user_id, email, shard FROM accounts
+    WHERE email IN (SELECT value FROM json_each(?)) AND active = 1
+'''
+
+
+def shard_of(user_id):
+    return zlib.crc32(int(user_id).to_bytes(8, 'little')) % SHARDS
+
+
+def shard_path(shard):
+    return os.path.join(SHARD_DIR, f'shard-{shard}.db')
+
+
+def database_paths():
+    """Every file that holds users: the shards, or just DATABASE."""
+    return [shard_path(shard) for shard in range(SHARDS)] if ENABLED else [db.DATABASE]
+
+
+def path_for_user(user_id):
+    return shard_path(shard_of(user_id)) if ENABLED else db.DATABASE
+
+
+def path_for_email(directory, email):
+    """Database holding the user with this email.
+
+    Unknown emails map to DATABASE, whose users table is empty when sharded.
+    """
+    if not ENABLED:
+        return db.DATABASE
+    account = lookup(directory, [email]).get(email)
+    return shard_path(account['shard']) if account else db.DATABASE
+
+
+def lookup(directory, emails):
+    """email -> {'user_id', 'email', 'shard'} for the registered ones."""
+    rows = directory.execute(_ACCOUNTS_QUERY, (json.dumps(sorted(set(emails))),)).fetchall()
+    return {row['email']: dict(row) for row in rows}
+
+
+def remote_accounts(directory, from_user_id, emails):
+    """Directory entries of the recipients that live on another shard than the sender."""
+    if not ENABLED:
+        return {}
+    home = shard_of(from_user_id)
+    return {email: account for email, account in lookup(directory, emails).items() if account['shard'] != home}
+
+
+def register(directory, connect, email, password_hash, bonus_minor):
+    """Allocate a user id and open the account on its shard; returns the user_id.
+
+    connect(shard) returns a connection to that shard. Raises
+    sqlite3.IntegrityError if the email is taken.
+    """
+    directory.execute('BEGIN IMMEDIATE')
+    try:
+        user_id = directory.execute('INSERT INTO accounts (email, shard) VALUES (?, -1)', (email,)).lastrowid
+        shard = shard_of(user_id)
+        directory.execute('UPDATE accounts SET shard = ? WHERE user_id = ?', (shard, user_id))
+        directory.commit()
+    except BaseException:
+        directory.rollback()
+        raise
+
+    try:
+        ledger.post(connect(shard), ledger.open_account, email, password_hash, bonus_minor, user_id)
+    except BaseException:
+        directory.execute('DELETE FROM accounts WHERE user_id = ?', (user_id,))
+        directory.commit()
+        raise
+    directory.execute('UPDATE accounts SET active = 1 WHERE user_id = ?', (user_id,))
+    directory.commit()
+    return user_id
+
+
+def deliver(conn, connect, transfer_ids=None, min_age=0):
+    """Apply the outbox rows of the shard behind conn (all of them by default,
+    or those at least min_age seconds old) on their receivers' shards.
+    Returns how many were delivered."""
+    if transfer_ids is None:
+        rows = conn.execute("SELECT * FROM outbox WHERE created_at <= datetime('now', ?) ORDER BY created_at",
+                            (f'-{min_age} seconds',)).fetchall()
+    else:
+        rows = conn.execute('SELECT * FROM outbox WHERE transfer_id IN (SELECT value FROM json_each(?))',
+                            (json.dumps(transfer_ids),)).fetchall()
+    for row in rows:
+        ledger.run_posting(connect(row['to_shard']), ledger.transfer_in, dict(row))
+        conn.execute('DELETE FROM outbox WHERE transfer_id = ?', (row['transfer_id'],))
+        conn.commit()
+    return len(rows)
+
+
+def recover(directory, connect):
+    """Settle interrupted registrations and deliver every queued cross-shard credit."""
+    stale = directory.execute('''
+        SELECT user_id, shard FROM accounts
+        WHERE active = 0 AND created_at <= datetime('now', ?)
+    ''', (f'-{STALE_REGISTRATION_SECONDS} seconds',)).fetchall()
+    for row in stale:
+        opened = connect(row['shard']).execute("SELECT 1 FROM users WHERE id = ? AND password != ''",
+                                               (row['user_id'],)).fetchone()
+        if opened:
+            directory.execute('UPDATE accounts SET active = 1 WHERE user_id = ?', (row['user_id'],))
+        else:
+            directory.execute('DELETE FROM accounts WHERE user_id = ?', (row['user_id'],))
+    directory.commit()
+    return sum(deliver(connect(shard), connect) for shard in range(SHARDS))
+
+
+class OutboxRetrier:
+    """Delivers the outbox rows that requests had to leave behind, from a thread in each worker.
+
+    Without it a credit deferred by a transient lock would wait for the next
+    restart's recover(). Workers may retry the same row at once; the inbox
+    makes the second credit a no-op.
+    """
+
+    def __init__(self, interval=RETRY_SECONDS):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # The thread does not survive gunicorn's fork; start one per worker
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._run, name='outbox-retrier', daemon=True).start()
+                    self._pid = os.getpid()
+
+    def _run(self):
+        connections = {}
+
+        def connect(shard):
+            if shard not in connections:
+                connections[shard] = db.connect(shard_path(shard))
+            return connections[shard]
+
+        while True:
+            time.sleep(self.interval)
+            for shard in range(SHARDS):
+                try:
+                    delivered = deliver(connect(shard), connect, min_age=self.interval)
+                    if delivered:
+                        log.info('delivered %d deferred transfers from shard %d', delivered, shard)
+                except Exception as e:  # still locked: the next round tries again
+                    log.warning('outbox retry: shard %d: %s', shard, e)
+                    for conn in connections.values():
+                        conn.rollback()
+
+
+retrier = OutboxRetrier()
+
+
+if __name__ == '__main__':
+    connections = {}
+
+    def connect(shard):
+        if shard not in connections:
+            connections[shard] = db.connect(shard_path(shard))
+        return connections[shard]
+
+    print(f'delivered {recover(db.connect(), connect)} queued transfers')
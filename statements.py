@@ -0,0 +1,246 @@
+"""Running balances and daily rollups.
+
+Every transactions row carries the TL balance (balance_minor) of each
+party right after it was posted: from_balance_after / to_balance_after.
+"What was the balance at time X" is then the balance on the user's last
+row at or before X, found with one seek per direction on the existing
+(user, created_at) indexes.
+
+daily_rollups holds per-user, per-day in/out totals and a row count for
+each account money sits in: USD for the cards and TL for the user
+balance, which also holds every other currency (see ledger.convert), so
+opening balance + in - out equals the closing balance. The ledger updates
+it in the same transaction as the postings it summarises (record()), so a
+statement for any period reads at most one rollup row per day and
+account instead of replaying history.
+
+All times are UTC, like CURRENT_TIMESTAMP.
+"""
+from datetime import datetime, timedelta, timezone
+
+import archive
+import money
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS daily_rollups (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        in_minor INTEGER NOT NULL DEFAULT 0,
+        out_minor INTEGER NOT NULL DEFAULT 0,
+        tx_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day, currency)
+    ) WITHOUT ROWID;
+'''
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+DAY_FORMAT = '%Y-%m-%d'
+
+_UPSERT = '''
+    INSERT INTO daily_rollups (user_id, day, currency, in_minor, out_minor, tx_count)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, day, currency) DO UPDATE SET
+        in_minor = in_minor + excluded.in_minor,
+        out_minor = out_minor + excluded.out_minor,
+        tx_count = tx_count + excluded.tx_count
+'''
+
+# Latest row at or before :ts on either side, with this user's balance after it
+BALANCE_AT_QUERY = '''
+    SELECT created_at, id, balance FROM (
+        SELECT * FROM (
+            SELECT created_at, id, from_balance_after AS balance FROM transactions
+            WHERE from_user_id = :user_id AND created_at <= :ts
+            ORDER BY created_at DESC, id DESC LIMIT 1
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT created_at, id, to_balance_after AS balance FROM transactions
+            WHERE to_user_id = :user_id AND created_at <= :ts
+            ORDER BY created_at DESC, id DESC LIMIT 1
+        )
+    )
+    ORDER BY created_at DESC, id DESC
+    LIMIT 1
+'''
+
+# The user's first row on either side, to tell "before the account" from "unrecorded"
+FIRST_ROW_QUERY = '''
+    SELECT created_at, id, balance FROM (
+        SELECT * FROM (
+            SELECT created_at, id, from_balance_after AS balance FROM transactions
+            WHERE from_user_id = :user_id ORDER BY created_at, id LIMIT 1
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT created_at, id, to_balance_after AS balance FROM transactions
+            WHERE to_user_id = :user_id ORDER BY created_at, id LIMIT 1
+        )
+    )
+    ORDER BY created_at, id
+    LIMIT 1
+'''
+
+ROLLUPS_QUERY = '''
+    SELECT day, currency, in_minor, out_minor, tx_count FROM daily_rollups
+    WHERE user_id = ? AND day BETWEEN ? AND ?
+    ORDER BY day, currency
+'''
+
+# Legacy rows in the account they moved (USD card or TL balance), rescaled like ledger._holding
+_ACCOUNT_SQL = f"iif(currency = '{money.CARD_CURRENCY}', '{money.CARD_CURRENCY}', '{money.BALANCE_CURRENCY}')"
+_ACCOUNT_MINOR_SQL = 'amount_minor * CASE currency {} ELSE 1 END'.format(' '.join(
+    f"WHEN '{code}' THEN {10 ** (money.exponent(money.BALANCE_CURRENCY) - exp)}"
+    for code, exp in money.EXPONENTS.items()))
+
+
+def now():
+    """Posting timestamp, in the same format as CURRENT_TIMESTAMP."""
+    return datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+def record(cursor, entries):
+    """Add (user_id, created_at, currency, in_minor, out_minor, count) entries to the rollups."""
+    cursor.executemany(_UPSERT, [(user_id, created_at[:10], currency, in_minor, out_minor, count)
+                                 for user_id, created_at, currency, in_minor, out_minor, count in entries])
+
+
+def parse_timestamp(value):
+    """UTC 'YYYY-MM-DD HH:MM:SS' for an ISO date or datetime, or None.
+
+    A bare date means the end of that day.
+    """
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    elif len(value.strip()) == 10:
+        parsed = parsed.replace(hour=23, minute=59, second=59)
+    return parsed.strftime(TIMESTAMP_FORMAT)
+
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value, DAY_FORMAT).date()
+    except (TypeError, ValueError):
+        return None
+
+
+def balance_at(conn, user_id, ts):
+    """TL balance in minor units right after ts, or None if it predates the recorded balances."""
+    params = {'user_id': user_id, 'ts': ts}
+    rows = conn.execute(BALANCE_AT_QUERY, params).fetchall()
+    rows = archive.extend_page(conn, BALANCE_AT_QUERY, params, rows, user_id, ts, 1)
+    if rows:
+        return rows[0]['balance']
+
+    first = archive.first_row(conn, FIRST_ROW_QUERY, {'user_id': user_id}, user_id)
+    if first is not None:
+        # Accounts opened with a recorded bonus row started at zero; older history is unknown
+        return 0 if first['balance'] is not None else None
+
+    # No postings at all: the balance has not moved since the account was opened
+    user = conn.execute('SELECT balance_minor, created_at FROM users WHERE id = ?', (user_id,)).fetchone()
+    return user['balance_minor'] if user['created_at'] <= ts else 0
+
+
+def statement(conn, user_id, start, end):
+    """Opening/closing balance and per-currency totals for the days start..end (dates, inclusive)."""
+    first_day, last_day = start.strftime(DAY_FORMAT), end.strftime(DAY_FORMAT)
+    days = conn.execute(ROLLUPS_QUERY, (user_id, first_day, last_day)).fetchall()
+
+    totals = {}
+    for row in days:
+        total = totals.setdefault(row['currency'], [0, 0, 0])
+        total[0] += row['in_minor']
+        total[1] += row['out_minor']
+        total[2] += row['tx_count']
+
+    opening = balance_at(conn, user_id, (start - timedelta(days=1)).strftime(DAY_FORMAT) + ' 23:59:59')
+    closing = balance_at(conn, user_id, last_day + ' 23:59:59')
+    return {
+        'user_id': user_id,
+        'from': first_day,
+        'to': last_day,
+        'opening_balance': None if opening is None else money.from_minor(opening),
+        'closing_balance': None if closing is None else money.from_minor(closing),
+        'totals': [{
+            'currency': currency,
+            'in': money.from_minor(in_minor, currency),
+            'out': money.from_minor(out_minor, currency),
+            'count': count
+        } for currency, (in_minor, out_minor, count) in sorted(totals.items())],
+        'days': [{
+            'day': row['day'],
+            'currency': row['currency'],
+            'in': money.from_minor(row['in_minor'], row['currency']),
+            'out': money.from_minor(row['out_minor'], row['currency']),
+            'count': row['tx_count']
+        } for row in days]
+    }
+
+
+def add_rollups(conn, after_id, last_id):
+    """Add transactions after_id < id <= last_id into daily_rollups; the caller commits.
+
+    Conversions only count on their debit side: rows do not store the credited amount.
+    Archived months (see archive.py) are not read, so rebuild before archiving.
+    """
+    conn.execute('''
+        INSERT INTO daily_rollups (user_id, day, currency, in_minor, out_minor, tx_count)
+        SELECT user_id, day, currency, SUM(in_minor), SUM(out_minor), SUM(tx_count) FROM (
+            SELECT from_user_id AS user_id, date(created_at) AS day, {account} AS currency,
+                   0 AS in_minor, {account_minor} AS out_minor, 1 AS tx_count
+            FROM transactions WHERE from_user_id IS NOT NULL AND id > :after AND id <= :last
+            UNION ALL
+            SELECT to_user_id, date(created_at), {account}, {account_minor}, 0, 1
+            FROM transactions WHERE to_user_id IS NOT NULL AND id > :after AND id <= :last
+            UNION ALL
+            -- Card-to-card moves credit the same user's other card
+            SELECT from_user_id, date(created_at), {account}, {account_minor}, 0, 0
+            FROM transactions WHERE type = 'card_transfer' AND from_user_id IS NOT NULL
+              AND id > :after AND id <= :last
+        )
+        WHERE true
+        GROUP BY user_id, day, currency
+        ON CONFLICT (user_id, day, currency) DO UPDATE SET
+            in_minor = in_minor + excluded.in_minor,
+            out_minor = out_minor + excluded.out_minor,
+            tx_count = tx_count + excluded.tx_count
+    '''.format(account=_ACCOUNT_SQL, account_minor=_ACCOUNT_MINOR_SQL), {'after': after_id, 'last': last_id})
+
+
+def rebuild_rollups(conn):
+    """Recompute daily_rollups from the whole transactions table; the caller commits."""
+    conn.execute('DELETE FROM daily_rollups')
+    add_rollups(conn, 0, 2 ** 63 - 1)
+
+
+def anchor_balances(conn, after_user_id, last_user_id):
+    """Stamp the current balance on the latest row of users after_user_id < id <= last_user_id.
+
+    For history written before running balances existed: old rows cannot be
+    replayed into exact balances (conversion rows never stored the credited
+    amount), so only the latest row is anchored and balance_at() reports
+    earlier times as unknown. The caller commits.
+    """
+    latest = conn.execute('''
+        SELECT u.id, u.balance_minor,
+               (SELECT created_at || '|' || printf('%020d', id) FROM transactions
+                WHERE from_user_id = u.id ORDER BY created_at DESC, id DESC LIMIT 1) AS last_from,
+               (SELECT created_at || '|' || printf('%020d', id) FROM transactions
+                WHERE to_user_id = u.id ORDER BY created_at DESC, id DESC LIMIT 1) AS last_to
+        FROM users u WHERE u.id > ? AND u.id <= ?
+    ''', (after_user_id, last_user_id)).fetchall()
+    from_anchors, to_anchors = [], []
+    for user_id, balance, last_from, last_to in latest:
+        if last_from and (not last_to or last_from > last_to):
+            from_anchors.append((balance, int(last_from.rsplit('|', 1)[1])))
+        elif last_to:
+            to_anchors.append((balance, int(last_to.rsplit('|', 1)[1])))
+    conn.executemany('UPDATE transactions SET from_balance_after = ? WHERE id = ?', from_anchors)
+    conn.executemany('UPDATE transactions SET to_balance_after = ? WHERE id = ?', to_anchors)
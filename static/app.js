@@ -5,7 +5,13 @@ const API_URL = window.location.hostname === 'localhost'
 
 let currentUser = null;
 let userCards = [];
+let userTransactions = [];
 let exchangeRates = {};
+let eventSource = null;
+let lastEventId = null;
+
+// Newest transactions kept on screen, like the dashboard's first page
+const TRANSACTIONS_SHOWN = 50;
 
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
@@ -13,7 +19,13 @@ document.addEventListener('DOMContentLoaded', () => {
     const savedUser = localStorage.getItem('currentUser');
     if (savedUser) {
         currentUser = JSON.parse(savedUser);
-        showDashboard();
+        // Sessions from before token auth cannot call the API; ask for a fresh login
+        if (currentUser.token) {
+            showDashboard();
+        } else {
+            currentUser = null;
+            localStorage.removeItem('currentUser');
+        }
     }
     
     // Load theme
@@ -46,8 +58,15 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
     
-    // Load exchange rate
-    loadExchangeRate();
+    // Exchange preview listeners
+    document.getElementById('fromCurrency')?.addEventListener('change', updateExchangePreview);
+    document.getElementById('toCurrency')?.addEventListener('change', updateExchangePreview);
+    document.getElementById('exchangeAmount')?.addEventListener('input', updateExchangePreview);
+    
+    // Logged-in users get the rates with the dashboard
+    if (!currentUser) {
+        loadExchangeRate();
+    }
 });
 
 // Theme Functions
@@ -124,7 +143,7 @@ async function handleRegister(event) {
         if (response.ok) {
             showMessage('authMessage', data.message, 'success');
             setTimeout(() => {
-                currentUser = { user_id: data.user_id, email: data.email };
+                currentUser = { user_id: data.user_id, email: data.email, token: data.token };
                 localStorage.setItem('currentUser', JSON.stringify(currentUser));
                 showDashboard();
             }, 1500);
@@ -137,6 +156,11 @@ async function handleRegister(event) {
 }
 
 function handleLogout() {
+    closeEventStream();
+    lastEventId = null;
+    if (currentUser && currentUser.token) {
+        fetch(`${API_URL}/logout`, { method: 'POST', headers: authHeaders() }).catch(() => {});
+    }
     currentUser = null;
     localStorage.removeItem('currentUser');
     document.getElementById('dashboardScreen').classList.remove('active');
@@ -151,26 +175,117 @@ async function showDashboard() {
     
     document.getElementById('userEmail').textContent = currentUser.email;
     
-    await updateBalance();
-    await loadCards();
-    await loadTransactions();
+    // The stream's first event ('ready') triggers the dashboard load
+    openEventStream();
+}
+
+// Live updates: the server pushes every change to this user's balance,
+// cards and transactions, so nothing is re-fetched after an action
+async function openEventStream() {
+    closeEventStream();
+    // EventSource cannot send the Authorization header, and a URL ends up in access logs:
+    // open the stream with a short-lived, stream-only ticket instead of the session token
+    let ticket = null;
+    try {
+        const response = await fetch(`${API_URL}/events/ticket`, { method: 'POST', headers: authHeaders() });
+        if (expireIfUnauthorized(response)) return;
+        if (response.ok) ticket = (await response.json()).ticket;
+    } catch (error) {
+        console.error('Event stream ticket error:', error);
+    }
+    if (!currentUser) return;
+    closeEventStream();
+    const params = new URLSearchParams({ ticket: ticket || '' });
+    // A reopened stream (the ticket only lasts a minute) replays what it missed
+    if (lastEventId) params.set('last_event_id', lastEventId);
+    const source = new EventSource(`${API_URL}/events/${currentUser.user_id}?${params}`);
+    eventSource = source;
+    let loaded = false;
+    
+    const seen = (e) => { if (e.lastEventId) lastEventId = e.lastEventId; };
+    // 'ready' on a fresh stream, 'reset' when missed events can no longer be replayed
+    const reload = (e) => { seen(e); loaded = true; loadDashboard(); };
+    source.addEventListener('ready', reload);
+    source.addEventListener('reset', reload);
+    source.addEventListener('transaction', (e) => { seen(e); applyTransaction(JSON.parse(e.data)); });
+    source.addEventListener('card', (e) => { seen(e); applyCard(JSON.parse(e.data)); });
+    
+    // EventSource reconnects by itself (sending Last-Event-ID) unless the server refused the stream,
+    // as it does once the ticket in the URL has expired; a new one is fetched then
+    source.onerror = () => {
+        if (source.readyState !== EventSource.CLOSED || eventSource !== source) return;
+        if (!loaded) loadDashboard();
+        updateBalance();
+        setTimeout(() => {
+            if (currentUser && eventSource === source) openEventStream();
+        }, 5000);
+    };
+}
+
+function closeEventStream() {
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+    }
+}
+
+function applyTransaction(tx) {
+    if (tx.balance_after != null) {
+        renderBalance({ balance: tx.balance_after });
+    }
+    if (userTransactions.some(t => t.id === tx.id)) return;
+    userTransactions.unshift(tx);
+    renderTransactions(userTransactions.slice(0, TRANSACTIONS_SHOWN));
+}
+
+function applyCard(card) {
+    const index = userCards.findIndex(c => c.id === card.id);
+    if (index === -1) {
+        userCards.push(card);
+    } else {
+        userCards[index] = card;
+    }
+    renderCards(userCards);
+}
+
+// Balance, cards, latest transactions and rates in one round trip
+async function loadDashboard() {
+    try {
+        const response = await fetch(`${API_URL}/dashboard/${currentUser.user_id}`, { headers: authHeaders() });
+        if (expireIfUnauthorized(response)) return;
+        const data = await response.json();
+        
+        if (response.ok) {
+            renderBalance(data.user);
+            renderCards(data.cards);
+            renderTransactions(data.transactions);
+            renderExchangeRates(data.exchange_rates);
+        }
+    } catch (error) {
+        console.error('Dashboard load error:', error);
+    }
 }
 
 async function updateBalance() {
     try {
-        const response = await fetch(`${API_URL}/user/${currentUser.user_id}`);
+        const response = await fetch(`${API_URL}/user/${currentUser.user_id}`, { headers: authHeaders() });
+        if (expireIfUnauthorized(response)) return;
         const data = await response.json();
         
         if (response.ok) {
-            currentUser.balance = data.balance;
-            document.getElementById('balanceAmount').textContent = 
-                `${data.balance.toFixed(2)} ₺`;
+            renderBalance(data);
         }
     } catch (error) {
         console.error('Balance update error:', error);
     }
 }
 
+function renderBalance(user) {
+    currentUser.balance = user.balance;
+    document.getElementById('balanceAmount').textContent = 
+        `${user.balance.toFixed(2)} ₺`;
+}
+
 // Tab Functions
 function showTab(tabName) {
     // Update tab buttons with smooth transition
@@ -200,46 +315,35 @@ function showTab(tabName) {
         }, 10);
     }, 200);
     
-    // Reload data based on tab
-    if (tabName === 'transactions') {
-        loadTransactions();
-    } else if (tabName === 'cards') {
-        loadCards();
-    }
 }
 
 // Card Functions
-async function loadCards() {
-    try {
-        const response = await fetch(`${API_URL}/cards/${currentUser.user_id}`);
-        userCards = await response.json();
-        
-        const cardsList = document.getElementById('cardsList');
-        
-        if (userCards.length === 0) {
-            cardsList.innerHTML = '<p class="empty-state">Henüz kart eklenmemiş</p>';
-        } else {
-            cardsList.innerHTML = userCards.map(card => {
-                const cardTypeIcon = card.card_type === 'Visa' ? '💳' : 
-                                    card.card_type === 'Mastercard' ? '💳' : '💳';
-                return `
-                    <div class="card-item">
-                        <div class="card-type">${cardTypeIcon} ${card.card_type}</div>
-                        <div class="card-number">${card.card_number}</div>
-                        <div class="card-holder">${card.card_holder}</div>
-                        <div class="card-balance">💰 ${card.balance_usd.toLocaleString('en-US')} USD</div>
-                        <div class="card-expiry">Exp: ${card.expiry}</div>
-                    </div>
-                `;
-            }).join('');
-        }
-        
-        // Update card selections
-        updateCardSelection();
-        updateCardSelections();
-    } catch (error) {
-        console.error('Load cards error:', error);
+function renderCards(cards) {
+    userCards = cards;
+    
+    const cardsList = document.getElementById('cardsList');
+    
+    if (userCards.length === 0) {
+        cardsList.innerHTML = '<p class="empty-state">Henüz kart eklenmemiş</p>';
+    } else {
+        cardsList.innerHTML = userCards.map(card => {
+            const cardTypeIcon = card.card_type === 'Visa' ? '💳' : 
+                                card.card_type === 'Mastercard' ? '💳' : '💳';
+            return `
+                <div class="card-item">
+                    <div class="card-type">${cardTypeIcon} ${card.card_type}</div>
+                    <div class="card-number">${card.card_number}</div>
+                    <div class="card-holder">${card.card_holder}</div>
+                    <div class="card-balance">💰 ${card.balance_usd.toLocaleString('en-US')} USD</div>
+                    <div class="card-expiry">Exp: ${card.expiry}</div>
+                </div>
+            `;
+        }).join('');
     }
+    
+    // Update card selections
+    updateCardSelection();
+    updateCardSelections();
 }
 
 function updateCardSelection() {
@@ -273,7 +377,7 @@ async function handleAddCard(event) {
     try {
         const response = await fetch(`${API_URL}/cards`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: authHeaders({ 'Content-Type': 'application/json' }),
             body: JSON.stringify(cardData)
         });
         
@@ -283,8 +387,6 @@ async function handleAddCard(event) {
             showMessage('dashboardMessage', data.message, 'success');
             closeModal('addCardModal');
             event.target.reset();
-            await loadCards();
-            updateCardSelections();
         } else {
             alert(data.error);
         }
@@ -322,7 +424,7 @@ async function handleAddBalance() {
     try {
         const response = await fetch(`${API_URL}/add-balance`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: authHeaders({ 'Content-Type': 'application/json' }),
             body: JSON.stringify({
                 user_id: currentUser.user_id,
                 card_id: cardId,
@@ -336,8 +438,6 @@ async function handleAddBalance() {
             showMessage('dashboardMessage', data.message, 'success');
             closeModal('addBalanceModal');
             document.getElementById('addBalanceAmount').value = '';
-            await updateBalance();
-            await loadTransactions();
         } else {
             alert(data.error);
         }
@@ -347,41 +447,37 @@ async function handleAddBalance() {
 }
 
 // Transaction Functions
-async function loadTransactions() {
-    try {
-        const response = await fetch(`${API_URL}/transactions/${currentUser.user_id}`);
-        const transactions = await response.json();
-        
-        const transactionsList = document.getElementById('transactionsList');
-        
-        if (transactions.length === 0) {
-            transactionsList.innerHTML = '<p class="empty-state">Henüz işlem yok</p>';
-        } else {
-            transactionsList.innerHTML = transactions.map(tx => {
-                const isIncoming = tx.is_incoming;
-                const otherEmail = isIncoming ? tx.from_email : tx.to_email;
-                const amountClass = isIncoming ? 'incoming' : 'outgoing';
-                const amountSign = isIncoming ? '+' : '-';
-                const label = tx.type === 'deposit' ? 'Bakiye Yükleme' : 
-                             (isIncoming ? 'Gelen Transfer' : 'Giden Transfer');
-                
-                return `
-                    <div class="transaction-item">
-                        <div class="transaction-info">
-                            <div class="transaction-email">${label}</div>
-                            ${otherEmail ? `<div class="transaction-desc">${otherEmail}</div>` : ''}
-                            ${tx.description ? `<div class="transaction-desc">${tx.description}</div>` : ''}
-                            <div class="transaction-date">${formatDate(tx.created_at)}</div>
-                        </div>
-                        <div class="transaction-amount ${amountClass}">
-                            ${amountSign}${tx.amount.toFixed(2)} ₺
-                        </div>
+function renderTransactions(transactions) {
+    userTransactions = transactions;
+    const transactionsList = document.getElementById('transactionsList');
+    
+    if (transactions.length === 0) {
+        transactionsList.innerHTML = '<p class="empty-state">Henüz işlem yok</p>';
+    } else {
+        transactionsList.innerHTML = transactions.map(tx => {
+            const isIncoming = tx.is_incoming;
+            const otherEmail = isIncoming ? tx.from_email : tx.to_email;
+            const amountClass = isIncoming ? 'incoming' : 'outgoing';
+            const amountSign = isIncoming ? '+' : '-';
+            const label = tx.type === 'deposit' ? 'Bakiye Yükleme' : 
+                         tx.type === 'bonus' ? 'Hoş Geldin Bonusu' :
+                         (isIncoming ? 'Gelen Transfer' : 'Giden Transfer');
+            
+            return `
+                <div class="transaction-item">
+                    <div class="transaction-info">
+                        <div class="transaction-email">${label}</div>
+                        ${otherEmail ? `<div class="transaction-desc">${otherEmail}</div>` : ''}
+                        ${tx.description ? `<div class="transaction-desc">${tx.description}</div>` : ''}
+                        <div class="transaction-date">${formatDate(tx.created_at)}</div>
+                        ${tx.balance_after != null ? `<div class="transaction-desc">Bakiye: ${tx.balance_after.toFixed(2)} ₺</div>` : ''}
                     </div>
-                `;
-            }).join('');
-        }
-    } catch (error) {
-        console.error('Load transactions error:', error);
+                    <div class="transaction-amount ${amountClass}">
+                        ${amountSign}${tx.amount.toFixed(2)} ₺
+                    </div>
+                </div>
+            `;
+        }).join('');
     }
 }
 
@@ -400,7 +496,7 @@ async function handleSendMoney(event) {
     try {
         const response = await fetch(`${API_URL}/send-money`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: authHeaders({ 'Content-Type': 'application/json' }),
             body: JSON.stringify({
                 from_user_id: currentUser.user_id,
                 to_email: recipientEmail,
@@ -414,8 +510,6 @@ async function handleSendMoney(event) {
         if (response.ok) {
             showMessage('dashboardMessage', data.message, 'success');
             event.target.reset();
-            await updateBalance();
-            await loadTransactions();
         } else {
             showMessage('dashboardMessage', data.error, 'error');
         }
@@ -428,51 +522,49 @@ async function handleSendMoney(event) {
 async function loadExchangeRate() {
     try {
         const response = await fetch(`${API_URL}/exchange-rates`);
-        exchangeRates = await response.json();
-        
-        // Populate currency grid
-        const grid = document.getElementById('currencyGrid');
-        if (grid) {
-            grid.innerHTML = Object.entries(exchangeRates)
-                .sort((a, b) => a[0].localeCompare(b[0]))
-                .map(([code, data]) => `
-                    <div class="currency-item">
-                        <div class="currency-code">${data.symbol} ${code}</div>
-                        <div class="currency-name">${data.currency_name}</div>
-                        <div class="currency-rate">1 ${code} = ${(1 / data.rate_to_usd).toFixed(4)} USD</div>
-                    </div>
-                `).join('');
-        }
-        
-        // Populate currency selects
-        const fromSelect = document.getElementById('fromCurrency');
-        const toSelect = document.getElementById('toCurrency');
-        
-        if (fromSelect && toSelect) {
-            const options = Object.entries(exchangeRates)
-                .sort((a, b) => a[0].localeCompare(b[0]))
-                .map(([code, data]) => 
-                    `<option value="${code}">${data.symbol} ${code} - ${data.currency_name}</option>`
-                ).join('');
-            
-            fromSelect.innerHTML = '<option value="">Seçiniz...</option>' + options;
-            toSelect.innerHTML = '<option value="">Seçiniz...</option>' + options;
-            
-            // Set defaults
-            fromSelect.value = 'USD';
-            toSelect.value = 'TRY';
-        }
-        
-        // Add change listeners for preview
-        document.getElementById('fromCurrency')?.addEventListener('change', updateExchangePreview);
-        document.getElementById('toCurrency')?.addEventListener('change', updateExchangePreview);
-        document.getElementById('exchangeAmount')?.addEventListener('input', updateExchangePreview);
-        
+        renderExchangeRates(await response.json());
     } catch (error) {
         console.error('Load exchange rate error:', error);
     }
 }
 
+function renderExchangeRates(rates) {
+    exchangeRates = rates;
+    
+    // Populate currency grid
+    const grid = document.getElementById('currencyGrid');
+    if (grid) {
+        grid.innerHTML = Object.entries(exchangeRates)
+            .sort((a, b) => a[0].localeCompare(b[0]))
+            .map(([code, data]) => `
+                <div class="currency-item">
+                    <div class="currency-code">${data.symbol} ${code}</div>
+                    <div class="currency-name">${data.currency_name}</div>
+                    <div class="currency-rate">1 ${code} = ${(1 / data.rate_to_usd).toFixed(4)} USD</div>
+                </div>
+            `).join('');
+    }
+    
+    // Populate currency selects
+    const fromSelect = document.getElementById('fromCurrency');
+    const toSelect = document.getElementById('toCurrency');
+    
+    if (fromSelect && toSelect) {
+        const options = Object.entries(exchangeRates)
+            .sort((a, b) => a[0].localeCompare(b[0]))
+            .map(([code, data]) => 
+                `<option value="${code}">${data.symbol} ${code} - ${data.currency_name}</option>`
+            ).join('');
+        
+        fromSelect.innerHTML = '<option value="">Seçiniz...</option>' + options;
+        toSelect.innerHTML = '<option value="">Seçiniz...</option>' + options;
+        
+        // Set defaults
+        fromSelect.value = 'USD';
+        toSelect.value = 'TRY';
+    }
+}
+
 function updateExchangePreview() {
     const fromCurrency = document.getElementById('fromCurrency').value;
     const toCurrency = document.getElementById('toCurrency').value;
@@ -514,7 +606,7 @@ async function handleExchange(event) {
     try {
         const response = await fetch(`${API_URL}/convert-currency`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: authHeaders({ 'Content-Type': 'application/json' }),
             body: JSON.stringify(exchangeData)
         });
         
@@ -523,9 +615,6 @@ async function handleExchange(event) {
         if (response.ok) {
             showMessage('dashboardMessage', data.message + ': ' + data.description, 'success');
             event.target.reset();
-            await updateBalance();
-            await loadCards();
-            await loadTransactions();
         } else {
             showMessage('dashboardMessage', data.error, 'error');
         }
@@ -547,7 +636,7 @@ async function handleCardTransfer(event) {
     try {
         const response = await fetch(`${API_URL}/transfer-between-cards`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: authHeaders({ 'Content-Type': 'application/json' }),
             body: JSON.stringify(transferData)
         });
         
@@ -556,8 +645,6 @@ async function handleCardTransfer(event) {
         if (response.ok) {
             showMessage('dashboardMessage', data.message, 'success');
             event.target.reset();
-            await loadCards();
-            await loadTransactions();
         } else {
             showMessage('dashboardMessage', data.error, 'error');
         }
@@ -603,6 +690,19 @@ function updateCardSelections() {
 }
 
 // Helper Functions
+function authHeaders(extra = {}) {
+    return { ...extra, 'Authorization': `Bearer ${currentUser.token}` };
+}
+
+function expireIfUnauthorized(response) {
+    if (response.status === 401) {
+        handleLogout();
+        showMessage('authMessage', 'Oturumunuz sona erdi, lütfen tekrar giriş yapın', 'error');
+        return true;
+    }
+    return false;
+}
+
 function showMessage(elementId, message, type) {
     const messageEl = document.getElementById(elementId);
     messageEl.textContent = message;